@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import os
+import tarfile
+import tempfile
+
+logger = logging.getLogger('ci')
+
+
+def parse_cache_directories(text):
+    """
+    Parses cache definitions, one per line::
+
+        <directory>: <key file> <key file> ...
+
+    Returns a list of (directory, key files) tuples. Raises ValueError for
+    paths outside of the build directory.
+    """
+    directories = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        directory, _, files = line.partition(':')
+        directory = directory.strip().rstrip('/')
+        for path in [directory] + files.split():
+            if os.path.isabs(path) or '..' in path.split('/'):
+                raise ValueError("%s is outside of the build directory" %
+                                 path)
+        directories.append((directory, files.split()))
+    return directories
+
+
+def is_inside(base_path, path):
+    base_path = os.path.realpath(base_path)
+    return os.path.realpath(os.path.join(base_path, path)).startswith(
+        base_path + os.sep)
+
+
+def check_members(members, base_path):
+    """
+    Raises TarError unless all the archive <members> are extracted under
+    <base_path>. Symbolic links may point anywhere (virtualenvs have
+    absolute ones), but nothing is extracted through them.
+    """
+    links = set([member.name.rstrip('/') for member in members
+                 if member.issym()])
+    for member in members:
+        parts = member.name.rstrip('/').split('/')
+        through_link = [index for index in range(1, len(parts))
+                        if '/'.join(parts[:index]) in links]
+        if (not is_inside(base_path, member.name) or through_link or
+            member.islnk() and not is_inside(base_path, member.linkname)):
+            raise tarfile.TarError("%s is outside of %s" % (member.name,
+                                                             base_path))
+
+
+def cache_key(base_path, directory, key_files, values=None):
+    """
+    A hash of a cache directory's name, of the content of its key files and
+    of the build's axis values.
+    """
+    key = hashlib.sha1(directory)
+    for name, value in sorted((values or {}).items()):
+        key.update('\0%s=%s' % (name, value))
+    for name in key_files:
+        key.update('\0%s:' % name)
+        path = os.path.join(base_path, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                key.update(hashlib.sha1(f.read()).hexdigest())
+    return key.hexdigest()
+
+
+class CacheStore(object):
+    """
+    Compressed archives of directories, stored by key. When the archives
+    exceed ``max_size`` bytes, the least recently used ones are evicted.
+    """
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+
+    def path(self, key):
+        return os.path.join(self.root, '%s.tar.gz' % key)
+
+    def restore(self, key, base_path, directory):
+        """
+        Extracts <directory> into <base_path>. Returns False on cache misses.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return False
+        os.utime(path, None)  # LRU
+        with tarfile.open(path, 'r:gz') as archive:
+            check_members(archive.getmembers(), base_path)
+            archive.extractall(base_path)
+        return True
+
+    def save(self, key, base_path, directory):
+        """
+        Stores <base_path>/<directory> under <key>, unless it's stored
+        already. Returns True if the directory has been stored.
+        """
+        path = self.path(key)
+        source = os.path.join(base_path, directory)
+        if os.path.exists(path) or not os.path.isdir(source):
+            return False
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        # Concurrent jobs may save the same key: write to a temporary file
+        # and rename it, which is atomic.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with tarfile.open(fileobj=f, mode='w:gz') as archive:
+                    archive.add(source, arcname=directory)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+        self.evict()
+        return True
+
+    def archives(self):
+        """
+        (last access, size, path) of all the stored archives, least recently
+        used first.
+        """
+        archives = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.tar.gz'):
+                    path = os.path.join(dirpath, name)
+                    stat = os.stat(path)
+                    archives.append((stat.st_mtime, stat.st_size, path))
+        return sorted(archives)
+
+    def evict(self):
+        archives = self.archives()
+        total = sum([size for mtime, size, path in archives])
+        for mtime, size, path in archives:
+            if total <= self.max_size:
+                break
+            logger.info("Evicting cache archive %s" % path)
+            os.remove(path)
+            total -= size
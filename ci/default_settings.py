@@ -109,6 +109,16 @@ LOGGING = {
     },
 }
 
+# Locks and build requests are shared between the web and worker processes:
+# the cache backend must be shared as well. Create the table with
+# "django-admin.py createcachetable ci_cache" or use memcached.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'ci_cache',
+    },
+}
+
 # Redis for celery
 BROKER_TRANSPORT = "redis"
 BROKER_HOST = "localhost"
@@ -118,8 +128,87 @@ BROKER_VHOST = "2"
 # Not consuming task results
 CELERY_IGNORE_RESULT = True
 
+# Build data is deleted by a dedicated worker, see the Procfile
+CELERY_ROUTES = {
+    'ci.projects.tasks.empty_trash': {'queue': 'cleanup'},
+    'ci.projects.tasks.empty_trash_periodically': {'queue': 'cleanup'},
+}
+
 import djcelery
 djcelery.setup_loader()
 
 # CI-specific settings
 WORKSPACE = os.path.join(HERE, 'workspace')
+
+# Delay (in seconds) before processing a build request. Requests received in
+# the meantime are merged into a single fetch-and-build cycle.
+BUILD_TRIGGER_DELAY = 10
+
+# A fetch-and-build cycle lock expires after this many seconds, in case the
+# worker holding it crashed.
+BUILD_LOCK_TIMEOUT = 60 * 60
+
+# Projects are polled for new commits every POLL_INTERVAL_MIN to
+# POLL_INTERVAL_MAX seconds, depending on how often they change.
+POLL_INTERVAL_MIN = 60
+POLL_INTERVAL_MAX = 60 * 60
+
+# Number of repositories checked concurrently when polling.
+POLL_CONCURRENCY = 8
+
+# Local clones are repacked (git) or verified (hg) every MAINTENANCE_INTERVAL
+# days, during MAINTENANCE_HOURS (local time). At most MAINTENANCE_CONCURRENCY
+# clones are maintained at the same time, the others wait for a slot and try
+# again every MAINTENANCE_RETRY_DELAY seconds.
+MAINTENANCE_INTERVAL = 7
+MAINTENANCE_HOURS = range(2, 6)
+MAINTENANCE_CONCURRENCY = 2
+MAINTENANCE_RETRY_DELAY = 60
+
+# Max. size (in bytes) of the cache directories stored between builds. The
+# least recently used ones are evicted first.
+DEPENDENCY_CACHE_SIZE = 5 * 1024 ** 3
+
+# A job's lease on a warm workspace expires after this many seconds, in case
+# the worker running it crashed.
+WORKSPACE_LEASE_TIMEOUT = 6 * 60 * 60
+
+# Max. number of files deleted per second when emptying the trash.
+TRASH_DELETE_RATE = 2000
+
+# Disk budget (in bytes) of the workspace. Above that, old build data, caches
+# and warm workspaces are deleted.
+WORKSPACE_SIZE_LIMIT = 50 * 1024 ** 3
+
+# Monitoring counters are kept in this Redis database and exposed at /metrics
+# for Prometheus. Set to None to keep them in process (single-process setups
+# only).
+METRICS_REDIS = {'host': BROKER_HOST, 'port': BROKER_PORT, 'db': 3}
+
+# Builds are traced from the trigger to the end of their jobs. Spans are kept
+# TRACING_RETENTION days, and also appended to TRACING_OTLP_FILE (OTLP/JSON,
+# one batch per line) if set.
+TRACING = True
+TRACING_RETENTION = 7
+TRACING_OTLP_FILE = None
+
+# The outputs of finished jobs are stored compressed in this directory,
+# outside of the database.
+LOGS_ROOT = os.path.join(HERE, 'logs')
+
+# Number of revisions built in parallel by each round of a bisection. Set it
+# to the number of idle workers.
+BISECTION_WIDTH = 4
+
+# Remote build agents authenticate with this token (X-CI-Token header). The
+# agent API is disabled when it's None. A job goes back to the queue if its
+# agent hasn't sent anything for AGENT_LEASE_TIMEOUT seconds. Agents asking
+# for a job wait for one at most AGENT_POLL_TIMEOUT seconds.
+AGENT_TOKEN = None
+AGENT_LEASE_TIMEOUT = 60
+AGENT_POLL_TIMEOUT = 30
+
+# Labels of the workers and agents of this machine (e.g. ['pypy', 'py25']).
+# Jobs whose axis values need labels go to a dedicated queue, see
+# "django-admin.py worker_queues".
+WORKER_LABELS = []
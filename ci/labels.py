@@ -0,0 +1,77 @@
+import itertools
+import re
+
+LABEL_RE = re.compile(r'^[\w-]+$')
+
+# Prefix of the queues of the jobs needing labelled workers. Other jobs go
+# to Celery's default queue.
+QUEUE_PREFIX = 'ci.'
+
+
+def parse_labels(text):
+    """
+    Worker labels separated by spaces or commas, sorted and without
+    duplicates.
+    """
+    return sorted(set(text.replace(',', ' ').split()))
+
+
+def parse_value_labels(text):
+    """
+    Parses the labels required by configuration values::
+
+        <value>: <label> <label>; <value>: <label>
+
+    Returns a dict of value to labels. Raises ValueError for lines without a
+    value or with invalid labels.
+    """
+    labels = {}
+    for item in text.split(';'):
+        if not item.strip():
+            continue
+        value, sep, names = item.partition(':')
+        value = value.strip()
+        names = parse_labels(names)
+        if not sep or not value:
+            raise ValueError("No value in %r" % item.strip())
+        for name in names:
+            if not LABEL_RE.match(name):
+                raise ValueError("Invalid label %r" % name)
+        labels[value] = names
+    return labels
+
+
+def queue_name(labels):
+    """
+    The queue of the jobs needing workers with <labels>, None for the
+    default queue.
+    """
+    if not labels:
+        return None
+    return QUEUE_PREFIX + '.'.join(sorted(labels))
+
+
+def worker_queues(labels, default='celery'):
+    """
+    The queues a worker with <labels> consumes: one per combination of its
+    labels, since a job can need any of them.
+    """
+    labels = sorted(set(labels))
+    queues = [default]
+    for count in range(1, len(labels) + 1):
+        queues.extend([queue_name(combination) for combination in
+                       itertools.combinations(labels, count)])
+    return queues
+
+
+def label_combinations(labels):
+    """
+    The labels of the jobs a worker with <labels> can run, as stored in
+    ``Job.labels``: no label or any combination of its labels.
+    """
+    labels = sorted(set(labels))
+    combinations = ['']
+    for count in range(1, len(labels) + 1):
+        combinations.extend([' '.join(combination) for combination in
+                             itertools.combinations(labels, count)])
+    return combinations
@@ -0,0 +1,117 @@
+import errno
+import fcntl
+import os
+import time
+
+from django.core.cache import cache
+
+
+class Lock(object):
+    """
+    A lock shared by the web and worker processes.
+
+    ``cache.add()`` only sets a key if it doesn't exist yet, which makes it
+    usable as a test-and-set as long as the cache backend is shared between
+    processes (see ``CACHES`` in the settings). Locks expire after
+    ``expire`` seconds so that a crashed worker can't hold them forever.
+    """
+    def __init__(self, name, expire=60 * 60):
+        self.name = 'ci:lock:%s' % name
+        self.expire = expire
+
+    def acquire(self, blocking=False, timeout=None):
+        """
+        Returns True if the lock has been acquired. With ``blocking``, waits
+        until it's released or ``timeout`` seconds have elapsed.
+        """
+        start = time.time()
+        while not cache.add(self.name, True, self.expire):
+            if not blocking:
+                return False
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(0.5)
+        return True
+
+    def release(self):
+        cache.delete(self.name)
+
+    @property
+    def locked(self):
+        return cache.get(self.name) is not None
+
+    def __enter__(self):
+        self.acquire(blocking=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class FileLock(object):
+    """
+    A lock shared by the processes of one machine, for the remote agents
+    which have no access to the server's cache.
+
+    It's an ``flock()`` on the file at ``path``, which the system releases
+    when the process holding it dies.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self, blocking=False, timeout=None):
+        """
+        Returns True if the lock has been acquired. With ``blocking``, waits
+        until it's released or ``timeout`` seconds have elapsed.
+        """
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # Created by another process
+                pass
+        start = time.time()
+        lock_file = open(self.path, 'a')
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    lock_file.close()
+                    raise
+            if not blocking or (timeout is not None and
+                                time.time() - start > timeout):
+                lock_file.close()
+                return False
+            time.sleep(0.5)
+        self.file = lock_file
+        return True
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    @property
+    def locked(self):
+        if self.file is not None:
+            return True
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return False
+
+    def __enter__(self):
+        self.acquire(blocking=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,164 @@
+import mmap
+import os
+import struct
+import zlib
+
+# Uncompressed size of the blocks, rounded up to the end of a line
+BLOCK_SIZE = 256 * 1024
+
+# Compressed and uncompressed sizes of a block, before its data
+HEADER = struct.Struct('>II')
+
+# Line index, next to the log: offset of the data, compressed size,
+# uncompressed size and number of the first line of each block. The last
+# entry only holds the number of lines.
+INDEX_ENTRY = struct.Struct('>QIII')
+
+
+def split(text, block_size=BLOCK_SIZE):
+    """
+    Splits <text> in blocks of whole lines of at least <block_size>
+    characters, except the last one.
+    """
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start + block_size - 1)
+        end = len(text) if end == -1 else end + 1
+        yield text[start:end]
+        start = end
+
+
+def count_lines(text):
+    return text.count('\n') + (1 if text and text[-1] != '\n' else 0)
+
+
+def split_lines(text):
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def index_path(path):
+    return '%s.idx' % path
+
+
+def write(path, text, block_size=BLOCK_SIZE):
+    """
+    Stores <text> at <path> as a sequence of zlib-compressed blocks, each one
+    decompressible on its own, and its line index. Returns the size of the
+    log.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    partial = '%s.tmp' % path
+    entries = []
+    line = 0
+    with open(partial, 'wb') as f:
+        for block in split(text, block_size):
+            if isinstance(block, unicode):
+                block = block.encode('utf-8')
+            data = zlib.compress(block, 6)
+            f.write(HEADER.pack(len(data), len(block)))
+            entries.append((f.tell(), len(data), len(block), line))
+            f.write(data)
+            line += count_lines(block)
+        size = f.tell()
+    write_index(path, entries, line)
+    os.rename(partial, path)  # Readers never see a partial log
+    return size
+
+
+def write_index(path, entries, lines):
+    partial = '%s.tmp' % index_path(path)
+    with open(partial, 'wb') as f:
+        for entry in entries:
+            f.write(INDEX_ENTRY.pack(*entry))
+        f.write(INDEX_ENTRY.pack(0, 0, 0, lines))
+    os.rename(partial, index_path(path))
+
+
+def read_index(path):
+    """
+    The (offset, compressed size, uncompressed size, first line) of the
+    blocks of a log and its number of lines. Logs written without an index
+    are indexed on the first read.
+    """
+    if not os.path.exists(index_path(path)):
+        entries = []
+        line = 0
+        with open(path, 'rb') as f:
+            for offset, compressed, size in blocks(f):
+                f.seek(offset)
+                entries.append((offset, compressed, size, line))
+                line += count_lines(zlib.decompress(f.read(compressed)))
+        write_index(path, entries, line)
+        return entries, line
+    with open(index_path(path), 'rb') as f:
+        data = f.read()
+    entries = [INDEX_ENTRY.unpack_from(data, offset)
+               for offset in range(0, len(data), INDEX_ENTRY.size)]
+    return entries[:-1], entries[-1][3]
+
+
+def read_lines(path, start, count):
+    """
+    Lines <start> to <start + count> (0-based) of a log, and its number of
+    lines. Only the blocks holding these lines are decompressed, from a
+    memory map of the log.
+    """
+    entries, total = read_index(path)
+    entries = [entry for index, entry in enumerate(entries)
+               if entry[3] < start + count and (
+                   index + 1 == len(entries) or
+                   entries[index + 1][3] > start)]
+    if not entries:
+        return [], total
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            text = ''.join([
+                zlib.decompress(data[offset:offset + compressed])
+                for offset, compressed, size, line in entries
+            ]).decode('utf-8')
+        finally:
+            data.close()
+    skip = start - entries[0][3]
+    return split_lines(text)[skip:skip + count], total
+
+
+def blocks(f):
+    """
+    (offset, compressed size, uncompressed size) of the blocks of an open
+    log. Only the headers are read.
+    """
+    offset = 0
+    while True:
+        f.seek(offset)
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        compressed, size = HEADER.unpack(header)
+        yield offset + HEADER.size, compressed, size
+        offset += HEADER.size + compressed
+
+
+def read(path, tail=None):
+    """
+    Yields the text of a log written by write(), one block at a time. With
+    <tail>, only the last blocks holding at least <tail> bytes are
+    decompressed.
+    """
+    with open(path, 'rb') as f:
+        headers = list(blocks(f))
+        if tail is not None:
+            size = 0
+            for index in range(len(headers) - 1, -1, -1):
+                size += headers[index][2]
+                if size >= tail:
+                    break
+            headers = headers[index:] if headers else []
+        for offset, compressed, size in headers:
+            f.seek(offset)
+            yield zlib.decompress(f.read(compressed)).decode('utf-8')
@@ -0,0 +1,160 @@
+import logging
+import re
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger('ci')
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+METRICS = (
+    ('ci_jobs_pending', GAUGE, 'Jobs waiting for a worker.'),
+    ('ci_jobs_pending_by_label', GAUGE,
+     'Jobs waiting for a worker with a label.'),
+    ('ci_jobs_running', GAUGE, 'Jobs being executed.'),
+    ('ci_jobs_finished_total', COUNTER, 'Jobs finished.'),
+    ('ci_builds_total', COUNTER, 'Builds created.'),
+    ('ci_job_queue_wait_seconds', HISTOGRAM,
+     'Time spent by jobs waiting for a worker.'),
+    ('ci_job_duration_seconds', HISTOGRAM, 'Duration of the jobs.'),
+    ('ci_job_output_bytes_total', COUNTER, 'Bytes of build output.'),
+    ('ci_vcs_fetch_seconds', HISTOGRAM,
+     'Duration of the updates of the local clones.'),
+)
+
+KEY = 'ci:metrics'
+
+
+class Store(object):
+    """
+    In-process storage.
+    """
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def incr(self, increments):
+        with self.lock:
+            for key, amount in increments:
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def all(self):
+        with self.lock:
+            return dict(self.values)
+
+
+class RedisStore(object):
+    def __init__(self, host='localhost', port=6379, db=0):
+        import redis
+        self.redis = redis.Redis(host=host, port=port, db=db)
+
+    def incr(self, increments):
+        pipe = self.redis.pipeline(transaction=False)
+        for key, amount in increments:
+            pipe.hincrby(KEY, key, amount)
+        pipe.execute()
+
+    def all(self):
+        return dict([(key, int(value)) for key, value in
+                     self.redis.hgetall(KEY).items()])
+
+
+_store = None
+
+
+def get_store():
+    """
+    Metrics are kept in Redis so that the web and worker processes share
+    them, or in process if METRICS_REDIS is None. Durations are stored in
+    milliseconds: Redis only increments integers atomically.
+    """
+    global _store
+    if _store is None:
+        if settings.METRICS_REDIS is None:
+            _store = Store()
+        else:
+            _store = RedisStore(**settings.METRICS_REDIS)
+    return _store
+
+
+def series(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join([
+        '%s="%s"' % (key, unicode(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items())
+    ]))
+
+
+def _update(increments):
+    try:
+        get_store().incr(increments)
+    except Exception:
+        # Monitoring must never break builds
+        logger.exception("Unable to update metrics")
+
+
+def incr(name, labels=None, amount=1):
+    _update([(series(name, labels), amount)])
+
+
+def decr(name, labels=None, amount=1):
+    _update([(series(name, labels), -amount)])
+
+
+def observe(name, seconds, labels=None):
+    """
+    Adds a duration to a histogram.
+    """
+    labels = dict(labels or {})
+    increments = [
+        (series(name + '_count', labels), 1),
+        (series(name + '_sum_ms', labels), int(seconds * 1000)),
+    ]
+    for bound in BUCKETS:
+        if seconds <= bound:
+            labels['le'] = bound
+            increments.append((series(name + '_bucket', labels), 1))
+    labels['le'] = '+Inf'
+    increments.append((series(name + '_bucket', labels), 1))
+    _update(increments)
+
+
+def render(gauges=()):
+    """
+    All the metrics, in Prometheus' text exposition format. <gauges> are
+    the (name, labels, value) of the gauges computed when rendering, they
+    replace the stored ones.
+    """
+    names = set([name for name, labels, value in gauges])
+    values = dict([(key, value) for key, value in get_store().all().items()
+                   if key.split('{', 1)[0] not in names])
+    values.update([(series(name, labels), value)
+                   for name, labels, value in gauges])
+
+    def sort_key(key):
+        # Histogram buckets are sorted by bound
+        bound = re.search(r'le="([^"]+)"', key)
+        if bound is None:
+            return (key, 0)
+        return (re.sub(r',?le="[^"]+"', '', key), float(bound.group(1)))
+
+    lines = []
+    for name, kind, help_text in METRICS:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for key in sorted(values, key=sort_key):
+            metric = key.split('{', 1)[0]
+            if kind == HISTOGRAM and metric == name + '_sum_ms':
+                lines.append('%s_sum%s %.3f' % (name, key[len(metric):],
+                                                values[key] / 1000.))
+            elif metric == name or (kind == HISTOGRAM and metric in (
+                name + '_bucket', name + '_count')):
+                lines.append('%s %s' % (key, values[key]))
+    return '\n'.join(lines) + '\n'
@@ -1,3 +1,8 @@
+import anyjson as json
+import hashlib
+import re
+import time
+
 from xml.etree import ElementTree
 
 
@@ -30,3 +35,198 @@ class XunitParser(object):
             })
             if 'name' in attrs:
                 self.testcases.append(attrs)
+
+
+def parse_push(data):
+    """
+    Extracts the pushed branches from a push hook's data.
+
+    Understands GitHub and Bitbucket payloads, as well as a generic form
+    with a ``ref`` and an optional ``sha``. Returns a list of
+    ``(branch, revision)`` tuples -- revision may be None -- or None if the
+    payload doesn't say which branches have been pushed.
+    """
+    if 'ref' in data:
+        # GitHub, or generic form
+        ref = data['ref']
+        if ref.startswith('refs/tags/'):
+            return []
+        if ref.startswith('refs/heads/'):
+            ref = ref[11:]
+        revision = data.get('after', data.get('sha')) or None
+        if data.get('deleted') or revision == '0' * 40:
+            return []
+        return [(ref, revision)]
+
+    if data.get('commits'):
+        # Bitbucket: commits are listed from the oldest to the most recent
+        heads = {}
+        for commit in data['commits']:
+            if commit.get('branch'):
+                heads[commit['branch']] = commit.get('raw_node',
+                                                     commit.get('node'))
+        if heads:
+            return sorted(heads.items())
+    return None
+
+
+def parse_benchmarks(content):
+    """
+    (name, value) of the results of a JSON benchmark report, lower values
+    being better. Understands pytest-benchmark reports (mean times, in
+    seconds) and generic ones: ``{"name": value}`` or
+    ``[{"name": name, "value": value}]``. Raises ValueError on anything else.
+    """
+    data = json.loads(content)
+    try:
+        if isinstance(data, dict) and 'benchmarks' in data:
+            results = [(result.get('fullname', result['name']),
+                        result['stats']['mean'])
+                       for result in data['benchmarks']]
+        elif isinstance(data, dict):
+            results = data.items()
+        else:
+            results = [(result['name'], result['value']) for result in data]
+        return [(unicode(name), float(value)) for name, value in results]
+    except (KeyError, TypeError):
+        raise ValueError("Invalid benchmark report")
+
+
+# Parts of error messages that change from a run to another
+FAILURE_NOISE = (
+    (re.compile(r'0x[0-9a-fA-F]+'), '0x?'),
+    (re.compile(r'(/tmp|/var/tmp|/private/var/folders)/\S*'), '<tmp>'),
+    (re.compile(r'\bline \d+'), 'line ?'),
+    (re.compile(r':\d+(:\d+)?\b'), ':?'),
+    (re.compile(r'\b[0-9a-f]{12,40}\b'), '<hash>'),
+    (re.compile(r'\b\d+(\.\d+)?(s|ms)\b'), '?s'),
+    (re.compile(r'[ \t]+'), ' '),
+)
+
+TRACEBACK = 'Traceback (most recent call last):'
+ERROR_RE = re.compile(r'\b(error|fatal|exception|failed|failure)\b', re.I)
+
+
+def normalize_failure(text, paths=()):
+    """
+    Strips <paths> (e.g. the build directory), line numbers, addresses,
+    temporary paths and durations from an error message.
+    """
+    for path in paths:
+        text = text.replace(path, '<build>')
+    for regex, replacement in FAILURE_NOISE:
+        text = regex.sub(replacement, text)
+    return '\n'.join([line.strip() for line in text.strip().splitlines()])
+
+
+def failure_hash(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def output_failure(output, tail=200):
+    """
+    The last traceback in the last <tail> lines of a build output, or the
+    last line that looks like an error. Lines written by the CI and shell
+    traces are ignored. Returns None if nothing looks like an error.
+    """
+    lines = [line for line in output.splitlines()[-tail:]
+             if not line.startswith(('[CI] ', 'Error while running "', '+'))]
+    for index in range(len(lines) - 1, -1, -1):
+        if lines[index].strip() == TRACEBACK:
+            block = [lines[index]]
+            for line in lines[index + 1:]:
+                block.append(line)
+                if not line.startswith((' ', '\t')):
+                    break  # The exception
+            return '\n'.join(block)
+    for line in reversed(lines):
+        if ERROR_RE.search(line):
+            return line
+    return None
+
+
+def first_error_line(output):
+    """
+    The number (0-based) of the first line of a build output that starts a
+    traceback or looks like an error, or None.
+    """
+    for number, line in enumerate(output.split('\n')):
+        if line.startswith(('[CI] ', 'Error while running "', '+')):
+            continue
+        if line.strip() == TRACEBACK or ERROR_RE.search(line):
+            return number
+    return None
+
+
+def log_sections(lines, start):
+    """
+    Groups consecutive lines of an output, the first one being line <start>
+    (0-based), in sections starting at the lines written by the CI. Returns
+    dicts with the section's title, or None for lines before the first
+    title, and its (1-based line number, line) tuples.
+    """
+    sections = [{'title': None, 'lines': []}]
+    for number, line in enumerate(lines, start + 1):
+        if line.startswith('[CI] '):
+            sections.append({'title': (number, line), 'lines': []})
+        else:
+            sections[-1]['lines'].append((number, line))
+    if sections[0]['lines'] or len(sections) == 1:
+        return sections
+    return sections[1:]
+
+
+class TraceProfiler(object):
+    """
+    Times the steps of a script run with ``set -x`` and ``PS4='+${LINENO}: '``
+    from the time at which its trace lines are received.
+
+    Top-level commands of lines <first_line> to <last_line> are the steps,
+    commands run from the rest of the script are ignored. Durations of lines
+    run several times (loops) are added up.
+    """
+    trace_re = re.compile(r'^\+(\d+): ')
+
+    def __init__(self, first_line, last_line):
+        self.first_line = first_line
+        self.last_line = last_line
+        self.durations = {}
+        self.counts = {}
+        self.current = None
+        self.started = None
+
+    def feed(self, output, now=None):
+        if now is None:
+            now = time.time()
+        for line in output.splitlines():
+            match = self.trace_re.match(line)
+            if match is None:
+                continue
+            number = int(match.group(1))
+            if number < self.first_line or number == self.current:
+                continue
+            self.finish(now)
+            if number <= self.last_line:
+                self.current = number
+                self.started = now
+                self.counts[number] = self.counts.get(number, 0) + 1
+
+    def finish(self, now=None):
+        if self.current is None:
+            return
+        if now is None:
+            now = time.time()
+        self.durations[self.current] = (self.durations.get(self.current, 0) +
+                                        now - self.started)
+        self.current = None
+
+    @property
+    def steps(self):
+        """
+        (line, runs, duration) tuples, lines being numbered from first_line.
+        """
+        return [(number - self.first_line + 1, self.counts[number],
+                 self.durations.get(number, 0))
+                for number in sorted(self.counts)]
@@ -0,0 +1,60 @@
+import os
+import shutil
+
+
+def parse_paths(text):
+    """
+    Paths relative to the build directory, one per line.
+    """
+    paths = []
+    for line in text.splitlines():
+        line = line.strip().strip('/')
+        if line and not line.startswith('#'):
+            if line.startswith('..') or '/../' in line:
+                raise ValueError("%s is outside of the build directory" %
+                                 line)
+            paths.append(line)
+    return paths
+
+
+def sort_stages(needs):
+    """
+    Orders the stages of a pipeline so that each one comes after the stages
+    it needs. <needs> maps each stage name to a list of stage names. Raises
+    ValueError for unknown stages and cycles.
+    """
+    for name, required in needs.items():
+        unknown = [stage for stage in required if stage not in needs]
+        if unknown:
+            raise ValueError("%s needs unknown stages: %s" % (
+                name, ', '.join(unknown)))
+    ordered = []
+    remaining = sorted(needs)
+    while remaining:
+        ready = [name for name in remaining
+                 if not [stage for stage in needs[name]
+                         if stage not in ordered]]
+        if not ready:
+            raise ValueError("Stages needing each other: %s" %
+                             ', '.join(remaining))
+        ordered.extend(ready)
+        remaining = [name for name in remaining if name not in ready]
+    return ordered
+
+
+def copy_path(source, destination):
+    """
+    Copies a file or a directory, merging directories with the existing
+    ones.
+    """
+    if os.path.isdir(source):
+        if not os.path.isdir(destination):
+            os.makedirs(destination)
+        for name in os.listdir(source):
+            copy_path(os.path.join(source, name),
+                      os.path.join(destination, name))
+    else:
+        directory = os.path.dirname(destination)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        shutil.copy2(source, destination)
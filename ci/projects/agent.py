@@ -0,0 +1,194 @@
+import anyjson as json
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import urllib2
+
+from django.conf import settings
+
+from ..locks import FileLock
+from .models import Project, Build, Job
+
+logger = logging.getLogger('ci')
+
+
+class LeaseLost(Exception):
+    """
+    Raised while running a job given to another agent, to stop it.
+    """
+
+
+class AgentJob(Job):
+    """
+    A job run by a remote agent. It's built from the job description sent
+    by the server and never touches the database: saving it sends the new
+    output to the server.
+    """
+    class Meta:
+        proxy = True
+
+    @classmethod
+    def from_spec(cls, spec, client):
+        project = Project(**spec['project'])
+        build = Build(project=project, **spec['build'])
+        job = cls(id=spec['id'], build=build, stage=spec['stage'],
+                  values=spec['values'])
+        job.client = client
+        job.sent = 0
+        job.lost = False
+        job.lock = threading.Lock()
+        job.workspace_leases = {}
+        return job
+
+    @property
+    def workspace_lease(self):
+        """
+        A lock on this machine: the server's cache isn't shared with the
+        agents, and the warm workspaces are local to each of them.
+        """
+        lease = self.workspace_leases.get(self.workspace)
+        if lease is None:
+            name = hashlib.sha1(self.workspace).hexdigest()
+            lease = FileLock(os.path.join(settings.WORKSPACE, 'locks',
+                                          name + '.lock'))
+            self.workspace_leases[self.workspace] = lease
+        return lease
+
+    def save(self, *args, **kwargs):
+        self.send_output()
+        self.check_lease()
+
+    def stream_to(self, output):
+        super(AgentJob, self).stream_to(output)
+        self.check_lease()
+
+    def check_lease(self):
+        """
+        Stops the job once the heartbeat or a save found the lease lost.
+        """
+        if self.lost:
+            raise LeaseLost("Lost the lease on job %s" % self.pk)
+
+    def send_output(self):
+        """
+        Sends the output added since the last call, and extends the lease.
+        """
+        with self.lock:
+            output = self.output[self.sent:]
+            try:
+                status, data = self.client.request(
+                    'agents/jobs/%s/output/' % self.pk, {'output': output})
+            except (EnvironmentError, ValueError) as e:
+                # Sent with the next chunk, the lease is long enough
+                logger.info("Unable to send the output: %s" % e)
+                return
+            if status == 409:
+                logger.info("Lost the lease on job %s" % self.pk)
+                self.lost = True
+            elif status == 200:
+                self.sent += len(output)
+
+    def delete_build_data(self):
+        shutil.rmtree(self.build_path, ignore_errors=True)
+
+    def result(self, timings):
+        return {
+            'status': self.status,
+            'timings': timings,
+            'output': self.output,
+            'profile': self.profile,
+            'xunit_xml_report': self.xunit_xml_report,
+            'benchmarks': getattr(self, 'benchmark_results', []),
+            'cpu_user': self.cpu_user,
+            'cpu_system': self.cpu_system,
+            'max_rss': self.max_rss,
+            'io_read': self.io_read,
+            'io_write': self.io_write,
+        }
+
+
+class Agent(object):
+    """
+    Runs the jobs of the projects built on remote agents: leases them from
+    the server at <url>, streams their output and sends their results.
+    """
+    def __init__(self, url, token, name=None, wait=None, labels=None):
+        self.url = url.rstrip('/') + '/'
+        self.token = token
+        self.name = name or socket.gethostname()
+        self.labels = settings.WORKER_LABELS if labels is None else labels
+        self.wait = settings.AGENT_POLL_TIMEOUT if wait is None else wait
+
+    def request(self, path, data):
+        """
+        POSTs <data> to the API, returns the response status and data.
+        """
+        data = dict(data, agent=self.name)
+        request = urllib2.Request(self.url + path, json.dumps(data), {
+            'Content-Type': 'application/json',
+            'X-CI-Token': self.token,
+        })
+        try:
+            response = urllib2.urlopen(request, timeout=self.wait + 30)
+        except urllib2.HTTPError as e:
+            return e.code, None
+        content = response.read()
+        return response.getcode(), json.loads(content) if content else None
+
+    def lease(self):
+        """
+        The description of the next job to run, or None.
+        """
+        status, spec = self.request('agents/lease/', {
+            'wait': self.wait, 'labels': ' '.join(self.labels)})
+        return spec if status == 200 else None
+
+    def run_job(self, spec):
+        job = AgentJob.from_spec(spec, self)
+        logger.info("Starting job %s" % job.pk)
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(spec['lease_timeout'] / 3.):
+                job.send_output()
+
+        thread = threading.Thread(target=heartbeat)
+        thread.daemon = True
+        thread.start()
+        timings = dict([(phase, 0) for phase, name in Job.PHASES])
+        try:
+            job.run_steps(timings)
+        except LeaseLost as e:
+            # Another agent runs it now
+            logger.info("Stopped job %s: %s" % (job.pk, e))
+            return job
+        finally:
+            stop.set()
+            thread.join()
+        status, data = self.request('agents/jobs/%s/finish/' % job.pk,
+                                    job.result(timings))
+        if status != 200:
+            logger.info("Unable to send the results of job %s: %s" % (
+                job.pk, status))
+        return job
+
+    def run(self, once=False):
+        """
+        Runs jobs until interrupted, or until there is no job to run with
+        <once>.
+        """
+        while True:
+            try:
+                spec = self.lease()
+            except (EnvironmentError, ValueError) as e:
+                logger.info("Unable to lease a job: %s" % e)
+                time.sleep(self.wait or 1)
+                continue
+            if spec is not None:
+                self.run_job(spec)
+            elif once:
+                return
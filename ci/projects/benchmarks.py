@@ -0,0 +1,267 @@
+import anyjson as json
+import datetime
+import os
+import sys
+import time
+
+from django.core.urlresolvers import reverse
+from django.db import connection, reset_queries
+from django.test.client import Client
+
+from .. import vcs
+from ..parsers import XunitParser
+from ..shell import Command
+from .models import Project, Build, Job
+from .stats import percentile
+
+# Sizes of the synthetic data, multiplied by the scale of the run.
+SIZES = {
+    'commits': 500,
+    'branches': 20,
+    'branch_commits': 10,
+    'changelog': 100,
+    'testcases': 5000,
+    'axis_values': 5,
+    'output_lines': 20000,
+    'projects': 50,
+}
+
+
+def scaled(scale):
+    return dict([(key, max(1, int(round(value * scale))))
+                 for key, value in SIZES.items()])
+
+
+def make_git_repo(path, commits, branches=0, branch_commits=1):
+    """
+    Creates a bare git repository with <commits> commits on master and
+    <branches> branches of <branch_commits> commits forked from its middle.
+    """
+    Command('git init -q --bare %s' % path)
+    stream = []
+    timestamp = 1300000000
+
+    def commit(ref, mark, parent, content):
+        stream.extend([
+            'commit %s' % ref,
+            'mark :%s' % mark,
+            'committer Bench <bench@example.com> %s +0000' % (
+                timestamp + mark),
+            'data <<EOF',
+            'Commit %s' % mark,
+            'EOF',
+        ])
+        if parent is not None:
+            stream.append('from :%s' % parent)
+        stream.extend(['M 644 inline file%s.txt' % (mark % 10),
+                       'data <<EOF', content, 'EOF', ''])
+
+    for mark in range(1, commits + 1):
+        commit('refs/heads/master', mark, mark - 1 or None, str(mark))
+    mark = commits
+    for branch in range(branches):
+        parent = commits // 2 or 1
+        for index in range(branch_commits):
+            mark += 1
+            commit('refs/heads/branch%s' % branch, mark, parent,
+                   'branch %s, %s' % (branch, index))
+            parent = mark
+    Command('git fast-import --quiet', stdin='\n'.join(stream) + '\n',
+            cwd=path)
+    Command('git symbolic-ref HEAD refs/heads/master', cwd=path)
+
+
+def make_hg_repo(path, commits, branches=0, branch_commits=1):
+    """
+    Same as make_git_repo, for mercurial.
+    """
+    dag = ['+%s' % commits, ':base']
+    for branch in range(branches):
+        dag.extend(['<base', '@branch%s' % branch, '+%s' % branch_commits])
+    Command('hg init %s' % path)
+    Command("hg debugbuilddag --new-file '%s'" % ' '.join(dag), cwd=path)
+
+
+def make_xunit(testcases, failure_rate=10):
+    """
+    A report of <testcases> tests, 1 in <failure_rate> failing.
+    """
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<testsuite name="bench" tests="%s" errors="0" failures="%s" '
+             'skip="0">' % (testcases, testcases // failure_rate)]
+    for index in range(testcases):
+        case = ('<testcase classname="bench.tests.Test%s" name="test_%s" '
+                'time="0.01"' % (index // 100, index))
+        if index % failure_rate:
+            lines.append(case + '/>')
+        else:
+            lines.extend([case + '>',
+                          '<failure type="AssertionError" message="fail">',
+                          'Traceback (most recent call last):\n'
+                          '  File "tests.py", line %s, in test_%s\n'
+                          'AssertionError: %s != 0' % (index, index, index),
+                          '</failure>', '</testcase>'])
+    lines.append('</testsuite>')
+    return '\n'.join(lines)
+
+
+class Benchmark(object):
+    """
+    A hot path to measure. <setup> prepares each run and isn't timed.
+    """
+    def __init__(self, name, run, setup=None):
+        self.name = name
+        self.run = run
+        self.setup = setup
+
+    def measure(self, repeat):
+        durations = []
+        queries = []
+        for index in range(repeat):
+            if self.setup is not None:
+                self.setup()
+            reset_queries()
+            started = time.time()
+            self.run()
+            durations.append(time.time() - started)
+            queries.append(len(connection.queries))
+        return {
+            'seconds': percentile(durations, 50),
+            'min': min(durations),
+            'queries': max(queries),
+        }
+
+
+def benchmarks(root, sizes):
+    """
+    Creates the synthetic data in <root> and returns the benchmarks.
+    """
+    git_repo = os.path.join(root, 'git.git')
+    hg_repo = os.path.join(root, 'hg')
+    for make, path in [(make_git_repo, git_repo), (make_hg_repo, hg_repo)]:
+        make(path, sizes['commits'], sizes['branches'],
+             sizes['branch_commits'])
+
+    git = vcs.Git(git_repo, os.path.join(root, 'git-clone'))
+    git.update_source()
+    git_since = git.repo.get_refs()['refs/heads/master']
+    for index in range(sizes['changelog']):
+        git_since = git.repo[git_since].parents[0]
+    hg = vcs.Hg(hg_repo, os.path.join(root, 'hg-clone'))
+    hg.update_source()
+    hg_since = hg.latest_branch_revision('default') - sizes['changelog']
+
+    project = Project.objects.create(
+        name='bench', slug='bench', repo=git_repo,
+        build_instructions='true',
+    )
+    for key in ['python', 'django']:
+        project.configurations.create(key=key).values.create(value='1')
+    for index in range(sizes['projects']):
+        Project.objects.create(name='bench-%s' % index,
+                               slug='bench-%s' % index, repo=git_repo)
+
+    matrix = Project.objects.create(name='matrix', slug='matrix',
+                                    repo=git_repo)
+    for key in ['a', 'b', 'c']:
+        config = matrix.configurations.create(key=key)
+        for value in range(sizes['axis_values']):
+            config.values.create(value=str(value))
+
+    xunit = make_xunit(sizes['testcases'])
+    output = Command('python -c "%s"' % ';'.join([
+        'import sys',
+        'lines = [\'line %%s \' %% i + \'.\' * 80 for i in range(%s)]' % (
+            sizes['output_lines']),
+        "sys.stdout.write('\\n'.join(lines))",
+    ])).out
+    reports = Project.objects.create(name='reports', slug='reports',
+                                     repo=git_repo)
+    build = Build.objects.create(project=reports, revision='bench',
+                                 branch='master', matrix='{}', history='[]')
+    job = build.jobs.create(status=Job.FAILURE, output=output,
+                            xunit_xml_report=xunit,
+                            values=json.dumps({'python': '1'}))
+
+    def delete_builds(project):
+        def setup():
+            project.builds.all().delete()
+        return setup
+
+    def stream():
+        streamed = Job.objects.get(pk=job.pk)
+        streamed.output = ''
+        Command('cat output.txt', cwd=root, stream_to=streamed.stream_to)
+        streamed.save()
+
+    with open(os.path.join(root, 'output.txt'), 'wb') as f:
+        f.write(output)
+
+    client = Client()
+
+    def view(name, *args):
+        url = reverse(name, args=args)
+        return lambda: client.get(url)
+
+    return [
+        Benchmark('git_changelog',
+                  lambda: list(git.changelog('master', git_since))),
+        Benchmark('hg_changelog',
+                  lambda: list(hg.changelog('default', hg_since))),
+        Benchmark('project_build', project.build,
+                  setup=delete_builds(project)),
+        Benchmark('build_matrix', lambda: matrix.build_branch('master'),
+                  setup=delete_builds(matrix)),
+        Benchmark('xunit_parser', lambda: XunitParser(xunit)),
+        Benchmark('command_streaming', stream),
+        Benchmark('view_projects', view('projects')),
+        Benchmark('view_project', view('project', reports.slug)),
+        Benchmark('view_build', view('project_build', reports.slug,
+                                     build.pk)),
+        Benchmark('view_job', view('project_job', reports.slug, build.pk,
+                                   job.pk)),
+    ]
+
+
+def run(root, scale=1, repeat=3, only=None):
+    """
+    Runs the benchmarks with synthetic data stored in <root>. Queries are
+    only counted when settings.DEBUG is True.
+    """
+    sizes = scaled(scale)
+    results = {}
+    for benchmark in benchmarks(root, sizes):
+        if only and benchmark.name not in only:
+            continue
+        results[benchmark.name] = benchmark.measure(repeat)
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'scale': scale,
+        'sizes': sizes,
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=0.2, min_seconds=0.01):
+    """
+    Lists the regressions of <current> results over <baseline>: benchmarks
+    more than <threshold> slower (ignoring differences under <min_seconds>)
+    or running more SQL queries.
+    """
+    if baseline['sizes'] != current['sizes']:
+        return ['The baseline ran with different sizes: %s' % (
+            baseline['sizes'])]
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]
+        if (result['seconds'] > before['seconds'] * (1 + threshold) and
+            result['seconds'] - before['seconds'] > min_seconds):
+            regressions.append('%s: %.3fs instead of %.3fs' % (
+                name, result['seconds'], before['seconds']))
+        if result['queries'] > before['queries']:
+            regressions.append('%s: %s queries instead of %s' % (
+                name, result['queries'], before['queries']))
+    return regressions
@@ -1,4 +1,8 @@
+import datetime
+
+from django.conf import settings
 from django.forms.formsets import formset_factory, BaseFormSet
+from django.forms.models import modelformset_factory, BaseModelFormSet
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext_lazy as _
 
@@ -8,7 +12,10 @@ from dulwich.client import get_transport_and_path, SubprocessGitClient
 from mercurial import hg, ui
 from mercurial.error import RepoError
 
-from .models import Project
+from ..caches import parse_cache_directories
+from ..labels import parse_value_labels
+from ..pipelines import parse_paths, sort_stages
+from .models import Project, Build, Job, Stage
 
 
 class ProjectForm(forms.ModelForm):
@@ -63,21 +70,46 @@ class ProjectForm(forms.ModelForm):
 class ProjectBuildForm(forms.ModelForm):
     class Meta:
         model = Project
-        fields = ['build_instructions', 'sequential', 'keep_build_data',
-                  'xunit_xml_report', 'build_branches']
+        fields = ['upstream', 'build_instructions', 'sequential',
+                  'keep_build_data', 'warm_workspace', 'xunit_xml_report',
+                  'benchmark_report', 'build_branches', 'cache_directories',
+                  'remote_agents', 'poll']
         widgets = {
+            'upstream': forms.Select,
             'build_instructions': forms.Textarea,
             'sequential': forms.CheckboxInput,
             'keep_build_data': forms.CheckboxInput,
+            'warm_workspace': forms.CheckboxInput,
             'xunit_xml_report': forms.TextInput,
+            'benchmark_report': forms.TextInput,
             'build_branches': forms.Select,
+            'cache_directories': forms.Textarea,
+            'remote_agents': forms.CheckboxInput,
+            'poll': forms.CheckboxInput,
         }
 
+    def __init__(self, *args, **kwargs):
+        super(ProjectBuildForm, self).__init__(*args, **kwargs)
+        self.fields['upstream'].queryset = Project.objects.exclude(
+            pk=self.instance.pk)
+
+    def clean_cache_directories(self):
+        try:
+            parse_cache_directories(self.cleaned_data['cache_directories'])
+        except ValueError as e:
+            raise forms.ValidationError(unicode(e))
+        return self.cleaned_data['cache_directories']
+
 
 class ConfigurationForm(forms.Form):
     name = forms.CharField(label=_('Name'))
     values = forms.CharField(label=_('Values'),
                              help_text=_('Comma-separated list of values'))
+    labels = forms.CharField(
+        label=_('Worker labels'), required=False,
+        help_text=_('Labels of the workers able to run each value, e.g. '
+                    '"pypy: pypy; 2.5: py25 old-libc"'),
+    )
 
     def clean_values(self):
         values = self.cleaned_data['values']
@@ -85,6 +117,19 @@ class ConfigurationForm(forms.Form):
         # unique values -- not strictly necessary but avoids queries for later
         return list(set(values))
 
+    def clean(self):
+        data = super(ConfigurationForm, self).clean()
+        try:
+            data['labels'] = parse_value_labels(data.get('labels', ''))
+        except ValueError as e:
+            self._errors['labels'] = self.error_class([unicode(e)])
+            return data
+        unknown = set(data['labels']) - set(data.get('values', []))
+        if 'values' in data and unknown:
+            self._errors['labels'] = self.error_class([
+                _('Unknown values: %s') % ', '.join(sorted(unknown))])
+        return data
+
 
 class DeletionFormSet(BaseFormSet):
     def add_fields(self, form, index):
@@ -103,3 +148,118 @@ class DeletionFormSet(BaseFormSet):
 
 ConfigurationFormSet = formset_factory(ConfigurationForm, extra=1,
                                        formset=DeletionFormSet)
+
+
+class StageForm(forms.ModelForm):
+    class Meta:
+        model = Stage
+        fields = ['name', 'needs', 'build_instructions', 'matrix',
+                  'artifacts']
+        widgets = {
+            'name': forms.TextInput,
+            'needs': forms.TextInput,
+            'build_instructions': forms.Textarea,
+            'matrix': forms.CheckboxInput,
+            'artifacts': forms.Textarea,
+        }
+
+    def clean_artifacts(self):
+        try:
+            parse_paths(self.cleaned_data['artifacts'])
+        except ValueError as e:
+            raise forms.ValidationError(unicode(e))
+        return self.cleaned_data['artifacts']
+
+
+class BaseStageFormSet(BaseModelFormSet):
+    def clean(self):
+        """
+        Stages must have distinct names and form a DAG.
+        """
+        if any(self.errors):
+            return
+        needs = {}
+        for form in self.forms:
+            data = getattr(form, 'cleaned_data', None)
+            if not data or data.get('DELETE'):
+                continue
+            if data['name'] in needs:
+                raise forms.ValidationError(
+                    _('There are several "%s" stages.') % data['name'])
+            needs[data['name']] = data['needs'].split()
+        try:
+            sort_stages(needs)
+        except ValueError as e:
+            raise forms.ValidationError(unicode(e))
+
+
+StageFormSet = modelformset_factory(Stage, form=StageForm,
+                                    formset=BaseStageFormSet, extra=1,
+                                    can_delete=True)
+
+
+class BuildChoiceField(forms.ModelChoiceField):
+    def label_from_instance(self, build):
+        return u'#%s: %s (%s)' % (build.pk, build.short_rev,
+                                   build.build_status)
+
+
+class BisectForm(forms.Form):
+    good = BuildChoiceField(Build.objects.none(), label=_('Good build'),
+                            empty_label=None)
+    width = forms.IntegerField(label=_('Builds per round'), min_value=1,
+                               initial=settings.BISECTION_WIDTH)
+
+    def __init__(self, bad, *args, **kwargs):
+        super(BisectForm, self).__init__(*args, **kwargs)
+        self.bad = bad
+        self.fields['good'].queryset = bad.project.builds.filter(
+            branch=bad.branch, bisection__isnull=True, pk__lt=bad.pk,
+        ).order_by('-pk')
+
+    def clean(self):
+        good = self.cleaned_data.get('good')
+        if good is not None:
+            commits = self.bad.commits_since(good)
+            if not commits or unicode(commits[-1]['rev']) != self.bad.revision:
+                raise forms.ValidationError(
+                    _('The changelogs of the builds between these two are '
+                      'incomplete, they can\'t be bisected.'))
+        return self.cleaned_data
+
+
+class SearchForm(forms.Form):
+    q = forms.CharField(label=_('Search'))
+    project = forms.ModelChoiceField(Project.objects.all(), required=False,
+                                     to_field_name='slug',
+                                     empty_label=_('All projects'))
+    branch = forms.CharField(required=False)
+    value = forms.CharField(label=_('Axis value'), required=False,
+                            help_text=_('e.g. python=2.7'))
+    since = forms.DateField(required=False)
+    until = forms.DateField(required=False)
+
+    def clean_value(self):
+        value = self.cleaned_data['value']
+        if value and '=' not in value:
+            raise forms.ValidationError(_('Use the name=value format.'))
+        return value
+
+    def search(self, index):
+        """
+        The matching jobs as (job, snippet) tuples. Jobs deleted since they
+        were indexed are skipped.
+        """
+        data = self.cleaned_data
+        until = data['until']
+        if until is not None:
+            until += datetime.timedelta(days=1)
+        results = index.search(
+            data['q'], project=data['project'] and data['project'].slug,
+            branch=data['branch'] or None, value=data['value'] or None,
+            since=data['since'], until=until,
+        )
+        jobs = Job.objects.select_related('build__project').in_bulk(
+            [job_id for job_id, snippet in results])
+        return [(jobs[job_id], snippet) for job_id, snippet in results
+                if job_id in jobs]
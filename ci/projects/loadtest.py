@@ -0,0 +1,149 @@
+import datetime
+import os
+import shutil
+import time
+
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+
+from ..shell import Command
+from .benchmarks import make_git_repo
+from .models import Project, Job
+from .stats import percentile
+
+PREFIX = 'load-'
+
+
+def create_projects(root, count, script):
+    """
+    Creates <count> projects, each one with its own bare repository in
+    <root>.
+    """
+    projects = []
+    for index in range(count):
+        repo = os.path.join(root, '%s%s.git' % (PREFIX, index))
+        make_git_repo(repo, 2)
+        projects.append(Project.objects.create(
+            name='%s%s' % (PREFIX, index), slug='%s%s' % (PREFIX, index),
+            repo=repo, build_instructions=script,
+        ))
+    return projects
+
+
+def push_commit(repo, message):
+    """
+    Adds a commit on the master branch of a bare repository and returns its
+    SHA.
+    """
+    Command('git fast-import --quiet', stdin='\n'.join([
+        'commit refs/heads/master',
+        'committer Load <load@example.com> %d +0000' % time.time(),
+        'data <<EOF', message, 'EOF',
+        'from refs/heads/master^0',
+        'M 644 inline load.txt',
+        'data <<EOF', message, 'EOF', '',
+    ]), cwd=repo)
+    return Command('git rev-parse master', cwd=repo).out.strip()
+
+
+def distribution(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+def run(root, projects=500, pushes=1000, rate=5, script='true', timeout=600,
+        log=None):
+    """
+    Pushes <pushes> commits to <projects> projects at <rate> pushes per
+    second, triggering a build through the push hook view after each one.
+    Then waits for the builds to finish (at most <timeout> seconds) and
+    returns the distributions of trigger-to-start and trigger-to-finish
+    latencies, in seconds.
+
+    Builds run wherever the settings send them: the workers, or the current
+    process with CELERY_ALWAYS_EAGER.
+    """
+    projects = create_projects(root, projects, script)
+    client = Client()
+    triggers = []
+    started = time.time()
+    for index in range(pushes):
+        project = projects[index % len(projects)]
+        delay = started + float(index) / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        sha = push_commit(project.repo, 'Push %s' % index)
+        triggers.append((project.pk, sha, datetime.datetime.now()))
+        client.post(reverse('project_trigger_build', args=[project.slug]),
+                    {'ref': 'refs/heads/master', 'sha': sha})
+        if log is not None and index % 100 == 99:
+            log("%s pushes" % (index + 1))
+    push_duration = time.time() - started
+
+    # Pushes made while a build is scheduled are merged into it: they are
+    # built by the build of a later revision
+    latest = {}
+    for pk, sha, date in triggers:
+        latest[pk] = sha
+    deadline = time.time() + timeout
+    while True:
+        builds = finished_builds()
+        pending = [sha for sha in latest.values() if sha not in builds]
+        if not pending or time.time() > deadline:
+            break
+        time.sleep(1)
+
+    to_start = []
+    to_finish = []
+    next_build = {}
+    for pk, sha, date in reversed(triggers):
+        if sha in builds:
+            next_build[pk] = builds[sha]
+        if pk in next_build:
+            start_date, end_date = next_build[pk]
+            to_start.append((start_date - date).total_seconds())
+            to_finish.append((end_date - date).total_seconds())
+    return {
+        'projects': len(projects),
+        'pushes': pushes,
+        'push_rate': pushes / push_duration,
+        'builds': len(builds),
+        'unfinished': len(pending),
+        'trigger_to_start': distribution(to_start),
+        'trigger_to_finish': distribution(to_finish),
+    }
+
+
+def finished_builds():
+    """
+    The (first job start, last job end) dates of the finished builds of the
+    load test projects, by revision.
+    """
+    dates = {}
+    running = set()
+    for revision, start_date, end_date in Job.objects.filter(
+        build__project__slug__startswith=PREFIX,
+    ).values_list('build__revision', 'start_date', 'end_date'):
+        if end_date is None:
+            running.add(revision)
+            continue
+        if revision in dates:
+            start_date = min(start_date, dates[revision][0])
+            end_date = max(end_date, dates[revision][1])
+        dates[revision] = (start_date, end_date)
+    return dict([(revision, value) for revision, value in dates.items()
+                 if revision not in running])
+
+
+def clean():
+    """
+    Removes the projects created by a load test and their clones.
+    """
+    for project in Project.objects.filter(slug__startswith=PREFIX):
+        shutil.rmtree(project.cache_dir, ignore_errors=True)
+        project.delete()
@@ -0,0 +1,111 @@
+import datetime
+import glob
+import logging
+import os
+
+from django.conf import settings
+from django.db.models import Q
+
+from ..exceptions import CommandError
+from ..locks import Lock
+from .models import Project, Job
+
+logger = logging.getLogger('ci')
+
+
+def is_due(project, now):
+    threshold = now - datetime.timedelta(days=settings.MAINTENANCE_INTERVAL)
+    return (project.maintenance_date is None or
+            project.maintenance_date <= threshold)
+
+
+def due_projects(now):
+    """
+    One project per local clone that hasn't been maintained for
+    MAINTENANCE_INTERVAL days.
+    """
+    threshold = now - datetime.timedelta(days=settings.MAINTENANCE_INTERVAL)
+    projects = {}
+    for project in Project.objects.filter(
+        Q(maintenance_date__isnull=True) | Q(maintenance_date__lte=threshold),
+    ):
+        projects.setdefault(project.cache_dir, project)
+    return [projects[path] for path in sorted(projects)]
+
+
+def is_borrowed_from(path):
+    """
+    Whether other git clones use <path>'s objects via alternates.
+    """
+    objects = os.path.join(path, '.git', 'objects')
+    pattern = os.path.join(os.path.dirname(path), '*', '.git', 'objects',
+                           'info', 'alternates')
+    for alternates in glob.glob(pattern):
+        with open(alternates) as f:
+            if objects in [line.strip() for line in f]:
+                return True
+    return False
+
+
+def maintain_repositories(now=None):
+    """
+    Schedules the maintenance of the local clones that need it, during
+    off-peak hours. Returns the projects whose clone is being maintained.
+    """
+    now = now or datetime.datetime.now()
+    if now.hour not in settings.MAINTENANCE_HOURS:
+        return []
+
+    from .tasks import maintain_repository
+    projects = due_projects(now)
+    for project in projects:
+        maintain_repository.delay(project.pk)
+    return projects
+
+
+def maintain_repository(project, now=None):
+    """
+    Maintains a project's local clone. At most MAINTENANCE_CONCURRENCY
+    clones are maintained at the same time, and never while they're being
+    fetched.
+
+    Returns True if the clone has been maintained, False if it's busy (the
+    task tries again later) and None if there's nothing to do: no clone
+    yet, or maintained since it was scheduled.
+    """
+    path = project.cache_dir
+    if not os.path.exists(path) or not is_due(project,
+                                              now or datetime.datetime.now()):
+        return None
+
+    for slot in range(settings.MAINTENANCE_CONCURRENCY):
+        slot_lock = Lock('maintenance:%s' % slot, settings.BUILD_LOCK_TIMEOUT)
+        if slot_lock.acquire():
+            break
+    else:
+        return False
+
+    try:
+        mirror_lock = project.mirror_lock
+        if not mirror_lock.acquire():
+            return False
+        try:
+            logger.info("Maintaining %s" % path)
+            project.vcs().maintain(prune=not is_borrowed_from(path))
+            status = Job.SUCCESS
+        except CommandError as e:
+            logger.info("Maintenance of %s failed: %s" % (path, e))
+            status = Job.FAILURE
+        finally:
+            mirror_lock.release()
+    finally:
+        slot_lock.release()
+
+    # Clones are shared: so is their maintenance
+    shared = [p.pk for p in Project.objects.filter(repo_type=project.repo_type)
+              if p.cache_dir == path]
+    Project.objects.filter(pk__in=shared).update(
+        maintenance_date=datetime.datetime.now(),
+        maintenance_status=status,
+    )
+    return True
@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ....labels import parse_labels
+from ...agent import Agent
+
+
+class Command(BaseCommand):
+    args = '<url>'
+    help = ("Runs the jobs of the projects built on remote agents, leased "
+            "from the CI server at <url>. Needs no database.")
+    option_list = BaseCommand.option_list + (
+        make_option('--token', default=settings.AGENT_TOKEN,
+                    help="Token of the agent API (default: AGENT_TOKEN)."),
+        make_option('--name', help="Name of the agent (default: hostname)."),
+        make_option('--labels', help="Labels of the agent, separated by "
+                    "commas (default: WORKER_LABELS)."),
+        make_option('--once', action='store_true', default=False,
+                    help="Stop when there is no job to run."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: agent <url>")
+        if not options['token']:
+            raise CommandError("No token, see --token")
+        labels = options['labels']
+        if labels is not None:
+            labels = parse_labels(labels)
+        Agent(args[0], options['token'], options['name'],
+              labels=labels).run(once=options['once'])
@@ -0,0 +1,73 @@
+import anyjson as json
+import os
+import shutil
+import tempfile
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ... import benchmarks
+
+
+class Command(BaseCommand):
+    help = ("Measures the hot paths of the CI on synthetic repositories and "
+            "compares the results to a previous run.")
+    args = '[benchmark ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--output', help="Write the results to this JSON file."),
+        make_option('--compare', help="Compare the results to this JSON "
+                    "file and fail if there are regressions."),
+        make_option('--threshold', type='float', default=0.2,
+                    help="Relative slowdown considered as a regression "
+                    "(default: 0.2)."),
+        make_option('--repeat', type='int', default=3,
+                    help="Runs of each benchmark (default: 3)."),
+        make_option('--scale', type='float', default=1,
+                    help="Multiplier of the size of the synthetic data "
+                    "(default: 1)."),
+    )
+
+    def handle(self, *names, **options):
+        if not settings.CELERY_ALWAYS_EAGER:
+            raise CommandError("Jobs must run synchronously, use "
+                               "--settings=ci.test_settings")
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.loads(f.read())
+
+        # Like the test runner: a throwaway database and workspace
+        old_name = connection.settings_dict['NAME']
+        old_workspace = settings.WORKSPACE
+        old_logs_root = settings.LOGS_ROOT
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        settings.DEBUG = True  # Counting queries
+        root = tempfile.mkdtemp(prefix='ci-benchmarks-')
+        settings.WORKSPACE = root
+        settings.LOGS_ROOT = os.path.join(root, 'logs')
+        try:
+            results = benchmarks.run(root, options['scale'],
+                                     options['repeat'], names)
+        finally:
+            settings.WORKSPACE = old_workspace
+            settings.LOGS_ROOT = old_logs_root
+            shutil.rmtree(root)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for name, result in sorted(results['results'].items()):
+            self.stdout.write('%-20s %8.3fs %6s queries\n' % (
+                name, result['seconds'], result['queries']))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(json.dumps(results))
+
+        if baseline is not None:
+            regressions = benchmarks.compare(baseline, results,
+                                             options['threshold'])
+            if regressions:
+                raise CommandError("Regressions:\n%s" % '\n'.join(
+                    regressions))
+            self.stdout.write("No regression.\n")
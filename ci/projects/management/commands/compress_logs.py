@@ -0,0 +1,37 @@
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...models import Job
+
+
+class Command(BaseCommand):
+    help = ("Moves the outputs of the finished jobs still stored in the "
+            "database to compressed files. Jobs are updated one at a time, "
+            "so the table is never locked for long.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', default=100,
+                    help="Number of jobs loaded at once (default: 100)."),
+        make_option('--pause', type='float', default=0,
+                    help="Seconds to wait between batches (default: 0)."),
+    )
+
+    def handle(self, **options):
+        jobs = Job.objects.filter(
+            compressed=False, end_date__isnull=False,
+            status__in=[Job.SUCCESS, Job.FAILURE],
+        ).order_by('pk')
+        last = 0
+        count = 0
+        while True:
+            batch = list(jobs.filter(pk__gt=last)[:options['batch']])
+            if not batch:
+                break
+            for job in batch:
+                job.compress_output()
+            last = batch[-1].pk
+            count += len(batch)
+            self.stdout.write("%s jobs compressed\n" % count)
+            time.sleep(options['pause'])
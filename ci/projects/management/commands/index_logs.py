@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from .... import search
+from ...models import Job
+
+
+class Command(BaseCommand):
+    help = ("Adds the output of the finished jobs that aren't indexed yet to "
+            "the full-text index of the logs, and removes the deleted jobs "
+            "from it.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', default=500,
+                    help="Number of jobs loaded at once (default: 500)."),
+        make_option('--rebuild', action='store_true', default=False,
+                    help="Index all the finished jobs again."),
+    )
+
+    def handle(self, **options):
+        index = search.get_index()
+        try:
+            indexed = set(index.job_ids())
+            existing = set(Job.objects.filter(
+                end_date__isnull=False,
+            ).values_list('pk', flat=True))
+            index.remove(indexed - existing)
+            if options['rebuild']:
+                indexed = set()
+            missing = sorted(existing - indexed)
+            batch = options['batch']
+            for start in range(0, len(missing), batch):
+                jobs = Job.objects.select_related('build__project').filter(
+                    pk__in=missing[start:start + batch])
+                for job in jobs:
+                    job.index_output(index)
+                self.stdout.write("%s/%s jobs indexed\n" % (
+                    min(start + batch, len(missing)), len(missing)))
+        finally:
+            index.close()
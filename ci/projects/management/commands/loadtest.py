@@ -0,0 +1,70 @@
+import anyjson as json
+import os
+import shutil
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import loadtest
+
+
+class Command(BaseCommand):
+    help = ("Creates many projects, pushes commits to them at a given rate "
+            "and measures how long builds take to start and finish. Runs "
+            "against the configured database and workers.")
+    option_list = BaseCommand.option_list + (
+        make_option('--projects', type='int', default=500,
+                    help="Number of projects (default: 500)."),
+        make_option('--pushes', type='int', default=1000,
+                    help="Number of pushes (default: 1000)."),
+        make_option('--rate', type='float', default=5,
+                    help="Pushes per second (default: 5)."),
+        make_option('--script', default='true',
+                    help="Build instructions of the projects "
+                    "(default: true)."),
+        make_option('--timeout', type='int', default=600,
+                    help="Max. time to wait for the builds to finish, in "
+                    "seconds (default: 600)."),
+        make_option('--output', help="Write the report to this JSON file."),
+        make_option('--keep', action='store_true', default=False,
+                    help="Keep the projects and their builds."),
+        make_option('--clean', action='store_true', default=False,
+                    help="Only remove the projects of a previous run."),
+    )
+
+    def handle(self, **options):
+        # The workers must be able to clone the repositories
+        root = os.path.join(settings.WORKSPACE, 'loadtest')
+        if options['clean']:
+            loadtest.clean()
+            shutil.rmtree(root, ignore_errors=True)
+            return
+        if os.path.exists(root):
+            raise CommandError("A load test is running or hasn't been "
+                               "cleaned, see --clean")
+        os.makedirs(root)
+        try:
+            report = loadtest.run(
+                root, options['projects'], options['pushes'],
+                options['rate'], options['script'], options['timeout'],
+                log=lambda message: self.stdout.write(message + '\n'),
+            )
+        finally:
+            if not options['keep']:
+                loadtest.clean()
+                shutil.rmtree(root)
+
+        self.stdout.write(
+            "%(pushes)s pushes to %(projects)s projects at %(push_rate).1f "
+            "pushes/s, %(builds)s builds, %(unfinished)s unfinished\n" %
+            report)
+        for key in ['trigger_to_start', 'trigger_to_finish']:
+            self.stdout.write(
+                "%-18s p50 %%(p50).2fs  p90 %%(p90).2fs  p99 %%(p99).2fs  "
+                "max %%(max).2fs\n" % key % report[key]
+                if report[key]['count'] else "%s: no build\n" % key)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(json.dumps(report))
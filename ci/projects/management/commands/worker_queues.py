@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ....labels import parse_labels, worker_queues
+
+
+class Command(BaseCommand):
+    help = ("Prints the queues a worker with the given labels consumes, for "
+            "celeryd -Q.")
+    option_list = BaseCommand.option_list + (
+        make_option('--labels', help="Labels of the worker, separated by "
+                    "commas (default: WORKER_LABELS)."),
+    )
+
+    def handle(self, **options):
+        labels = settings.WORKER_LABELS
+        if options['labels'] is not None:
+            labels = parse_labels(options['labels'])
+        default = getattr(settings, 'CELERY_DEFAULT_QUEUE', 'celery')
+        self.stdout.write(','.join(worker_queues(labels, default)) + '\n')
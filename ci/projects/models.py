@@ -1,19 +1,30 @@
 import anyjson as json
 import datetime
+import hashlib
 import itertools
 import logging
 import os
-import shutil
+import tarfile
+import time
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
-from .. import vcs
+from .. import logs, metrics, search, tracing, vcs
+from ..caches import CacheStore, cache_key, parse_cache_directories
+from ..labels import label_combinations, parse_labels, queue_name
 from ..exceptions import CommandError
+from ..locks import Lock
+from ..pipelines import copy_path, parse_paths, sort_stages
 from ..shell import Command
-from ..parsers import XunitParser
+from ..trash import move_to_trash
+from ..parsers import (TraceProfiler, XunitParser, failure_hash,
+                       first_error_line, normalize_failure, output_failure,
+                       parse_benchmarks)
 
 logger = logging.getLogger('ci')
 
@@ -44,6 +55,13 @@ class Project(models.Model):
     )
     repo_type = models.CharField(_('Repository type'), max_length=10,
                                  choices=REPO_TYPES, default=GIT)
+    upstream = models.ForeignKey(
+        'self', verbose_name=_('Fork of'), null=True, blank=True,
+        related_name='forks', on_delete=models.SET_NULL,
+        help_text=_('The project building the repository yours is a fork '
+                    'of. Its clone is used as a reference for git clones, '
+                    'to avoid fetching the same objects twice.'),
+    )
     build_instructions = models.TextField(
         _('Build instructions'),
         help_text=_('The commands that need to be run in order to build the '
@@ -61,10 +79,53 @@ class Project(models.Model):
                     'debugging builds but potentially eats a lot of disk '
                     'space.'),
     )
+    warm_workspace = models.BooleanField(
+        _('Reuse workspaces'), default=False,
+        help_text=_('Check this box to run jobs in the workspace of a '
+                    'previous job with the same configuration values, '
+                    'updated instead of cloned from scratch. Files ignored '
+                    'by your VCS, such as build outputs, are kept.'),
+    )
     xunit_xml_report = models.CharField(_('XML test report'), blank=True,
                                         max_length=1023)
+    benchmark_report = models.CharField(
+        _('Benchmark report'), blank=True, max_length=1023,
+        help_text=_('JSON file written by your benchmarks, relative to the '
+                    'root of your repository: a pytest-benchmark report, '
+                    'or {"name": value} with lower values being better.'),
+    )
     build_branches = models.CharField(_('Branches to build'), max_length=50,
                                       choices=BRANCHES, default=DEFAULT_BRANCH)
+    cache_directories = models.TextField(
+        _('Cache directories'), blank=True,
+        help_text=_('Directories to keep between builds, one per line, '
+                    'relative to the root of your repository and followed '
+                    'by the files their content depends on. E.g. '
+                    '".pip-cache: requirements.txt". Caches are restored '
+                    'before running the build instructions and saved after '
+                    'successful builds.'),
+    )
+    remote_agents = models.BooleanField(
+        _('Run on remote agents'), default=False,
+        help_text=_('Check this box to run jobs on the build agents that '
+                    'lease them over HTTP instead of the workers.'),
+    )
+    poll = models.BooleanField(
+        _('Poll repository'), default=True,
+        help_text=_('Check this box to build new commits automatically, '
+                    'without a push hook.'),
+    )
+    poll_interval = models.PositiveIntegerField(
+        _('Polling interval'), default=settings.POLL_INTERVAL_MIN,
+        editable=False,
+    )
+    next_poll = models.DateTimeField(_('Next poll'), null=True,
+                                     editable=False)
+    maintenance_date = models.DateTimeField(_('Last maintenance'),
+                                            null=True, editable=False)
+    maintenance_status = models.CharField(_('Maintenance status'),
+                                          max_length=10, blank=True,
+                                          editable=False)
 
     class Meta:
         ordering = ('name',)
@@ -86,30 +147,75 @@ class Project(models.Model):
         return {
             self.GIT: vcs.Git,
             self.HG: vcs.Hg,
-        }[self.repo_type](self.repo, self.cache_dir)
+        }[self.repo_type](self.repo, self.cache_dir,
+                          reference=self.related_mirror)
 
     @property
     def cache_dir(self):
         """
-        Directory where to put the local clone.
+        Directory where to put the local clone. Projects tracking the same
+        repository share the same clone.
         """
         prefix = os.path.join(settings.WORKSPACE, 'repos')
         if not os.path.exists(prefix):
             os.makedirs(prefix)
-        return os.path.join(prefix, self.slug)
+        return os.path.join(prefix, vcs.mirror_name(self.repo_type, self.repo))
+
+    @property
+    def related_mirror(self):
+        """
+        The clone of the upstream project's repository, if the project is a
+        fork of it. Git clones borrow objects from it via alternates.
 
-    def build(self):
+        Mercurial clones are only shared when the URLs match: a shared store
+        would mix the heads of both repositories.
+        """
+        if self.repo_type != self.GIT or self.upstream_id is None:
+            return
+        upstream = self.upstream  # Cached by the descriptor
+        if upstream.repo_type != self.GIT:
+            return
+        path = upstream.cache_dir
+        if (path != self.cache_dir and
+            os.path.isdir(os.path.join(path, '.git'))):
+            return path
+
+    def build(self, branches=None):
         """
         Triggers a build!
 
+        If <branches> is given, only those branches are fetched and built.
+        Otherwise the branches to build depend on the project's settings.
+
         Returns True if the build is triggered, False if not
         (revisions are not built twice).
         """
-        self.update_source()
-        vcs = self.vcs()
-        branches = ([vcs.default_branch]  # TODO detect repo's default branch
-                    if self.build_branches == self.DEFAULT_BRANCH
-                    else vcs.branches())
+        with tracing.span('Project.build', root=True, project=self.slug):
+            return self._build(branches)
+
+    def _build(self, branches):
+        if branches is None:
+            self.update_source()
+            vcs = self.vcs()
+            branches = ([vcs.default_branch]  # TODO detect default branch
+                        if self.build_branches == self.DEFAULT_BRANCH
+                        else vcs.branches())
+        else:
+            if self.build_branches == self.DEFAULT_BRANCH:
+                default_branch = self.vcs().default_branch
+                branches = [b for b in branches if b == default_branch]
+            if not branches:
+                return False
+            try:
+                self.update_source(branches)
+            except CommandError:
+                # A pushed branch may have been deleted since
+                logger.info("Unable to fetch %s, fetching everything" %
+                            ', '.join(branches))
+                self.update_source()
+            # Deleted branches can't be built
+            existing = self.vcs().branches()
+            branches = [b for b in branches if b in existing]
 
         jobs = []
         for branch in branches:
@@ -117,19 +223,66 @@ class Project(models.Model):
             if branch_jobs is not None:
                 jobs = list(itertools.chain(jobs, branch_jobs))
 
+        self.queue_jobs(jobs)
+        return bool(jobs)
+
+    def queue_jobs(self, jobs):
+        """
+        Queues the jobs of new builds. Pipeline builds only queue the stages
+        that need no other one.
+        """
+        pipelines = [job for job in jobs if job.stage]
+        for build_id in sorted(set([job.build_id for job in pipelines])):
+            Build.objects.get(pk=build_id).advance_pipeline()
+        self.send_jobs([job for job in jobs if not job.stage])
+
+    def send_jobs(self, jobs):
+        """
+        Sends <jobs> to the workers, or leaves them to the remote agents.
+        """
         if jobs and self.sequential:
             from .tasks import execute_jobs
-            execute_jobs.delay([j.pk for j in jobs])
+            job_ids = [j.pk for j in jobs]
+            Job.objects.filter(pk__in=job_ids).update(
+                queue_date=datetime.datetime.now(),
+            )
+            if not self.remote_agents:
+                execute_jobs.apply_async(
+                    [job_ids], {'trace': tracing.current()},
+                    queue=Job.jobs_queue(jobs))
         else:
             for job in jobs:
                 job.queue()
-        return bool(jobs)
 
     def build_branch(self, branch):
+        with tracing.span('build_branch', branch=branch):
+            return self._build_branch(branch)
+
+    def _build_branch(self, branch):
         rev = self.vcs().latest_branch_revision(branch)
         if self.builds.filter(branch=branch, revision=rev).exists():
             # Latest rev already build -- don't bother
             return
+
+        # Attach some history info. If the branch hasn't been built yet,
+        # forget about history -- we don't want to walk through the
+        # entire repo.
+        same_branch = self.builds.filter(branch=branch,
+                                         bisection__isnull=True)
+        with tracing.span('changelog'):
+            if same_branch:
+                history = list(self.vcs().changelog(branch,
+                                                    same_branch[0].revision))
+            else:
+                history = []
+        return self.create_build(branch, rev,
+                                 [c.serializable for c in history])
+
+    def create_build(self, branch, rev, history, bisection=None):
+        """
+        Creates a build of revision <rev> and its jobs, one per combination
+        of configuration values. Returns the jobs.
+        """
         configs = self.configurations.all()
         if configs:
             products = []
@@ -140,73 +293,197 @@ class Project(models.Model):
                 products.append(values)
                 for val in values:
                     matrix[config.key].append(val.value)
-            items = itertools.product(*products)
+            items = list(itertools.product(*products))
         else:
             matrix = {}
-
-        # Attach some history info. If the branch hasn't been built yet,
-        # forget about history -- we don't want to walk through the
-        # entire repo.
-        same_branch = self.builds.filter(branch=branch)
-        if same_branch:
-            history = self.vcs().changelog(branch, same_branch[0].revision)
-        else:
-            history = []
+            items = []
+        stages = self.pipeline()
 
         build = Build.objects.create(
             project=self,
             revision=rev,
             branch=branch,
             matrix=json.dumps(matrix),
-            history=json.dumps([c.serializable for c in history]),
+            history=json.dumps(history),
             build_instructions=self.build_instructions,
             xunit_xml_report=self.xunit_xml_report,
+            benchmark_report=self.benchmark_report,
+            cache_directories=self.cache_directories,
+            stages=json.dumps(stages) if stages else '',
+            trace_id=tracing.trace_id(),
+            bisection=bisection,
         )
+        metrics.incr('ci_builds_total', {'project': self.slug})
         jobs = []
 
-        if configs:
-            for values in items:
-                job = Job.objects.create(
-                    build=build,
-                    values=json.dumps({v.key.key: v.value for v in values}),
-                )
-                jobs.append(job)
-        else:
-            job = Job.objects.create(
-                build=build,
-            )
-            jobs.append(job)
+        with tracing.span('create_jobs'):
+            for stage in stages or [{'name': '', 'matrix': True}]:
+                if configs and stage['matrix']:
+                    for values in items:
+                        job = Job.objects.create(
+                            build=build,
+                            stage=stage['name'],
+                            values=json.dumps({v.key.key: v.value
+                                               for v in values}),
+                            labels=' '.join(parse_labels(' '.join(
+                                [v.labels for v in values]))),
+                        )
+                        jobs.append(job)
+                else:
+                    job = Job.objects.create(
+                        build=build,
+                        stage=stage['name'],
+                    )
+                    jobs.append(job)
         return jobs
 
-    def update_source(self):
+    def pipeline(self):
+        """
+        The stages of the project, each one after the stages it needs, as
+        stored in its builds. Empty if the project is built by a single
+        script.
+        """
+        stages = dict([(stage.name, stage) for stage in self.stages.all()])
+        return [{
+            'name': name,
+            'build_instructions': stages[name].build_instructions,
+            'needs': stages[name].needs_list,
+            'matrix': stages[name].matrix,
+            'artifacts': parse_paths(stages[name].artifacts),
+        } for name in sort_stages(dict([
+            (name, stage.needs_list) for name, stage in stages.items()
+        ]))]
+
+    @property
+    def build_lock(self):
+        """
+        Held during a fetch-and-build cycle.
+        """
+        return Lock('build:%s' % self.pk, settings.BUILD_LOCK_TIMEOUT)
+
+    @property
+    def build_scheduled(self):
+        """
+        Held while a build cycle is scheduled but hasn't started yet.
+        """
+        return Lock('build-scheduled:%s' % self.pk,
+                    settings.BUILD_LOCK_TIMEOUT)
+
+    def request_build(self, refs=None):
+        """
+        Asks for a build, asynchronously. Requests made while a build cycle
+        is scheduled are merged into that cycle.
+
+        <refs> is a list of (branch, revision) tuples telling which branches
+        have been pushed. If None, the project's branches are all checked.
+
+        Returns True if a new build cycle has been scheduled, False if the
+        request has been merged into a pending one or if there's nothing
+        to build.
+        """
+        if refs is None:
+            self.build_requests.create()
+        else:
+            refs = [(branch, rev) for branch, rev in refs if rev is None or
+                    not self.builds.filter(branch=branch,
+                                           revision=rev).exists()]
+            if not refs:
+                return False
+            for branch, rev in refs:
+                self.build_requests.create(branch=branch, revision=rev or '')
+
+        if not self.build_scheduled.acquire():
+            return False
+        from .tasks import process_build_requests
+        process_build_requests.apply_async(
+            args=[self.pk], kwargs={'trace': tracing.current()},
+            countdown=settings.BUILD_TRIGGER_DELAY,
+        )
+        return True
+
+    def process_build_requests(self):
+        """
+        Runs fetch-and-build cycles until there is no pending build request.
+        If another worker is already building this project, it takes care of
+        the pending requests when it's done with its current cycle.
+
+        Returns True if a build has been triggered.
+        """
+        self.build_scheduled.release()
+        lock = self.build_lock
+        triggered = False
+        while self.build_requests.exists():
+            if not lock.acquire():
+                break
+            try:
+                while True:
+                    pending = list(self.build_requests.all())
+                    if not pending:
+                        break
+                    branches = set([r.branch for r in pending])
+                    if '' in branches:
+                        branches = None
+                    else:
+                        branches = sorted(branches)
+                    triggered = self.build(branches) or triggered
+                    # Kept for the next cycle if the build failed
+                    BuildRequest.objects.filter(
+                        pk__in=[r.pk for r in pending],
+                    ).delete()
+            finally:
+                lock.release()
+        return triggered
+
+    def update_source(self, branches=None):
         """
         Projects keep a full clone / checkout of the upstream repo for
-        polling changes.
+        polling changes. Clones can be shared between projects, they are
+        updated one project at a time.
+        """
+        with tracing.span('update_source'), self.mirror_lock:
+            started = time.time()
+            self.vcs().update_source(branches)
+            metrics.observe('ci_vcs_fetch_seconds', time.time() - started,
+                            {'vcs': self.repo_type})
+
+    @property
+    def mirror_lock(self):
+        """
+        Held while the local clone is being updated or maintained.
         """
-        self.vcs().update_source()
+        return Lock('mirror:%s' % os.path.basename(self.cache_dir),
+                    settings.BUILD_LOCK_TIMEOUT)
 
     @property
     def latest_revision(self):
         """
         Fetch the latest revision from SCM
         """
-        vcs = self.vcs()
-        vcs.update_source()
-        return vcs.latest_revision()
+        self.update_source()
+        return self.vcs().latest_revision()
+
+    @property
+    def branch_builds(self):
+        """
+        The builds of the branches, without the builds of older revisions
+        made by bisections.
+        """
+        return self.builds.filter(bisection__isnull=True)
 
     @property
     def build_status(self):
         """
         Success or failure? Or maybe still running...
         """
-        if not self.builds.exists():
+        if not self.branch_builds.exists():
             return _('no build yet')
-        return self.builds.all()[0].build_status
+        return self.branch_builds[0].build_status
 
     def build_progress(self):
-        builds = self.builds.all()[0].jobs.all()
+        builds = self.branch_builds[0].jobs.all()
         total = len(builds)
-        done = len([b for b in builds if b.status in (b.SUCCESS, b.FAILURE)])
+        done = len([b for b in builds if b.status in (b.SUCCESS, b.FAILURE,
+                                                      b.CANCELLED)])
         return '%s/%s' % (done, total)
 
     def axis_initial(self):
@@ -215,13 +492,34 @@ class Project(models.Model):
         """
         initial = []
         for axis in self.configurations.all():
+            values = axis.values.all()
             initial.append({
                 'name': axis.key,
-                'values': ', '.join(map(unicode, axis.values.all())),
+                'values': ', '.join(map(unicode, values)),
+                'labels': '; '.join(['%s: %s' % (value, value.labels)
+                                     for value in values if value.labels]),
             })
         return initial
 
 
+class BuildRequest(models.Model):
+    """
+    A build asked for by a push hook or the build button, waiting to be
+    processed by a worker.
+    """
+    project = models.ForeignKey(Project, verbose_name=_('Project'),
+                                related_name='build_requests')
+    branch = models.CharField(_('Branch'), max_length=1023, blank=True,
+                              help_text=_('Empty to check all branches'))
+    revision = models.CharField(_('Revision pushed'), max_length=1023,
+                                blank=True)
+    creation_date = models.DateTimeField(_('Date created'),
+                                         default=datetime.datetime.now)
+
+    class Meta:
+        ordering = ('creation_date',)
+
+
 class Configuration(models.Model):
     """
     Multi-configurations ala jenkins: a key, several values, a build per value.
@@ -241,6 +539,11 @@ class Value(models.Model):
     key = models.ForeignKey(Configuration, verbose_name=_('Key'),
                             related_name='values')
     value = models.CharField(_('Value'), max_length=255)
+    labels = models.CharField(
+        _('Worker labels'), max_length=255, blank=True,
+        help_text=_('Labels of the workers able to run the jobs with this '
+                    'value, separated by spaces'),
+    )
 
     def __unicode__(self):
         return u'%s' % self.value
@@ -249,6 +552,42 @@ class Value(models.Model):
         unique_together = ('key', 'value')
 
 
+class Stage(models.Model):
+    """
+    A step of a pipeline. Stages run once the stages they need have
+    succeeded, in parallel if they don't need each other.
+    """
+    project = models.ForeignKey(Project, verbose_name=_('Project'),
+                                related_name='stages')
+    name = models.SlugField(_('Name'), max_length=255)
+    build_instructions = models.TextField(_('Build instructions'))
+    needs = models.CharField(
+        _('Needs'), max_length=1023, blank=True,
+        help_text=_('The stages that must succeed first, separated by '
+                    'spaces'),
+    )
+    matrix = models.BooleanField(
+        _('Build matrix'), default=False,
+        help_text=_('Run once per combination of the axis values'),
+    )
+    artifacts = models.TextField(
+        _('Artifacts'), blank=True,
+        help_text=_('Files and directories passed to the stages needing '
+                    'this one, one per line'),
+    )
+
+    def __unicode__(self):
+        return u'%s' % self.name
+
+    class Meta:
+        ordering = ('id',)
+        unique_together = ('project', 'name')
+
+    @property
+    def needs_list(self):
+        return self.needs.split()
+
+
 class Build(models.Model):
     """
     Stores the metadata for a build axis / matrix
@@ -268,6 +607,14 @@ class Build(models.Model):
     build_instructions = models.TextField(_('Build instructions'))
     xunit_xml_report = models.CharField(_('XML test report'), blank=True,
                                         max_length=1023)
+    benchmark_report = models.CharField(_('Benchmark report'), blank=True,
+                                        max_length=1023)
+    cache_directories = models.TextField(_('Cache directories'), blank=True)
+    stages = models.TextField(_('Pipeline stages'), blank=True)
+    trace_id = models.CharField(_('Trace'), max_length=32, blank=True)
+    bisection = models.ForeignKey('Bisection', verbose_name=_('Bisection'),
+                                  related_name='builds', null=True,
+                                  blank=True)
 
     def __unicode__(self):
         return u'Build #%s of %s' % (self.pk, self.project.name)
@@ -280,8 +627,18 @@ class Build(models.Model):
         Trigger a sequential build.
         """
         from .tasks import execute_jobs
-        job_ids = list(self.jobs.values_list('pk', flat=True))
-        execute_jobs.delay(job_ids)
+        if self.stages:
+            self.jobs.update(queue_date=None, status=Job.PENDING, agent='',
+                             lease_expiry=None, end_date=None)
+            self.advance_pipeline()
+            return
+        jobs = list(self.jobs.all())
+        job_ids = [job.pk for job in jobs]
+        self.jobs.update(queue_date=datetime.datetime.now(),
+                         status=Job.PENDING, agent='', lease_expiry=None)
+        if not self.project.remote_agents:
+            execute_jobs.apply_async([job_ids], {'trace': tracing.current()},
+                                     queue=Job.jobs_queue(jobs))
 
     @property
     def matrix_data(self):
@@ -290,10 +647,94 @@ class Build(models.Model):
         """
         return json.loads(self.matrix)
 
+    @property
+    def stages_data(self):
+        """
+        The pipeline stages, each one after the stages it needs.
+        """
+        if not self.stages:
+            return []
+        return json.loads(self.stages)
+
+    def stage_data(self, name):
+        for stage in self.stages_data:
+            if stage['name'] == name:
+                return stage
+
+    def artifacts_path(self, stage):
+        return os.path.join(settings.WORKSPACE, 'artifacts', str(self.pk),
+                            stage)
+
+    @property
+    def pipeline_lock(self):
+        return Lock('pipeline:%s' % self.pk)
+
+    def advance_pipeline(self):
+        """
+        Queues the stages whose needed stages have all succeeded, and
+        cancels the ones needing a failed or cancelled stage.
+        """
+        queued = []
+        with self.pipeline_lock:
+            jobs = list(self.jobs.all())
+            states = {}
+            for stage in self.stages_data:
+                stage_jobs = [job for job in jobs
+                              if job.stage == stage['name']]
+                needed = [states[name] for name in stage['needs']]
+                if [job for job in stage_jobs if job.status in (
+                    Job.FAILURE, Job.CANCELLED)]:
+                    states[stage['name']] = 'failed'
+                elif [job for job in stage_jobs if job.status != Job.SUCCESS]:
+                    states[stage['name']] = 'unfinished'
+                else:
+                    states[stage['name']] = 'success'
+                if [job for job in stage_jobs if job.status != Job.PENDING
+                    or job.queue_date is not None]:
+                    continue  # Already queued
+                if 'failed' in needed:
+                    self.jobs.filter(stage=stage['name']).update(
+                        status=Job.CANCELLED,
+                        end_date=datetime.datetime.now(),
+                    )
+                    states[stage['name']] = 'failed'
+                elif not [state for state in needed if state != 'success']:
+                    # Marked as queued while the lock is held
+                    self.jobs.filter(stage=stage['name']).update(
+                        queue_date=datetime.datetime.now())
+                    queued.extend(stage_jobs)
+        # Outside of the lock: jobs may run in this process
+        self.project.send_jobs(queued)
+
     @property
     def history_data(self):
         return json.loads(self.history)
 
+    def commits_since(self, good):
+        """
+        The commits of the builds of the branch after <good> up to this
+        one, oldest first, from their changelogs.
+        """
+        builds = self.project.builds.filter(
+            branch=self.branch, bisection__isnull=True, pk__gt=good.pk,
+            pk__lte=self.pk,
+        ).order_by('-pk')
+        commits = [commit for build in builds
+                   for commit in build.history_data]
+        return list(reversed(commits))
+
+    def bisect(self, good, width=None):
+        """
+        Starts looking for the commit that broke this build since <good>.
+        """
+        bisection = Bisection.objects.create(
+            project=self.project, good=good, bad=self,
+            commits=json.dumps(self.commits_since(good)),
+            width=width or settings.BISECTION_WIDTH,
+        )
+        bisection.advance()
+        return Bisection.objects.get(pk=bisection.pk)
+
     @property
     def build_status(self):
         builds = self.jobs.all()
@@ -303,6 +744,9 @@ class Build(models.Model):
         failed = [build for build in builds if build.status == build.FAILURE]
         if failed:
             return 'failed'
+        pending = [build for build in builds if build.status == build.PENDING]
+        if pending and self.stages and len(pending) < len(builds):
+            return 'running'  # Waiting for the next stages
         success = [build for build in builds if build.status == build.SUCCESS]
         if success:
             return 'success'
@@ -323,12 +767,34 @@ class Job(models.Model):
     FAILURE = 'failure'
     RUNNING = 'running'
     PENDING = 'pending'
+    CANCELLED = 'cancelled'
 
     STATUSES = (
         (SUCCESS, _('Success')),
         (FAILURE, _('Failure')),
         (RUNNING, _('Running')),
         (PENDING, _('Pending')),
+        (CANCELLED, _('Cancelled')),
+    )
+
+    # Phases of a job's execution, timed separately
+    PHASES = (
+        ('queue', _('Queue')),
+        ('checkout', _('Checkout')),
+        ('artifacts', _('Artifacts')),
+        ('caches', _('Caches')),
+        ('script', _('Build script')),
+        ('reports', _('Reports')),
+        ('cleanup', _('Cleanup')),
+    )
+
+    # Resources used by the build script, as displayed in stats
+    RESOURCES = (
+        ('cpu_user', _('User CPU (s)')),
+        ('cpu_system', _('System CPU (s)')),
+        ('max_rss', _('Max. RSS (MiB)')),
+        ('io_read', _('Read (MiB)')),
+        ('io_write', _('Written (MiB)')),
     )
 
     build = models.ForeignKey(Build, verbose_name=_('Build'),
@@ -337,11 +803,32 @@ class Job(models.Model):
                               choices=STATUSES, default=PENDING)
     creation_date = models.DateTimeField(_('Date created'),
                                          default=datetime.datetime.now)
+    queue_date = models.DateTimeField(_('Date queued'), null=True)
     start_date = models.DateTimeField(_('Date started'), null=True)
     end_date = models.DateTimeField(_('Date ended'), null=True)
+    timings = models.TextField(_('Timings'), blank=True)
+    profile = models.TextField(_('Build steps profile'), blank=True)
+    cpu_user = models.FloatField(_('User CPU time'), null=True)
+    cpu_system = models.FloatField(_('System CPU time'), null=True)
+    max_rss = models.PositiveIntegerField(_('Max. resident set size'),
+                                          null=True)
+    io_read = models.BigIntegerField(_('Bytes read'), null=True)
+    io_write = models.BigIntegerField(_('Bytes written'), null=True)
+    stage = models.CharField(_('Stage'), max_length=255, blank=True)
     values = models.TextField(_('Values'), blank=True)
+    labels = models.CharField(_('Worker labels'), max_length=255,
+                              blank=True)
+    workspace = models.CharField(_('Workspace'), max_length=1023, blank=True)
+    agent = models.CharField(_('Agent'), max_length=255, blank=True)
+    lease_expiry = models.DateTimeField(_('Lease expiry'), null=True)
     output = models.TextField(_('Build output'), blank=True)
+    compressed = models.BooleanField(_('Output compressed'), default=False)
+    first_error_line = models.PositiveIntegerField(_('First error line'),
+                                                   null=True)
     xunit_xml_report = models.TextField(_('XML test report'), blank=True)
+    failures = models.ManyToManyField('FailureSignature',
+                                      verbose_name=_('Failures'),
+                                      related_name='jobs', blank=True)
 
     def __unicode__(self):
         return u'Build #%s (%s)' % (self.pk,
@@ -352,17 +839,86 @@ class Job(models.Model):
 
     @property
     def build_path(self):
+        if self.workspace:
+            return self.workspace
         prefix = os.path.join(settings.WORKSPACE, 'builds')
         if not os.path.exists(prefix):
             os.makedirs(prefix)
         return os.path.join(prefix, str(self.pk))
 
+    @property
+    def log_path(self):
+        return os.path.join(settings.LOGS_ROOT, str(self.pk // 1000),
+                            '%s.z' % self.pk)
+
+    def iter_output(self, tail=None):
+        """
+        The output, in chunks. Compressed outputs are decompressed one block
+        at a time. With <tail>, at least the last <tail> bytes are returned.
+        """
+        if self.compressed:
+            return logs.read(self.log_path, tail)
+        if tail is not None:
+            return [self.output[-tail:]]
+        return [self.output]
+
+    def get_output(self):
+        return u''.join(self.iter_output())
+
+    def get_output_tail(self, size):
+        return u''.join(self.iter_output(tail=size))[-size:] if size else u''
+
+    def get_lines(self, start, count):
+        """
+        Lines <start> to <start + count> (0-based) of the output, and its
+        number of lines.
+        """
+        if self.compressed:
+            return logs.read_lines(self.log_path, start, count)
+        lines = logs.split_lines(self.output)
+        return lines[start:start + count], len(lines)
+
+    def compress_output(self):
+        """
+        Moves the output of a finished job out of the database, to a
+        compressed file.
+        """
+        if self.compressed:
+            return
+        self.first_error_line = first_error_line(self.output)
+        logs.write(self.log_path, self.output)
+        Job.objects.filter(pk=self.pk).update(
+            output='', compressed=True, first_error_line=self.first_error_line)
+        self.output = ''
+        self.compressed = True
+
     @property
     def values_data(self):
         if self.values:
             return json.loads(self.values)
         return {}
 
+    @property
+    def timings_data(self):
+        """
+        The duration of each phase, in seconds, in execution order.
+        """
+        if not self.timings:
+            return []
+        timings = json.loads(self.timings)
+        return [(name, timings[phase]) for phase, name in self.PHASES
+                if phase in timings]
+
+    @property
+    def profile_data(self):
+        """
+        The build steps: line of the build instructions, command, number of
+        runs and total duration in seconds.
+        """
+        if not self.profile:
+            return []
+        return json.loads(self.profile)
+
     @property
     def xunit(self):
         """
@@ -373,9 +929,15 @@ class Job(models.Model):
         return self._xunit
 
     def delete_build_data(self):
+        """
+        Moves the build data to the trash, which is emptied in the
+        background.
+        """
         if os.path.exists(self.build_path):
             logger.info("Cleaning build data")
-            shutil.rmtree(self.build_path)
+            move_to_trash(self.build_path)
+            from .tasks import empty_trash
+            empty_trash.delay()
 
     def vcs(self):
         return {
@@ -384,49 +946,223 @@ class Job(models.Model):
         }[self.build.project.repo_type](self.build.project.repo,
                                         self.build_path)
 
+    @property
+    def workspace_lease(self):
+        return Lock('workspace:%s' % self.workspace,
+                    settings.WORKSPACE_LEASE_TIMEOUT)
+
+    def lease_workspace(self):
+        """
+        Picks a warm workspace for the job: one used by a previous job with
+        the same configuration values and not in use by another job.
+        """
+        values = '&'.join(['%s=%s' % item
+                           for item in sorted(self.values_data.items())])
+        prefix = os.path.join(settings.WORKSPACE, 'warm',
+                              self.build.project.slug,
+                              hashlib.sha1(values).hexdigest()[:12])
+        slot = 0
+        while True:
+            self.workspace = '%s-%s' % (prefix, slot)
+            if self.workspace_lease.acquire():
+                break
+            slot += 1
+        logger.info("Using workspace %s" % self.workspace)
+        if os.path.exists(self.workspace):
+            os.utime(self.workspace, None)  # For the garbage collector
+
     def execute(self):
         """
         Execute all the things!
         """
+        with tracing.span('Job.execute', job=self.pk):
+            self._execute()
+
+    def _execute(self):
         logger.info("Starting %s" % self.__unicode__())
+        self.start()
+        self.save()
+        timings = dict([(phase, 0) for phase, name in self.PHASES])
+        self.run_steps(timings)
+        self.finish(timings)
+
+    def start(self):
+        """
+        Marks the job as running, without saving it.
+        """
         self.status = self.RUNNING
         self.start_date = datetime.datetime.now()
-        self.save()
+        if self.queue_date is not None:
+            metrics.observe('ci_job_queue_wait_seconds',
+                            (self.start_date -
+                             self.queue_date).total_seconds(),
+                            {'project': self.build.project.slug})
 
+    def run_steps(self, timings):
+        """
+        Checks out the source, runs the build script and fetches the reports
+        in the build directory, then sets the status. Adds the time spent
+        in each phase to <timings>. Runs in the workers and in the remote
+        agents, which have no database access.
+        """
         if not os.path.isdir(settings.WORKSPACE):
             logger.info("Creating workspace")
             os.makedirs(settings.WORKSPACE)
 
-        self.delete_build_data()
+        started = time.time()
+        warm = self.build.project.warm_workspace
+        if warm:
+            self.lease_workspace()
+        else:
+            self.workspace = ''
+            self.delete_build_data()
         self.output = ''
-
-        for step in [self.checkout_source, self.run, self.fetch_reports]:
-            try:
-                step()
-            except CommandError as e:
-                self.output += str(e) + '\n'
-                self.output += e.command.out
-                self.status = self.FAILURE
-
-        if self.status != self.FAILURE:
-            self.status = self.SUCCESS
+        self.compressed = False
+        timings['cleanup'] += time.time() - started
+
+        try:
+            for phase, step in [('checkout', self.checkout_source),
+                                ('artifacts', self.restore_artifacts),
+                                ('caches', self.restore_caches),
+                                ('script', self.run),
+                                ('reports', self.fetch_reports)]:
+                started = time.time()
+                try:
+                    with tracing.span(phase):
+                        step()
+                except CommandError as e:
+                    self.output += str(e) + '\n'
+                    self.output += e.command.out
+                    self.status = self.FAILURE
+                timings[phase] += time.time() - started
+
+            if self.status != self.FAILURE:
+                self.status = self.SUCCESS
+                started = time.time()
+                self.save_caches()
+                timings['caches'] += time.time() - started
+                started = time.time()
+                self.save_artifacts()
+                timings['artifacts'] += time.time() - started
+        finally:
+            if warm:
+                self.workspace_lease.release()
 
         logger.info("%s finished: %s" % (self.__unicode__(),
                                          self.status.upper()))
-        self.end_date = datetime.datetime.now()
-        if not self.build.project.keep_build_data:
+        started = time.time()
+        if not warm and not self.build.project.keep_build_data:
             self.delete_build_data()
+        timings['cleanup'] += time.time() - started
+
+    def finish(self, timings):
+        """
+        Stores the results of a job whose steps have run.
+        """
+        labels = {'project': self.build.project.slug}
+        self.end_date = datetime.datetime.now()
+        if self.queue_date is not None:
+            timings['queue'] = (self.start_date -
+                                self.queue_date).total_seconds()
+        self.timings = json.dumps(dict([
+            (phase, round(duration, 3)) for phase, duration in timings.items()
+        ]))
         self.save()
+        if self.build.benchmark_report:
+            # Missing results show in the benchmarks, not as a failure
+            self.benchmarks.all().delete()
+            for name, value in getattr(self, 'benchmark_results', []):
+                self.benchmarks.create(name=name[:255], values=self.values,
+                                       value=value)
+        if self.status == self.FAILURE:
+            self.index_failures()
+        output_size = len(self.output)
+        try:
+            self.compress_output()
+        except EnvironmentError:  # Kept in the database
+            logger.exception("Unable to compress the output of %s" % self)
+        from .tasks import advance_bisections, advance_pipeline, index_output
+        index_output.delay(self.pk)
+        if self.stage:
+            advance_pipeline.delay(self.build_id)
+        advance_bisections.delay(self.build.project_id)
+
+        metrics.incr('ci_jobs_finished_total',
+                     dict(labels, status=self.status))
+        metrics.observe('ci_job_duration_seconds',
+                        (self.end_date - self.start_date).total_seconds(),
+                        labels)
+        metrics.incr('ci_job_output_bytes_total', labels, output_size)
 
     def checkout_source(self):
         """
         Performs a checkout / clone in the build directory.
         """
         logger.info("Checking out %s" % self.build.project.repo)
-        self.output += '[CI] Cloning...\n'
         vcs = self.vcs()
-        vcs.update_source()
-        vcs.checkout(self.build.branch, self.build.revision)
+        if os.path.exists(self.build_path):
+            self.output += '[CI] Updating...\n'
+            vcs.update_source()
+            vcs.checkout(self.build.branch, self.build.revision)
+            vcs.clean()
+        else:
+            self.output += '[CI] Cloning...\n'
+            vcs.update_source()
+            vcs.checkout(self.build.branch, self.build.revision)
+
+    @property
+    def caches(self):
+        """
+        (directory, key) of the build's cache directories.
+        """
+        return [
+            (directory, '%s/%s' % (self.build.project.slug, cache_key(
+                self.build_path, directory, key_files, self.values_data,
+            ))) for directory, key_files in parse_cache_directories(
+                self.build.cache_directories,
+            )
+        ]
+
+    def cache_store(self):
+        return CacheStore(os.path.join(settings.WORKSPACE, 'caches'),
+                          settings.DEPENDENCY_CACHE_SIZE)
+
+    def restore_caches(self):
+        """
+        Restores the cache directories saved by previous builds.
+        """
+        store = self.cache_store()
+        try:
+            caches = self.caches
+        except ValueError as e:
+            self.output += '[CI] Invalid cache directories: %s\n' % e
+            return
+        for directory, key in caches:
+            try:
+                restored = store.restore(key, self.build_path, directory)
+            except (EnvironmentError, tarfile.TarError) as e:
+                logger.info("Unable to restore %s: %s" % (key, e))
+                restored = False
+            if restored:
+                self.output += '[CI] Restored cache %s\n' % directory
+            else:
+                self.output += '[CI] No cache for %s\n' % directory
+
+    def save_caches(self):
+        """
+        Saves the cache directories. A broken cache never fails a build.
+        """
+        store = self.cache_store()
+        try:
+            caches = self.caches
+        except ValueError:  # Reported when restoring
+            return
+        for directory, key in caches:
+            try:
+                if store.save(key, self.build_path, directory):
+                    self.output += '[CI] Saved cache %s\n' % directory
+            except (EnvironmentError, tarfile.TarError) as e:
+                logger.info("Unable to save %s: %s" % (key, e))
 
     def run(self):
         """
@@ -434,43 +1170,317 @@ class Job(models.Model):
         """
         logger.info("Generating build script")
         env = json.loads(self.values) if self.values else {}
-        with open(os.path.join(self.build_path, 'ci-run.sh'), 'wb') as f:
-            # Trap errors but carry on execution
-            f.write("""#! /usr/bin/env bash
+        instructions = self.instructions.replace('\r\n', '\n')
+        # Trap errors but carry on execution. Trace lines hold the line
+        # numbers, for profiling.
+        header = """#! /usr/bin/env bash
+PS4='+${LINENO}: '
 set -Ex
 trap onexit 1 2 3 15 ERR
 EXIT=0
 function onexit() {
     EXIT=${1:-$?}
 }
-""")
-            f.write(self.build.build_instructions.replace('\r\n', '\n'))
+"""
+        with open(os.path.join(self.build_path, 'ci-run.sh'), 'wb') as f:
+            f.write(header)
+            f.write(instructions)
             f.write('\nexit $EXIT\n')
         logger.info("Running build script")
         self.output += '[CI] Running build script...\n'
         self.save()
         Command('chmod +x ci-run.sh', cwd=self.build_path)
-        cmd = Command('./ci-run.sh', environ=env, stream_to=self.stream_to,
-                      cwd=self.build_path)
+
+        lines = instructions.split('\n')
+        first_line = header.count('\n') + 1
+        profiler = TraceProfiler(first_line, first_line + len(lines) - 1)
+
+        def stream_to(output):
+            profiler.feed(output)
+            self.stream_to(output)
+
+        cmd = None
+        try:
+            cmd = Command('./ci-run.sh', environ=env, stream_to=stream_to,
+                          cwd=self.build_path)
+        except CommandError as e:
+            cmd = e.command
+            raise
+        finally:
+            if cmd is not None:
+                self.record_usage(cmd.rusage)
+            profiler.finish()
+            self.profile = json.dumps([{
+                'line': line,
+                'command': lines[line - 1].strip(),
+                'runs': runs,
+                'duration': round(duration, 3),
+            } for line, runs, duration in profiler.steps])
         self.output += cmd.out
 
-    def fetch_reports(self):
+    @property
+    def instructions(self):
+        """
+        The build instructions of the job's stage, or of the build.
+        """
+        if self.stage:
+            return self.build.stage_data(self.stage)['build_instructions']
+        return self.build.build_instructions
+
+    def restore_artifacts(self):
         """
-        Stores the XML reports.
+        Copies the artifacts of the stages needed by the job's stage to the
+        build directory.
         """
-        if not self.build.xunit_xml_report:
+        if not self.stage:
             return
+        for name in self.build.stage_data(self.stage)['needs']:
+            path = self.build.artifacts_path(name)
+            if os.path.isdir(path):
+                copy_path(path, self.build_path)
+                self.output += '[CI] Restored the artifacts of %s\n' % name
 
-        with open(os.path.join(self.build_path,
-                               self.build.xunit_xml_report)) as xml:
-            self.xunit_xml_report = xml.read()
+    def save_artifacts(self):
+        """
+        Saves the artifacts of the job's stage for the stages needing it.
+        Jobs of the same stage share their artifacts.
+        """
+        if not self.stage:
+            return
+        destination = self.build.artifacts_path(self.stage)
+        for path in self.build.stage_data(self.stage)['artifacts']:
+            source = os.path.join(self.build_path, path)
+            if os.path.exists(source):
+                copy_path(source, os.path.join(destination, path))
+                self.output += '[CI] Saved artifact %s\n' % path
+            else:
+                self.output += '[CI] No artifact at %s\n' % path
+
+    def fetch_reports(self):
+        """
+        Reads the XML and benchmark reports.
+        """
+        if self.build.xunit_xml_report:
+            with open(os.path.join(self.build_path,
+                                   self.build.xunit_xml_report)) as xml:
+                self.xunit_xml_report = xml.read()
+
+        if self.build.benchmark_report:
+            try:
+                with open(os.path.join(self.build_path,
+                                       self.build.benchmark_report)) as f:
+                    self.benchmark_results = parse_benchmarks(f.read())
+            except (EnvironmentError, ValueError) as e:
+                self.output += '[CI] Unable to read the benchmarks: %s\n' % e
+
+    def failure_texts(self):
+        """
+        (title, error message) of the failing testcases, or of the error at
+        the end of the output if there is no failing testcase.
+        """
+        failures = []
+        if self.xunit_xml_report:
+            try:
+                testcases = self.xunit.testcases
+            except Exception:  # Broken reports are still displayed as is
+                testcases = []
+            for testcase in testcases:
+                if testcase['status'] in ('failure', 'error'):
+                    failures.append(('%s.%s' % (testcase.get('classname'),
+                                                testcase['name']),
+                                     testcase['text'] or ''))
+        if not failures:
+            # Only the lines output_failure() looks at are decompressed
+            lines, total = self.get_lines(0, 0)
+            lines, total = self.get_lines(max(total - 200, 0), 200)
+            text = output_failure('\n'.join(lines), tail=200)
+            if text is not None:
+                failures.append(('', text))
+        return failures
+
+    def index_failures(self):
+        """
+        Links the job to the signatures of its failures. Indexing errors
+        never fail a build.
+        """
+        paths = [self.build_path, settings.WORKSPACE]
+        try:
+            for title, text in self.failure_texts():
+                text = normalize_failure(text, paths)
+                if title:
+                    text = '%s\n%s' % (title, text)
+                signature, created = FailureSignature.objects.get_or_create(
+                    hash=failure_hash(text),
+                    defaults={'text': text, 'first_job': self},
+                )
+                self.failures.add(signature)
+        except Exception:
+            logger.exception("Unable to index the failures of %s" % self)
+
+    def index_output(self, index=None):
+        """
+        Adds the output to the full-text index of the build logs.
+        """
+        close = index is None
+        if index is None:
+            index = search.get_index()
+        try:
+            index.add(self.pk, self.get_output(), self.build.project.slug,
+                      self.build.branch, self.values_data, self.end_date)
+        finally:
+            if close:
+                index.close()
+
+    def record_usage(self, rusage):
+        """
+        Stores the resources used by the build script and its children, as
+        returned by os.wait4().
+        """
+        self.cpu_user = rusage.ru_utime
+        self.cpu_system = rusage.ru_stime
+        self.max_rss = rusage.ru_maxrss  # KiB on Linux
+        self.io_read = rusage.ru_inblock * 512
+        self.io_write = rusage.ru_oublock * 512
 
     def queue(self):
         """
         Fires a celery task that runs the build.
         """
         from .tasks import execute_job  # avoid circular imports
-        execute_job.delay(self.pk)
+        self.queue_date = datetime.datetime.now()
+        Job.objects.filter(pk=self.pk).update(queue_date=self.queue_date)
+        if not self.build.project.remote_agents:
+            execute_job.apply_async([self.pk], {'trace': tracing.current()},
+                                    queue=self.queue_name)
+
+    @property
+    def label_list(self):
+        return self.labels.split()
+
+    @property
+    def queue_name(self):
+        """
+        The Celery queue of the workers able to run the job.
+        """
+        return queue_name(self.label_list)
+
+    @staticmethod
+    def jobs_queue(jobs):
+        """
+        The queue of the workers able to run all of <jobs>, for sequential
+        builds.
+        """
+        return queue_name(parse_labels(' '.join([job.labels
+                                                 for job in jobs])))
+
+    @classmethod
+    def gauges(cls):
+        """
+        The queued and running jobs per project, and the queued jobs needing
+        each worker label, for metrics.render(). They're counted in the
+        database: counters would drift when workers crash or when builds
+        are deleted or queued again.
+        """
+        gauges = []
+        slugs = Project.objects.values_list('slug', flat=True)
+        pending = cls.objects.filter(status=cls.PENDING,
+                                     queue_date__isnull=False)
+        running = cls.objects.filter(status=cls.RUNNING)
+        for name, jobs in [('ci_jobs_pending', pending),
+                           ('ci_jobs_running', running)]:
+            counts = dict([
+                (row['build__project__slug'], row['count']) for row in
+                jobs.values('build__project__slug').annotate(
+                    count=models.Count('pk'))])
+            gauges.extend([(name, {'project': slug}, counts.get(slug, 0))
+                           for slug in slugs])
+
+        counts = {}
+        for text in Value.objects.values_list('labels', flat=True):
+            for label in text.split():
+                counts[label] = 0
+        for row in pending.values('labels').annotate(
+                count=models.Count('pk')):
+            for label in row['labels'].split():
+                counts[label] = counts.get(label, 0) + row['count']
+        gauges.extend([('ci_jobs_pending_by_label', {'label': label}, count)
+                       for label, count in sorted(counts.items())])
+        return gauges
+
+    @classmethod
+    def lease(cls, agent, labels=()):
+        """
+        Gives the oldest queued job of the projects run on remote agents that
+        needs no other labels than <labels> to <agent>, for
+        AGENT_LEASE_TIMEOUT seconds. Returns None if there is no job to run.
+        """
+        jobs = cls.objects.filter(
+            status=cls.PENDING, queue_date__isnull=False,
+            build__project__remote_agents=True,
+            labels__in=label_combinations(labels),
+        ).order_by('queue_date', 'pk')
+        for job in jobs[:10]:
+            expiry = datetime.datetime.now() + datetime.timedelta(
+                seconds=settings.AGENT_LEASE_TIMEOUT)
+            # Another agent may have leased it in the meantime
+            if cls.objects.filter(pk=job.pk, status=cls.PENDING).update(
+                status=cls.RUNNING, agent=agent, lease_expiry=expiry,
+            ):
+                job.agent = agent
+                job.lease_expiry = expiry
+                job.start()
+                job.output = ''
+                job.compressed = False
+                job.save()
+                return job
+
+    def renew_lease(self, agent, output=''):
+        """
+        Extends the lease of <agent> on the job and appends <output>.
+        Returns False if the agent has lost its lease.
+        """
+        job = Job.objects.get(pk=self.pk)
+        if job.status != self.RUNNING or job.agent != agent:
+            return False
+        return bool(Job.objects.filter(
+            pk=self.pk, status=self.RUNNING, agent=agent,
+        ).update(output=job.output + output,
+                 lease_expiry=datetime.datetime.now() + datetime.timedelta(
+                     seconds=settings.AGENT_LEASE_TIMEOUT)))
+
+    @classmethod
+    def expire_leases(cls):
+        """
+        Queues again the jobs of the agents that stopped sending heartbeats.
+        """
+        now = datetime.datetime.now()
+        for job in cls.objects.filter(status=cls.RUNNING,
+                                      lease_expiry__lt=now):
+            if cls.objects.filter(pk=job.pk, status=cls.RUNNING,
+                                  lease_expiry__lt=now).update(
+                status=cls.PENDING, agent='', lease_expiry=None,
+                start_date=None, queue_date=now,
+            ):
+                logger.info("Lease of %s on %s expired" % (job.agent, job))
+
+    def agent_spec(self):
+        """
+        What a remote agent needs to know to run the job.
+        """
+        project = self.build.project
+        return {
+            'id': self.pk,
+            'stage': self.stage,
+            'values': self.values,
+            'lease_timeout': settings.AGENT_LEASE_TIMEOUT,
+            'project': dict([(field, getattr(project, field)) for field in [
+                'name', 'slug', 'repo', 'repo_type', 'warm_workspace',
+                'keep_build_data']]),
+            'build': dict([(field, getattr(self.build, field)) for field in [
+                'id', 'branch', 'revision', 'build_instructions',
+                'xunit_xml_report', 'benchmark_report',
+                'cache_directories', 'stages']]),
+        }
 
     def stream_to(self, output):
         """
@@ -485,3 +1495,218 @@ function onexit() {
             datetime.datetime.now()):
             self.save()
             self.last_save = datetime.datetime.now()
+
+
+class FailureSignature(models.Model):
+    """
+    A failure seen in jobs, identified by the hash of its error message
+    stripped from what changes between runs (see parsers.normalize_failure).
+    """
+    hash = models.CharField(_('Hash'), max_length=40, unique=True)
+    text = models.TextField(_('Normalized error'))
+    first_job = models.ForeignKey(Job, verbose_name=_('First seen in'),
+                                  related_name='first_failures', null=True,
+                                  on_delete=models.SET_NULL)
+    creation_date = models.DateTimeField(_('Date created'),
+                                         default=datetime.datetime.now)
+
+    def __unicode__(self):
+        return self.title
+
+    class Meta:
+        ordering = ('-creation_date',)
+
+    @property
+    def title(self):
+        lines = self.text.splitlines()
+        return lines[-1] if lines else self.hash
+
+    def get_absolute_url(self):
+        return reverse('failure', args=[self.hash])
+
+
+class BenchmarkResult(models.Model):
+    """
+    A result of a benchmark reported by a job. Results with the same name
+    and axis values form a time series, see stats.change_points.
+    """
+    job = models.ForeignKey(Job, verbose_name=_('Job'),
+                            related_name='benchmarks')
+    name = models.CharField(_('Name'), max_length=255, db_index=True)
+    values = models.TextField(_('Values'), blank=True)
+    value = models.FloatField(_('Value'))
+
+    class Meta:
+        ordering = ('job', 'name')
+
+    @property
+    def values_data(self):
+        if self.values:
+            return json.loads(self.values)
+        return {}
+
+
+class Bisection(models.Model):
+    """
+    Looks for the first commit whose build fails between a good and a bad
+    build of a branch. Each round builds up to <width> revisions in
+    parallel, splitting the remaining range in <width> + 1 parts (k-ary
+    search).
+    """
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    STATUSES = (
+        (RUNNING, _('Running')),
+        (FINISHED, _('Finished')),
+    )
+
+    project = models.ForeignKey(Project, verbose_name=_('Project'),
+                                related_name='bisections')
+    good = models.ForeignKey(Build, verbose_name=_('Good build'),
+                             related_name='+')
+    bad = models.ForeignKey(Build, verbose_name=_('Bad build'),
+                            related_name='+')
+    commits = models.TextField(_('Commits'))
+    width = models.PositiveIntegerField(_('Builds per round'),
+                                        default=settings.BISECTION_WIDTH)
+    status = models.CharField(_('Status'), max_length=10, choices=STATUSES,
+                              default=RUNNING)
+    first_bad = models.CharField(_('First bad revision'), max_length=1023,
+                                 blank=True)
+    creation_date = models.DateTimeField(_('Date created'),
+                                         default=datetime.datetime.now)
+    end_date = models.DateTimeField(_('Date ended'), null=True)
+
+    class Meta:
+        ordering = ('-creation_date',)
+
+    def __unicode__(self):
+        return u'Bisection #%s of %s' % (self.pk, self.project.name)
+
+    def get_absolute_url(self):
+        return reverse('bisection', args=[self.project.slug, self.pk])
+
+    @property
+    def commits_data(self):
+        """
+        The commits between the good and the bad build, oldest first.
+        """
+        return json.loads(self.commits)
+
+    @property
+    def revisions(self):
+        # Mercurial changelogs hold revision numbers
+        return [unicode(commit['rev']) for commit in self.commits_data]
+
+    @property
+    def lock(self):
+        return Lock('bisection:%s' % self.pk)
+
+    def revision_states(self):
+        """
+        'success', 'failed', 'running' or 'pending' by revision, for the
+        revisions that have been built. Builds of the project made outside
+        of the bisection count too; finished builds win over unfinished
+        ones.
+        """
+        states = {}
+        for build in self.project.builds.filter(
+            revision__in=self.revisions,
+        ):
+            state = build.build_status
+            if states.get(build.revision) not in ('success', 'failed'):
+                states[build.revision] = state
+        return states
+
+    def bounds(self, states):
+        """
+        Indexes in commits_data of the last known good revision (-1 for the
+        good build) and of the first known bad one.
+        """
+        revisions = self.revisions
+        bad = len(revisions) - 1
+        for index, revision in enumerate(revisions):
+            if states.get(revision) == 'failed':
+                bad = index
+                break
+        good = -1
+        for index, revision in enumerate(revisions[:bad]):
+            if states.get(revision) == 'success':
+                good = index
+        return good, bad
+
+    def advance(self):
+        """
+        Narrows the range with the finished builds. When the builds of a
+        round are all finished, schedules the next round, or reports the
+        first bad revision.
+        """
+        with self.lock:
+            bisection = Bisection.objects.get(pk=self.pk)
+            if bisection.status != self.RUNNING:
+                return
+            commits = bisection.commits_data
+            revisions = bisection.revisions
+            states = bisection.revision_states()
+            good, bad = bisection.bounds(states)
+            if bad - good == 1:
+                Bisection.objects.filter(pk=self.pk).update(
+                    status=self.FINISHED, first_bad=revisions[bad],
+                    end_date=datetime.datetime.now(),
+                )
+                return
+            if [index for index in range(good + 1, bad)
+                if revisions[index] in states]:
+                return  # The round isn't over yet
+
+            count = min(bisection.width, bad - good - 1)
+            indexes = sorted(set([
+                good + int(round((bad - good) * part / (count + 1.)))
+                for part in range(1, count + 1)
+            ]))
+            jobs = []
+            for index in indexes:
+                jobs.append(self.project.create_build(
+                    self.bad.branch, revisions[index], [commits[index]],
+                    bisection=self,
+                ))
+        # Outside of the lock: jobs may run in this process
+        for round_jobs in jobs:
+            self.project.queue_jobs(round_jobs)
+
+
+class Span(models.Model):
+    """
+    A timed operation of a trace, see ci.tracing. Times are UNIX timestamps.
+    """
+    trace_id = models.CharField(_('Trace'), max_length=32, db_index=True)
+    span_id = models.CharField(_('Span'), max_length=16)
+    parent_id = models.CharField(_('Parent span'), max_length=16, blank=True)
+    name = models.CharField(_('Name'), max_length=255)
+    start = models.FloatField(_('Start'))
+    duration = models.FloatField(_('Duration'))
+    attributes = models.TextField(_('Attributes'), blank=True)
+
+    class Meta:
+        ordering = ('start',)
+
+    @property
+    def attributes_data(self):
+        if self.attributes:
+            return json.loads(self.attributes)
+        return {}
+
+
+@receiver(post_delete, sender=Build)
+def delete_artifacts(sender, instance, **kwargs):
+    path = os.path.dirname(instance.artifacts_path(''))
+    if os.path.exists(path):
+        move_to_trash(path)
+
+
+@receiver(post_delete, sender=Job)
+def delete_compressed_output(sender, instance, **kwargs):
+    if instance.compressed:
+        for path in [instance.log_path, logs.index_path(instance.log_path)]:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,81 @@
+import datetime
+import logging
+
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db.models import Q
+
+from ..locks import Lock
+from .models import Project
+
+logger = logging.getLogger('ci')
+
+
+def changed_branches(vcs):
+    """
+    Runs in the polling threads: no database access here.
+    """
+    try:
+        return vcs.changed_branches()
+    except Exception:
+        logger.exception("Unable to poll %s" % vcs.repo_url)
+        return []
+
+
+def poll_projects():
+    """
+    Checks the projects that are due for polling and requests a build of
+    the branches that have changed.
+
+    Repositories are checked concurrently, without fetching them. Projects
+    that change often are polled every POLL_INTERVAL_MIN seconds, quiet
+    projects every POLL_INTERVAL_MAX seconds.
+
+    Returns the list of projects for which a build has been requested.
+    """
+    lock = Lock('polling', settings.POLL_INTERVAL_MAX)
+    if not lock.acquire():
+        logger.info("Polling already in progress")
+        return []
+
+    try:
+        now = datetime.datetime.now()
+        projects = list(Project.objects.filter(poll=True).filter(
+            Q(next_poll__isnull=True) | Q(next_poll__lte=now),
+        ))
+        if not projects:
+            return []
+
+        vcs_list = [project.vcs() for project in projects]
+        pool = ThreadPool(min(settings.POLL_CONCURRENCY, len(projects)))
+        try:
+            results = pool.map(changed_branches, vcs_list)
+        finally:
+            pool.close()
+            pool.join()
+
+        changed = []
+        for project, vcs, branches in zip(projects, vcs_list, results):
+            if branches and project.build_branches == Project.DEFAULT_BRANCH:
+                branches = [b for b in branches if b == vcs.default_branch]
+
+            if branches is None or branches:
+                interval = max(settings.POLL_INTERVAL_MIN,
+                               project.poll_interval // 2)
+                refs = None
+                if branches is not None:
+                    refs = [(branch, None) for branch in branches]
+                project.request_build(refs)
+                changed.append(project)
+            else:
+                interval = min(settings.POLL_INTERVAL_MAX,
+                               project.poll_interval * 3 // 2)
+
+            Project.objects.filter(pk=project.pk).update(
+                poll_interval=interval,
+                next_poll=now + datetime.timedelta(seconds=interval),
+            )
+        return changed
+    finally:
+        lock.release()
@@ -0,0 +1,199 @@
+import anyjson as json
+import math
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of a list of numbers.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100. * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+def summarize(label, samples, keys):
+    """
+    p50 / p95 of each key of <samples>, a list of dicts.
+    """
+    return {
+        'label': label,
+        'count': len(samples),
+        'values': [{
+            'p50': percentile([s[key] for s in samples if key in s], 50),
+            'p95': percentile([s[key] for s in samples if key in s], 95),
+        } for key in keys],
+    }
+
+
+def group_stats(rows, keys):
+    """
+    Groups <rows> -- (end date, axis values, samples) tuples -- by day and by
+    axis value, and summarizes each group.
+    """
+    by_day = {}
+    by_value = {}
+    for end_date, values, samples in rows:
+        by_day.setdefault(end_date.date(), []).append(samples)
+        for item in values.items():
+            by_value.setdefault('%s=%s' % item, []).append(samples)
+    return {
+        'by_day': [summarize(day, by_day[day], keys)
+                   for day in sorted(by_day, reverse=True)],
+        'by_value': [summarize(value, by_value[value], keys)
+                     for value in sorted(by_value)],
+    }
+
+
+def timing_stats(jobs, phases):
+    """
+    Phase durations of <jobs>, a list of (end date, values, timings) tuples
+    as stored on Job.
+    """
+    rows = [(end_date, json.loads(values) if values else {},
+             json.loads(timings))
+            for end_date, values, timings in jobs if timings]
+    return group_stats(rows, phases)
+
+
+def step_stats(profiles):
+    """
+    Durations of the build steps across jobs, slowest first. <profiles> is a
+    list of profiles as stored on Job. Steps are identified by their command
+    so that they can be followed when lines are added to the build
+    instructions.
+    """
+    by_command = {}
+    for profile in profiles:
+        if not profile:
+            continue
+        for step in json.loads(profile):
+            by_command.setdefault(step['command'], []).append(step)
+    steps = [summarize(command, by_command[command], ['duration'])
+             for command in by_command]
+    return sorted(steps, key=lambda step: step['values'][0]['p50'],
+                  reverse=True)
+
+
+def resource_stats(jobs):
+    """
+    Resources used by <jobs>, a list of (end date, values, user CPU time,
+    system CPU time, max RSS, bytes read, bytes written) tuples as stored on
+    Job. Memory and I/O are converted to MiB.
+    """
+    rows = []
+    for end_date, values, user, system, rss, read, written in jobs:
+        if user is None:
+            continue
+        rows.append((end_date, json.loads(values) if values else {}, {
+            'cpu_user': user,
+            'cpu_system': system,
+            'max_rss': rss / 1024.,
+            'io_read': read / 1024. ** 2,
+            'io_write': written / 1024. ** 2,
+        }))
+    return group_stats(rows, ['cpu_user', 'cpu_system', 'max_rss',
+                              'io_read', 'io_write'])
+
+
+def waterfall(spans):
+    """
+    The spans of a trace in tree order, with their depth and their position
+    (offset and width in percents of the whole trace).
+    """
+    if not spans:
+        return []
+    ids = set([span.span_id for span in spans])
+    children = {}
+    for span in sorted(spans, key=lambda span: span.start):
+        parent = span.parent_id if span.parent_id in ids else None
+        children.setdefault(parent, []).append(span)
+    start = min([span.start for span in spans])
+    total = max([span.start + span.duration for span in spans]) - start
+    total = total or 1
+
+    rows = []
+
+    def walk(parent, depth):
+        for span in children.get(parent, []):
+            rows.append({
+                'span': span,
+                'depth': depth,
+                'offset': span.start - start,
+                'left': 100 * (span.start - start) / total,
+                'width': max(100 * span.duration / total, 0.1),
+            })
+            walk(span.span_id, depth + 1)
+    walk(None, 0)
+    return rows
+
+
+def change_points(values, min_size=3, threshold=0.05, t_min=4):
+    """
+    Indexes at which the level of a series changes, by binary segmentation:
+    the series is split where Welch's t statistic between both sides is the
+    highest, if it's above <t_min> and the means differ by more than
+    <threshold> (relative), and both sides are split again. Each side keeps
+    at least <min_size> values.
+    """
+    sums = [0.]
+    squares = [0.]
+    for value in values:
+        sums.append(sums[-1] + value)
+        squares.append(squares[-1] + value * value)
+
+    def moments(start, end):
+        count = end - start
+        mean = (sums[end] - sums[start]) / count
+        variance = ((squares[end] - squares[start]) - count * mean * mean) / (
+            count - 1)
+        return mean, max(variance, 0) / count
+
+    def split(start, end):
+        best = None
+        for index in range(start + min_size, end - min_size + 1):
+            before, before_error = moments(start, index)
+            after, after_error = moments(index, end)
+            if abs(after - before) <= threshold * abs(before):
+                continue
+            error = math.sqrt(before_error + after_error)
+            t = abs(after - before) / error if error else float('inf')
+            if t >= t_min and (best is None or t > best[0]):
+                best = (t, index)
+        if best is None:
+            return []
+        return split(start, best[1]) + [best[1]] + split(best[1], end)
+    return split(0, len(values))
+
+
+def benchmark_series(results):
+    """
+    Groups benchmark results -- (build id, name, axis values, value) tuples
+    ordered by build -- in series, and finds where their level changes.
+    """
+    series = {}
+    for build_id, name, values, value in results:
+        series.setdefault((name, values), []).append((build_id, value))
+    rows = []
+    for (name, values), points in sorted(series.items()):
+        levels = [value for build_id, value in points]
+        changes = []
+        bounds = [0] + change_points(levels) + [len(levels)]
+        for start, index, end in zip(bounds, bounds[1:-1], bounds[2:]):
+            before = sum(levels[start:index]) / (index - start)
+            after = sum(levels[index:end]) / (end - index)
+            changes.append({
+                'before': points[index - 1][0],
+                'after': points[index][0],
+                'change': (after - before) / before if before else None,
+                'regression': after > before,
+            })
+        rows.append({
+            'name': name,
+            'values': json.loads(values) if values else {},
+            'points': points,
+            'latest': levels[-1],
+            'changes': changes,
+        })
+    return rows
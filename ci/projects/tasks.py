@@ -1,29 +1,117 @@
-from celery.decorators import task
+import datetime
+import time
 
+from celery.decorators import periodic_task, task
+from django.conf import settings
+
+from .. import tracing, trash
 from ..exceptions import CommandError
-from .models import Job, Project
+from .models import Bisection, Build, Job, Project, Span
+from . import maintenance, polling, workspace
+
 
+# <trace> is the tracing context of the caller, see ci.tracing.current()
 
 @task(ignore_result=True)
-def execute_job(job_id):
-    try:
-        Job.objects.get(pk=job_id).execute()
-    except CommandError:
-        pass  # It's being reported, task is complete.
+def execute_job(job_id, trace=None):
+    with tracing.resume(trace, 'execute_job'):
+        try:
+            Job.objects.get(pk=job_id).execute()
+        except CommandError:
+            pass  # It's being reported, task is complete.
 
 
 @task(ignore_result=True)
-def execute_jobs(job_ids):
+def execute_jobs(job_ids, trace=None):
     """
     Sequential build.
     """
-    for job in Job.objects.filter(pk__in=job_ids):
-        try:
-            job.execute()
-        except CommandError:
-            pass
+    with tracing.resume(trace, 'execute_jobs'):
+        for job in Job.objects.filter(pk__in=job_ids):
+            try:
+                job.execute()
+            except CommandError:
+                pass
+
+
+@task(ignore_result=True)
+def advance_bisections(project_id):
+    for bisection in Bisection.objects.filter(project__pk=project_id,
+                                              status=Bisection.RUNNING):
+        bisection.advance()
+
+
+@task(ignore_result=True)
+def advance_pipeline(build_id):
+    Build.objects.get(pk=build_id).advance_pipeline()
+
+
+@task(ignore_result=True)
+def index_output(job_id):
+    Job.objects.get(pk=job_id).index_output()
+
+
+@task(ignore_result=True)
+def process_build_requests(project_id, trace=None):
+    with tracing.resume(trace, 'process_build_requests'):
+        Project.objects.get(pk=project_id).process_build_requests()
 
 
 @task(ignore_result=True)
 def clone_on_creation(project_id):
     Project.objects.get(pk=project_id).update_source()
+
+
+@periodic_task(
+    run_every=datetime.timedelta(seconds=settings.POLL_INTERVAL_MIN),
+    ignore_result=True)
+def poll_projects():
+    polling.poll_projects()
+
+
+@periodic_task(run_every=datetime.timedelta(hours=1), ignore_result=True)
+def maintain_repositories():
+    maintenance.maintain_repositories()
+
+
+@task(ignore_result=True, max_retries=None)
+def maintain_repository(project_id):
+    """
+    Clones waiting for a maintenance slot are tried again until the end of
+    the maintenance hours.
+    """
+    project = Project.objects.get(pk=project_id)
+    if (maintenance.maintain_repository(project) is False and
+            datetime.datetime.now().hour in settings.MAINTENANCE_HOURS):
+        maintain_repository.retry(
+            countdown=settings.MAINTENANCE_RETRY_DELAY)
+
+
+@periodic_task(run_every=datetime.timedelta(minutes=1), ignore_result=True)
+def expire_agent_leases():
+    Job.expire_leases()
+
+
+@task(ignore_result=True)
+def empty_trash():
+    trash.empty_trash()
+
+
+@periodic_task(run_every=datetime.timedelta(hours=1), ignore_result=True)
+def empty_trash_periodically():
+    """
+    Deletes what's been left behind if a worker crashed while emptying
+    the trash.
+    """
+    trash.empty_trash()
+
+
+@periodic_task(run_every=datetime.timedelta(hours=1), ignore_result=True)
+def collect_workspace_garbage():
+    workspace.collect_garbage()
+
+
+@periodic_task(run_every=datetime.timedelta(days=1), ignore_result=True)
+def expire_spans():
+    since = time.time() - settings.TRACING_RETENTION * 24 * 60 * 60
+    Span.objects.filter(start__lt=since).delete()
@@ -1,17 +1,30 @@
 import anyjson as json
+import datetime
 import os
 import shutil
 import tarfile
+import time
 
 from django.conf import settings
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 
 from celery.decorators import task
+from celery.exceptions import RetryTaskError
 
+from .. import labels, logs, metrics, pipelines, search, trash, vcs
+from ..caches import parse_cache_directories
+from ..locks import Lock
+from ..parsers import (TraceProfiler, log_sections, normalize_failure,
+                       output_failure, parse_push)
 from ..shell import Command
-from . import tasks
-from .models import Project, Configuration, Value, Build, Job
+from . import (benchmarks, loadtest, maintenance, polling, stats, tasks,
+               workspace)
+from .agent import Agent, AgentJob
+from .models import (Project, Configuration, Value, Build, Job,
+                     BuildRequest, BenchmarkResult, Bisection,
+                     FailureSignature, Span)
 
 
 class ProjectTests(TestCase):
@@ -108,6 +121,12 @@ class ProjectTests(TestCase):
         response = self.client.post(url, data)
         self.assertRedirects(response, url)
 
+        # Caches stay in the build directory
+        data['cache_directories'] = '../../other: README'
+        response = self.client.post(url, data)
+        self.assertContains(response,
+                            '../../other is outside of the build directory')
+
     def test_project_axis(self):
         """Managing multi-configuration builds"""
         self._create_project()
@@ -276,6 +295,113 @@ class ProjectTests(TestCase):
         self.assertContains(response, '0 errors')
         self.assertContains(response, 'AssertionError: False is not True')
 
+    def test_trigger_build(self):
+        """Build requests are merged while a build is scheduled"""
+        self._create_project()
+        url = reverse('project_trigger_build', args=[self.project.slug])
+
+        # Pretend a build cycle is already scheduled
+        lock = self.project.build_scheduled
+        self.assertTrue(lock.acquire())
+        self.addCleanup(lock.release)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 202)
+        response = self.client.post(url, HTTP_REFERER='http://example.com')
+        self.assertRedirects(response, reverse('project',
+                                               args=[self.project.slug]))
+        self.assertEqual(BuildRequest.objects.count(), 2)
+        self.assertEqual(Build.objects.count(), 0)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_push_payloads(self):
+        """Finding out what has been pushed"""
+        sha = 'ee9001ef213388da653486a8f59a07f4aa4cfca6'
+        self.assertEqual(parse_push({'ref': 'refs/heads/master',
+                                     'after': sha}),
+                         [('master', sha)])
+        self.assertEqual(parse_push({'ref': 'refs/heads/master',
+                                     'after': '0' * 40, 'deleted': True}),
+                         [])
+        self.assertEqual(parse_push({'ref': 'refs/tags/1.0', 'after': sha}),
+                         [])
+        self.assertEqual(parse_push({'ref': 'foo'}), [('foo', None)])
+        self.assertEqual(parse_push({'commits': [
+            {'branch': 'default', 'raw_node': 'a' * 40},
+            {'branch': 'stable', 'raw_node': 'b' * 40},
+            {'branch': 'default', 'raw_node': 'c' * 40},
+        ]}), [('default', 'c' * 40), ('stable', 'b' * 40)])
+        self.assertEqual(parse_push({}), None)
+
+    def test_normalize_url(self):
+        """Different spellings of the same repository URL"""
+        urls = [
+            'git@github.com:brutasse/ci.git',
+            'ssh://git@github.com/brutasse/ci',
+            'https://GitHub.com/brutasse/ci/',
+            'git://github.com/brutasse/ci.git',
+        ]
+        for url in urls:
+            self.assertEqual(vcs.normalize_url(url), 'github.com/brutasse/ci')
+        self.assertEqual(vcs.normalize_url('file:///tmp/repo'), '/tmp/repo')
+        self.assertEqual(vcs.normalize_url('/tmp/repo/.git'), '/tmp/repo')
+        self.assertNotEqual(vcs.mirror_name('git', urls[0]),
+                            vcs.mirror_name('hg', urls[0]))
+
+    def test_trace_profiler(self):
+        profiler = TraceProfiler(3, 5)
+        profiler.feed('+1: header\n+3: make\nmaking\n', now=10)
+        profiler.feed('++3: nested\n', now=12)
+        profiler.feed('+4: test\n+9: exit 0\n', now=15)
+        profiler.feed('+5: late\n', now=16)
+        profiler.finish(now=20)
+        self.assertEqual(profiler.steps, [(1, 1, 5), (2, 1, 0), (3, 1, 4)])
+
+    def test_command_interrupted(self):
+        """Commands are killed when their output handler raises"""
+        def stream_to(output):
+            raise ValueError("Stop")
+
+        started = time.time()
+        self.assertRaises(ValueError, Command,
+                          'echo started && sleep 60', stream_to=stream_to)
+        self.assertTrue(time.time() - started < 30)
+
+    def test_failure_normalization(self):
+        output = '\n'.join([
+            'Running tests',
+            'Traceback (most recent call last):',
+            '  File "/srv/ci/workspace/builds/12/app/tests.py", line 42, in t',
+            '    foo(0x7f3a2c)',
+            'ValueError: bad value in /tmp/tmpa8Xz/data after 1.25s',
+            'More output',
+            '[CI] Error while running the tests',
+            '+3: exit 1',
+        ])
+        text = output_failure(output)
+        self.assertEqual(text.splitlines()[0],
+                         'Traceback (most recent call last):')
+        self.assertEqual(text.splitlines()[-1],
+                         'ValueError: bad value in /tmp/tmpa8Xz/data after '
+                         '1.25s')
+        build_path = '/srv/ci/workspace/builds/12'
+        self.assertEqual(normalize_failure(text, [build_path]),
+                         'Traceback (most recent call last):\n'
+                         'File "<build>/app/tests.py", line ?, in t\n'
+                         'foo(0x?)\n'
+                         'ValueError: bad value in <tmp> after ?s')
+        self.assertEqual(output_failure('make: *** [all] Error 2\nbye'),
+                         'make: *** [all] Error 2')
+        self.assertEqual(output_failure('all good\n'), None)
+
+    def test_percentiles(self):
+        values = range(1, 101)
+        self.assertEqual(stats.percentile(values, 50), 50)
+        self.assertEqual(stats.percentile(values, 95), 95)
+        self.assertEqual(stats.percentile([3], 95), 3)
+        self.assertEqual(stats.percentile([], 50), None)
+
     def test_duplicate_slug(self):
         url = reverse('add_project')
         data = {
@@ -329,6 +455,22 @@ class ProjectTests(TestCase):
         self.assertEqual(response.status_code, 302)
 
 
+class ClientAgent(Agent):
+    """
+    An agent talking to the server through the test client.
+    """
+    def __init__(self, client, name):
+        super(ClientAgent, self).__init__('/', 'secret', name, wait=0)
+        self.client = client
+
+    def request(self, path, data):
+        response = self.client.post(
+            self.url + path, json.dumps(dict(data, agent=self.name)),
+            content_type='application/json', HTTP_X_CI_TOKEN=self.token)
+        return response.status_code, (json.loads(response.content)
+                                      if response.content else None)
+
+
 class GitBuildTest(TestCase):
     """
     Tests for actual build execution, with a git repository.
@@ -351,12 +493,21 @@ class GitBuildTest(TestCase):
         self._clean_data()
 
     def _clean_data(self):
-        to_remove = [os.path.join(settings.WORKSPACE, 'repos')] + [
+        to_remove = [os.path.join(settings.WORKSPACE, 'repos'),
+                     os.path.join(settings.WORKSPACE, 'caches'),
+                     os.path.join(settings.WORKSPACE, 'warm'),
+                     os.path.join(settings.WORKSPACE, 'locks'),
+                     os.path.join(settings.WORKSPACE, 'trash'),
+                     settings.LOGS_ROOT] + [
             os.path.join(self.data_dir, repo) for repo in self.repos
         ]
         for directory in to_remove:
             if os.path.exists(directory):
                 shutil.rmtree(directory)
+        for suffix in ['', '-wal', '-shm']:
+            index = os.path.join(settings.WORKSPACE, 'search.sqlite' + suffix)
+            if os.path.exists(index):
+                os.remove(index)
 
     def _create_project(self):
         self.project = Project.objects.create(
@@ -368,11 +519,44 @@ class GitBuildTest(TestCase):
 
     def test_clone_project(self):
         """Cloning a project after its creation"""
-        checkout_path = os.path.join(settings.WORKSPACE, 'repos',
-                                     self.git_name)
-        self.assertFalse(os.path.exists(checkout_path))
+        repos = os.path.join(settings.WORKSPACE, 'repos')
+        self.assertFalse(os.path.exists(repos))
+        self._create_project()
+        self.assertTrue(os.path.exists(self.project.cache_dir))
+        self.assertEqual(os.path.dirname(self.project.cache_dir), repos)
+
+    def test_shared_mirrors(self):
+        """Projects tracking the same repository share their clone"""
         self._create_project()
-        self.assertTrue(os.path.exists(checkout_path))
+        other = Project.objects.create(
+            name='other', slug='other',
+            repo='file://%s/' % self.project.repo,
+            build_instructions='echo 1',
+        )
+        self.assertEqual(other.cache_dir, self.project.cache_dir)
+        self.assertEqual(os.listdir(os.path.dirname(other.cache_dir)),
+                         [os.path.basename(other.cache_dir)])
+
+        # Forks borrow objects from the upstream clone
+        fork_dir = os.path.join(self.data_dir, 'fork')
+        self.addCleanup(shutil.rmtree, fork_dir)
+        Command('git clone %s %s' % (self.project.repo,
+                                     os.path.join(fork_dir, self.git_name)))
+        fork = Project.objects.create(
+            name='fork', slug='fork',
+            repo=os.path.join(fork_dir, self.git_name),
+            upstream=self.project, build_instructions='echo 1',
+        )
+        self.assertNotEqual(fork.cache_dir, self.project.cache_dir)
+        with open(os.path.join(fork.cache_dir, '.git', 'objects', 'info',
+                               'alternates')) as f:
+            self.assertTrue(self.project.cache_dir in f.read())
+        self.assertTrue(fork.build())
+
+        # Not repositories that only share the name
+        namesake = Project(name='namesake', slug='namesake',
+                           repo=os.path.join(fork_dir, 'other', self.git_name))
+        self.assertEqual(namesake.related_mirror, None)
 
     def test_build_project(self):
         """Building a project"""
@@ -391,6 +575,991 @@ class GitBuildTest(TestCase):
         # Re-building the last build
         self.project.builds.get().queue()
 
+    def test_trigger_build(self):
+        """Triggering a build asynchronously"""
+        self._create_project()
+        url = reverse('project_trigger_build', args=[self.project.slug])
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(Build.objects.count(), 1)
+        self.assertEqual(BuildRequest.objects.count(), 0)
+        self.assertFalse(self.project.build_lock.locked)
+
+    def test_trigger_pushed_branch(self):
+        """Only pushed branches are built"""
+        self._create_project()
+        self.project.build_branches = Project.ALL_BRANCHES
+        self.project.save()
+        self.project.build()
+        self.assertEqual(Build.objects.count(), 1)
+
+        Command(
+            ('git checkout -b foo && '
+             'echo "yay" >> README && '
+             'git commit -am "Added stuff to branch foo" && '
+             'git checkout master && '
+             'echo "foobar" >> README && '
+             'git commit -am "More instructions"'),
+            cwd=self.project.repo,
+        )
+        url = reverse('project_trigger_build', args=[self.project.slug])
+        response = self.client.post(url, {'ref': 'foo'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(Build.objects.count(), 2)
+        self.assertEqual(self.project.builds.all()[0].branch, 'foo')
+
+        # GitHub-style payload
+        sha = Command('git rev-parse master', cwd=self.project.repo).out
+        payload = {'ref': 'refs/heads/master', 'after': sha.strip()}
+        self.client.post(url, {'payload': json.dumps(payload)})
+        self.assertEqual(Build.objects.count(), 3)
+        self.assertEqual(self.project.builds.all()[0].revision, sha.strip())
+
+        # Already built: nothing is scheduled
+        self.assertFalse(self.project.request_build([('master',
+                                                      sha.strip())]))
+        self.assertEqual(BuildRequest.objects.count(), 0)
+
+    def test_polling(self):
+        """Polling upstream repositories for changes"""
+        self._create_project()
+        self.project.repo = 'file://' + self.project.repo
+        self.project.save()
+        self.assertEqual(polling.poll_projects(), [])
+        project = Project.objects.get()
+        self.assertTrue(project.poll_interval > settings.POLL_INTERVAL_MIN)
+        self.assertTrue(project.next_poll > datetime.datetime.now())
+
+        # Not due yet
+        Command('echo "yay" >> README && git commit -am "Stuff"',
+                cwd=self.project.repo[7:])
+        self.assertEqual(polling.poll_projects(), [])
+
+        Project.objects.update(next_poll=None)
+        self.assertEqual(polling.poll_projects(), [project])
+        self.assertEqual(Build.objects.count(), 1)
+        self.assertEqual(Project.objects.get().poll_interval,
+                         settings.POLL_INTERVAL_MIN)
+
+        # Mercurial
+        hg_project = Project.objects.create(
+            name='hgrepo',
+            slug='hgrepo',
+            repo='file://' + os.path.join(self.data_dir, self.hg_name),
+            repo_type=Project.HG,
+            build_instructions='echo 1',
+        )
+        vcs = hg_project.vcs()
+        self.assertEqual(vcs.changed_branches(), [])
+        Command('hg branch foo && hg ci -m "Creating branch foo"',
+                cwd=hg_project.repo[7:])
+        self.assertEqual(vcs.changed_branches(), ['foo'])
+
+    def test_maintenance(self):
+        """Repacking and verifying local clones"""
+        self._create_project()
+        hg_project = Project.objects.create(
+            name='hgrepo',
+            slug='hgrepo',
+            repo=os.path.abspath(os.path.join(self.data_dir, self.hg_name)),
+            repo_type=Project.HG,
+            build_instructions='echo 1',
+        )
+        night = datetime.datetime.now().replace(
+            hour=settings.MAINTENANCE_HOURS[0],
+        )
+        day = night.replace(hour=12)
+        self.assertEqual(maintenance.maintain_repositories(day), [])
+        self.assertEqual(Project.objects.filter(
+            maintenance_date__isnull=True).count(), 2)
+
+        self.assertEqual(len(maintenance.maintain_repositories(night)), 2)
+        self.assertEqual(Project.objects.filter(
+            maintenance_status=Job.SUCCESS).count(), 2)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.project.cache_dir, '.git', 'objects', 'info',
+            'commit-graph',
+        )))
+        self.assertEqual(maintenance.maintain_repositories(night), [])
+
+        # Busy clones are skipped, and tried again by the task
+        with hg_project.mirror_lock:
+            self.assertFalse(maintenance.maintain_repository(hg_project))
+        self.assertEqual(maintenance.maintain_repository(
+            Project.objects.get(pk=hg_project.pk)), None)
+        Project.objects.update(maintenance_date=None)
+        hours = settings.MAINTENANCE_HOURS
+        settings.MAINTENANCE_HOURS = range(24)
+        slots = [Lock('maintenance:%s' % slot)
+                 for slot in range(settings.MAINTENANCE_CONCURRENCY)]
+        try:
+            for slot in slots:
+                self.assertTrue(slot.acquire())
+            self.assertRaises(RetryTaskError, tasks.maintain_repository,
+                              hg_project.pk)
+        finally:
+            settings.MAINTENANCE_HOURS = hours
+            for slot in slots:
+                slot.release()
+
+    def test_dependency_cache(self):
+        """Cache directories are kept between builds"""
+        self._create_project()
+        self.project.build_instructions = (
+            'if [ -f .deps/stamp ]; then echo "CACHE HIT"; '
+            'else mkdir .deps && touch .deps/stamp; fi'
+        )
+        self.project.cache_directories = '.deps: README\n'
+        self.project.save()
+        self.project.build()
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.SUCCESS)
+        self.assertTrue('[CI] Saved cache .deps' in job.get_output())
+        self.assertFalse('CACHE HIT' in job.get_output())
+
+        self.project.builds.get().queue()
+        job = Job.objects.get()
+        self.assertTrue('[CI] Restored cache .deps' in job.get_output())
+        self.assertTrue('CACHE HIT' in job.get_output())
+
+        # Key files changed: new cache
+        Command('echo "yay" >> README && git commit -am "Stuff"',
+                cwd=self.project.repo)
+        self.project.build()
+        job = Job.objects.all()[0]
+        self.assertTrue('[CI] No cache for .deps' in job.get_output())
+        self.assertEqual(len(job.cache_store().archives()), 2)
+
+        # LRU eviction
+        store = job.cache_store()
+        store.max_size = store.archives()[-1][1]
+        store.evict()
+        self.assertEqual(len(store.archives()), 1)
+
+        # Nothing is saved or restored outside of the build directory
+        for text in ['/home/ci/.ssh: x', 'deps: ../setup.py']:
+            self.assertRaises(ValueError, parse_cache_directories, text)
+        target = os.path.join(settings.WORKSPACE, 'outside')
+        for names in [['../outside'], ['link', 'link/outside']]:
+            with tarfile.open(store.path('evil'), 'w:gz') as archive:
+                for name in names:
+                    member = tarfile.TarInfo(name)
+                    if name == 'link':
+                        member.type = tarfile.SYMTYPE
+                        member.linkname = settings.WORKSPACE
+                    archive.addfile(member)
+            self.assertRaises(tarfile.TarError, store.restore, 'evil',
+                              job.build_path, 'deps')
+            self.assertFalse(os.path.exists(target))
+
+    def test_warm_workspace(self):
+        """Reusing workspaces between jobs"""
+        self._create_project()
+        Command('echo "out/" > .gitignore && git add .gitignore && '
+                'git commit -m "Ignore build outputs"', cwd=self.project.repo)
+        self.project.warm_workspace = True
+        self.project.build_instructions = (
+            'if [ -f out/built ]; then echo "WARM"; fi\n'
+            'if [ -f untracked ]; then echo "DIRTY"; fi\n'
+            'mkdir -p out && touch out/built untracked'
+        )
+        self.project.save()
+        self.project.build()
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.SUCCESS)
+        self.assertFalse('WARM' in job.get_output())
+        self.assertTrue(os.path.exists(job.workspace))
+        self.assertFalse(job.workspace_lease.locked)
+
+        self.project.builds.get().queue()
+        job = Job.objects.get()
+        self.assertTrue('WARM' in job.get_output())
+        self.assertTrue('[CI] Updating...' in job.get_output())
+        self.assertFalse('DIRTY' in job.get_output())
+
+        # Leased workspaces aren't shared
+        workspace = job.workspace
+        job.workspace_lease.acquire()
+        self.project.builds.get().queue()
+        job = Job.objects.get()
+        self.assertNotEqual(job.workspace, workspace)
+        self.assertFalse('WARM' in job.get_output())
+
+    def test_trash(self):
+        """Build data is deleted in the background"""
+        # Left behind by a crashed worker
+        leftover = os.path.join(trash.trash_dir(), 'leftover', 'sub')
+        os.makedirs(leftover)
+        open(os.path.join(leftover, 'file'), 'w').close()
+        os.symlink(leftover, os.path.join(trash.trash_dir(), 'link'))
+
+        self._create_project()
+        self.project.build()
+        job = Job.objects.get()
+        self.assertFalse(os.path.exists(job.build_path))
+        self.assertEqual(os.listdir(trash.trash_dir()), [])
+
+    def test_workspace_gc(self):
+        """Keeping the workspace under its disk budget"""
+        self._create_project()
+        self.project.keep_build_data = True
+        self.project.cache_directories = '.deps: README'
+        self.project.build_instructions = 'mkdir .deps && echo 1 > .deps/a'
+        self.project.save()
+        self.project.build()
+        job = Job.objects.get()
+        self.assertTrue(os.path.exists(job.build_path))
+
+        # Leftover from a crashed job
+        crashed = os.path.join(settings.WORKSPACE, 'builds', '999999')
+        os.makedirs(crashed)
+        with open(os.path.join(crashed, 'data'), 'w') as f:
+            f.write('x' * 1024)
+        self.addCleanup(shutil.rmtree, crashed, True)
+
+        usage = workspace.usage_stats(workspace.scan())
+        self.assertEqual(usage['orphans'], 1024)
+        self.assertEqual(usage['projects'][0]['slug'], self.project.slug)
+        self.assertTrue(usage['projects'][0]['caches'] > 0)
+
+        limit = settings.WORKSPACE_SIZE_LIMIT
+        settings.WORKSPACE_SIZE_LIMIT = 0
+        try:
+            evicted = workspace.collect_garbage()
+        finally:
+            settings.WORKSPACE_SIZE_LIMIT = limit
+        self.assertEqual([item.kind for item in evicted],
+                         ['builds', 'caches', 'builds'])
+        self.assertEqual(evicted[0].path, crashed)
+        self.assertEqual(evicted[2].path, job.build_path)
+        self.assertFalse(os.path.exists(job.build_path))
+        self.assertTrue(os.path.exists(self.project.cache_dir))
+
+        response = self.client.get(reverse('workspace_usage'))
+        self.assertContains(response, self.project.slug)
+
+    def test_workspace_gc_borrowed_mirror(self):
+        """Clones borrowed from by forks are kept after their project"""
+        self._create_project()
+        fork_dir = os.path.join(self.data_dir, 'fork')
+        self.addCleanup(shutil.rmtree, fork_dir)
+        Command('git clone %s %s' % (self.project.repo,
+                                     os.path.join(fork_dir, self.git_name)))
+        fork = Project.objects.create(
+            name='fork', slug='fork',
+            repo=os.path.join(fork_dir, self.git_name),
+            upstream=self.project, build_instructions='echo 1',
+        )
+        upstream = self.project.cache_dir
+        self.project.delete()
+
+        limit = settings.WORKSPACE_SIZE_LIMIT
+        settings.WORKSPACE_SIZE_LIMIT = 0
+        try:
+            evicted = workspace.collect_garbage()
+        finally:
+            settings.WORKSPACE_SIZE_LIMIT = limit
+        self.assertFalse(upstream in [item.path for item in evicted])
+        self.assertTrue(os.path.exists(upstream))
+        self.assertTrue(fork.build())
+        self.assertEqual(Job.objects.get().status, Job.SUCCESS)
+
+    def test_timings(self):
+        """Timing each phase of the jobs"""
+        self._create_project()
+        self.project.configurations.create(key='python').values.create(
+            value='py27',
+        )
+        self.project.build()
+        job = Job.objects.get()
+        self.assertTrue(job.queue_date <= job.start_date)
+        self.assertEqual([name for name, duration in job.timings_data],
+                         [name for phase, name in Job.PHASES])
+
+        url = reverse('project_job', args=[self.project.slug, job.build_id,
+                                           job.pk])
+        self.assertContains(self.client.get(url), 'Build script')
+
+        url = reverse('project_timings', args=[self.project.slug])
+        response = self.client.get(url)
+        self.assertContains(response, 'python=py27')
+        self.assertEqual(response.context['timings']['by_day'][0]['count'],
+                         1)
+        for days, expected in [('abc', 30), ('99999999999', 3650),
+                               ('-5', 1)]:
+            response = self.client.get(url, {'days': days})
+            self.assertEqual(response.context['days'], expected)
+
+    def test_profile(self):
+        """Build steps profile"""
+        self._create_project()
+        self.project.build_instructions = ('# Comment\r\n'
+                                           'for i in 1 2; do\r\n'
+                                           '    sleep 0.2\r\n'
+                                           'done\r\n'
+                                           'false\r\n'
+                                           'echo done')
+        self.project.save()
+        self.project.build()
+        job = Job.objects.get()
+        self.assertEqual(job.status, job.FAILURE)
+        self.assertEqual([(s['line'], s['command'], s['runs'])
+                          for s in job.profile_data],
+                         [(2, 'for i in 1 2; do', 2),
+                          (3, 'sleep 0.2', 2),
+                          (5, 'false', 1),
+                          (6, 'echo done', 1)])
+        self.assertTrue(job.profile_data[1]['duration'] >= 0.4)
+
+        url = reverse('project_timings', args=[self.project.slug])
+        response = self.client.get(url)
+        self.assertEqual(response.context['steps'][0]['label'], 'sleep 0.2')
+
+    def test_resource_usage(self):
+        """CPU, memory and I/O used by the build script"""
+        self._create_project()
+        self.project.build_instructions = (
+            'python -c "x = \'a\' * 50 * 1024 ** 2; sum(range(10 ** 6))"'
+        )
+        self.project.save()
+        self.project.configurations.create(key='python').values.create(
+            value='py27',
+        )
+        self.project.build()
+        job = Job.objects.get()
+        self.assertEqual(job.status, job.SUCCESS)
+        self.assertTrue(job.cpu_user > 0)
+        self.assertTrue(job.cpu_system >= 0)
+        self.assertTrue(job.max_rss > 50 * 1024)
+        self.assertTrue(job.io_read >= 0)
+
+        url = reverse('project_job', args=[self.project.slug, job.build_id,
+                                           job.pk])
+        self.assertContains(self.client.get(url), 'Max. RSS')
+
+        url = reverse('project_timings', args=[self.project.slug])
+        response = self.client.get(url)
+        usage = response.context['usage']['by_value'][0]
+        self.assertEqual(usage['label'], 'python=py27')
+        self.assertTrue(usage['values'][2]['p50'] > 50)
+
+    def test_metrics(self):
+        """Monitoring counters"""
+        metrics._store = None
+        self._create_project()
+        self.project.build()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'],
+                         'text/plain; version=0.0.4')
+        for line in ['ci_builds_total{project="gitrepo"} 1',
+                     'ci_jobs_pending{project="gitrepo"} 0',
+                     'ci_jobs_running{project="gitrepo"} 0',
+                     'ci_jobs_finished_total{project="gitrepo",'
+                     'status="success"} 1',
+                     'ci_job_duration_seconds_count{project="gitrepo"} 1',
+                     'ci_job_queue_wait_seconds_bucket{le="+Inf",'
+                     'project="gitrepo"} 1',
+                     'ci_vcs_fetch_seconds_count{vcs="git"} ']:
+            self.assertContains(response, line)
+
+        # Gauges are counted, they don't drift with crashed workers or
+        # deleted builds
+        metrics.incr('ci_jobs_running', {'project': 'gitrepo'})
+        self.project.remote_agents = True
+        self.project.save()
+        self.project.builds.get().queue()
+        self.project.builds.get().queue()
+        response = self.client.get(reverse('metrics'))
+        self.assertContains(response, 'ci_jobs_pending{project="gitrepo"} 1')
+        self.assertContains(response, 'ci_jobs_running{project="gitrepo"} 0')
+        self.project.builds.all().delete()
+        response = self.client.get(reverse('metrics'))
+        self.assertContains(response, 'ci_jobs_pending{project="gitrepo"} 0')
+
+    def test_benchmarks(self):
+        """Benchmarks on synthetic repositories"""
+        root = os.path.join(settings.WORKSPACE, 'benchmarks')
+        os.makedirs(root)
+        try:
+            results = benchmarks.run(root, scale=0.02, repeat=1)
+        finally:
+            shutil.rmtree(root)
+        self.assertEqual(len(results['results']), 10)
+        self.assertEqual(results['sizes']['commits'], 10)
+
+        baseline = json.loads(json.dumps(results))
+        self.assertEqual(benchmarks.compare(baseline, results), [])
+        baseline['results']['view_job']['queries'] -= 1
+        baseline['results']['xunit_parser']['seconds'] = 0
+        results['results']['xunit_parser']['seconds'] = 1
+        self.assertEqual(len(benchmarks.compare(baseline, results)), 2)
+
+    def test_load_test(self):
+        """Load test harness"""
+        root = os.path.join(settings.WORKSPACE, 'loadtest')
+        os.makedirs(root)
+        try:
+            report = loadtest.run(root, projects=3, pushes=6, rate=100,
+                                  timeout=5)
+        finally:
+            shutil.rmtree(root)
+        self.assertEqual(report['builds'], 6)
+        self.assertEqual(report['unfinished'], 0)
+        self.assertEqual(report['trigger_to_finish']['count'], 6)
+        self.assertTrue(report['trigger_to_start']['p50'] <=
+                        report['trigger_to_finish']['p50'])
+        loadtest.clean()
+        self.assertFalse(Project.objects.exists())
+
+    def test_tracing(self):
+        """Tracing builds from the trigger to the end of the jobs"""
+        self._create_project()
+        otlp = os.path.join(settings.WORKSPACE, 'spans.json')
+        if os.path.exists(otlp):
+            os.remove(otlp)
+        settings.TRACING_OTLP_FILE = otlp
+        try:
+            url = reverse('project_trigger_build', args=[self.project.slug])
+            self.client.post(url)
+        finally:
+            settings.TRACING_OTLP_FILE = None
+        build = Build.objects.get()
+        self.assertEqual(len(build.trace_id), 32)
+        spans = Span.objects.filter(trace_id=build.trace_id)
+        names = [span.name for span in spans]
+        for name in ['project_trigger_build', 'queue',
+                     'process_build_requests', 'Project.build',
+                     'update_source', 'build_branch', 'changelog',
+                     'create_jobs', 'execute_jobs', 'Job.execute', 'checkout',
+                     'script', 'Command']:
+            self.assertTrue(name in names, name)
+        root = spans.get(name='project_trigger_build')
+        self.assertEqual(root.parent_id, '')
+        self.assertEqual(spans.get(name='Job.execute').parent_id,
+                         spans.get(name='execute_jobs').span_id)
+
+        with open(otlp) as f:
+            batches = [json.loads(line) for line in f]
+        os.remove(otlp)
+        exported = batches[0]['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertEqual(len(exported), spans.count())
+        self.assertEqual(exported[0]['traceId'], build.trace_id)
+
+        url = reverse('build_trace', args=[self.project.slug, build.pk])
+        response = self.client.get(url)
+        rows = response.context['spans']
+        self.assertEqual(rows[0]['span'].name, 'project_trigger_build')
+        self.assertEqual(rows[0]['depth'], 0)
+        self.assertContains(response, 'Job.execute')
+
+    def test_failure_signatures(self):
+        """Failures are grouped by signature"""
+        self._create_project()
+        self.project.build_instructions = (
+            'python -c "import tempfile; raise ValueError(tempfile.mkdtemp())"'
+        )
+        self.project.save()
+        self.project.build()
+        other = Project.objects.create(
+            name='other', slug='other', repo=self.project.repo,
+            build_instructions=self.project.build_instructions,
+        )
+        other.build()
+
+        signature = FailureSignature.objects.get()
+        self.assertEqual(signature.title, 'ValueError: <tmp>')
+        first_job = self.project.builds.get().jobs.get()
+        self.assertEqual(signature.first_job, first_job)
+        self.assertEqual(signature.jobs.count(), 2)
+
+        response = self.client.get(reverse('failures'))
+        failure = response.context['object_list'][0]
+        self.assertEqual(failure.job_count, 2)
+        self.assertEqual(failure.project_count, 2)
+
+        response = self.client.get(signature.get_absolute_url())
+        self.assertContains(response, 'across 2 projects')
+
+        url = reverse('project_job', args=[self.project.slug,
+                                           first_job.build_id, first_job.pk])
+        self.assertContains(self.client.get(url), signature.get_absolute_url())
+
+    def test_compressed_output(self):
+        """Finished outputs are stored compressed, outside of the database"""
+        self._create_project()
+        self.project.build_instructions = (
+            'python -c "for i in range(5000): print(\'line %s\' % i)"')
+        self.project.save()
+        self.project.build()
+        job = Job.objects.get()
+        self.assertTrue(job.compressed)
+        self.assertEqual(job.output, '')
+        self.assertTrue(os.path.getsize(job.log_path) < 20000)
+        output = job.get_output()
+        self.assertTrue('line 0\nline 1\n' in output)
+        self.assertTrue('line 4999\n' in output)
+        self.assertEqual(job.get_output_tail(100), output[-100:])
+
+        # Blocks hold whole lines, the tail is read from the last ones
+        path = os.path.join(settings.LOGS_ROOT, 'blocks.z')
+        logs.write(path, output, block_size=1000)
+        with open(path, 'rb') as f:
+            self.assertTrue(len(list(logs.blocks(f))) > 40)
+        chunks = list(logs.read(path))
+        self.assertEqual(''.join(chunks), output)
+        self.assertTrue(all(chunk.endswith('\n') for chunk in chunks))
+        self.assertEqual(''.join(logs.read(path, tail=10)), chunks[-1])
+
+        url = reverse('project_job', args=[self.project.slug,
+                                           job.build_id, job.pk])
+        self.assertContains(self.client.get(url), 'line 4999')
+        url = reverse('project_job_output', args=[self.project.slug,
+                                                  job.build_id, job.pk])
+        response = self.client.get(url, {'download': ''})
+        self.assertEqual(response.content, output)
+        self.assertTrue('attachment' in response['Content-Disposition'])
+        response = self.client.get(url, {'tail': 100})
+        self.assertEqual(response.content, output[-100:])
+        self.assertEqual(self.client.get(url, {'tail': 'x'}).status_code,
+                         404)
+
+        # Outputs stored before are compressed by the command
+        # Not the ones of the jobs queued again
+        Job.objects.update(output=output, compressed=False,
+                           status=Job.PENDING)
+        call_command('compress_logs')
+        self.assertFalse(Job.objects.get().compressed)
+        Job.objects.update(status=Job.SUCCESS)
+        call_command('compress_logs')
+        job = Job.objects.get()
+        self.assertTrue(job.compressed)
+        self.assertEqual(job.get_output(), output)
+
+        job.build.delete()
+        self.assertFalse(os.path.exists(job.log_path))
+
+    def test_log_window(self):
+        """Outputs are displayed by pages of lines"""
+        self._create_project()
+        self.project.build_instructions = '\n'.join([
+            'python -c "for i in range(2500): print(\'line %s\' % i)"',
+            'echo "fatal: broken"',
+            'echo done',
+        ])
+        self.project.save()
+        self.project.build()
+        job = Job.objects.get()
+        lines = job.get_output().splitlines()
+        self.assertEqual(lines[job.first_error_line], 'fatal: broken')
+        self.assertEqual(job.get_lines(2, 3), (lines[2:5], len(lines)))
+        self.assertEqual(job.failure_texts(), [('', 'fatal: broken')])
+
+        url = reverse('project_job', args=[self.project.slug,
+                                           job.build_id, job.pk])
+        response = self.client.get(url)
+        log = response.context['log']
+        self.assertEqual((log['start'], log['end'], log['total']),
+                         (len(lines) - 999, len(lines), len(lines)))
+        self.assertFalse(log['next'])
+        self.assertEqual(log['first_error'], job.first_error_line + 1)
+        self.assertContains(response, '<span id="L%s" class="error">' %
+                            log['first_error'])
+
+        response = self.client.get(url, {'start': 1})
+        log = response.context['log']
+        self.assertEqual((log['start'], log['end'], log['next']),
+                         (1, 1000, 1001))
+        self.assertFalse(log['previous'])
+        self.assertEqual(log['sections'][0]['title'], (1, '[CI] Cloning...'))
+        self.assertContains(response, '<details open>', 2)
+
+        # Logs compressed without an index are indexed on the first read
+        path = os.path.join(settings.LOGS_ROOT, 'blocks.z')
+        logs.write(path, '\n'.join(lines), block_size=100)
+        os.remove(logs.index_path(path))
+        self.assertEqual(logs.read_lines(path, 1234, 3),
+                         (lines[1234:1237], len(lines)))
+        self.assertTrue(os.path.exists(logs.index_path(path)))
+        self.assertEqual(logs.read_lines(path, len(lines) - 1, 10),
+                         (lines[-1:], len(lines)))
+
+        self.assertEqual(log_sections(['a', '[CI] b', 'c'], 10), [
+            {'title': None, 'lines': [(11, 'a')]},
+            {'title': (12, '[CI] b'), 'lines': [(13, 'c')]},
+        ])
+
+    def test_benchmark_results(self):
+        """Benchmark results are collected and their changes flagged"""
+        self._create_project()
+        self.project.benchmark_report = 'bench.json'
+        self.project.build_instructions = (
+            'echo \'{"benchmarks": [{"name": "test_a", "fullname": '
+            '"tests.py::test_a", "stats": {"mean": 0.5}}]}\' > bench.json')
+        self.project.save()
+        self.project.build()
+        result = BenchmarkResult.objects.get()
+        self.assertEqual((result.name, result.value), ('tests.py::test_a', .5))
+
+        # A missing report doesn't fail the build
+        build = self.project.builds.get()
+        build.benchmark_report = 'missing.json'
+        build.save()
+        build.queue()
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.SUCCESS)
+        self.assertTrue('[CI] Unable to read the benchmarks' in
+                        job.get_output())
+        self.assertEqual(BenchmarkResult.objects.count(), 0)
+
+        levels = [1, 1.01, .99, 1, 1, 1.01, 1.5, 1.51, 1.49, 1.5, 1.5]
+        self.assertEqual(stats.change_points(levels), [6])
+        self.assertEqual(stats.change_points(levels[:6]), [])
+        for index, level in enumerate(levels):
+            build = Build.objects.create(
+                project=self.project, revision='rev%s' % index,
+                branch='master', build_instructions='true', history=json.dumps(
+                    [{'rev': 'rev%s' % index, 'message': 'Commit %s' % index,
+                      'author': 'Me', 'files': []}]),
+            )
+            job = build.jobs.create(values=json.dumps({'PYTHON': '2.7'}))
+            job.benchmarks.create(name='bench', values=job.values,
+                                  value=level)
+
+        response = self.client.get(reverse('project_benchmarks',
+                                           args=[self.project.slug]))
+        [row] = [row for row in response.context['series']
+                 if row['name'] == 'bench']
+        self.assertEqual(row['values'], {'PYTHON': '2.7'})
+        [change] = row['changes']
+        self.assertTrue(change['regression'])
+        self.assertAlmostEqual(change['change'], .5, 1)
+        self.assertEqual([commit['rev'] for commit in change['commits']],
+                         ['rev6'])
+        self.assertContains(response, 'Commit 6')
+
+    def test_bisection(self):
+        """Finding the first bad commit, k revisions at a time"""
+        self._create_project()
+        self.project.build_instructions = 'test ! -f broken'
+        self.project.save()
+        self.project.build()
+        good = self.project.builds.get()
+        shas = []
+        for index in range(7):
+            Command('touch %s %s && git add . && git commit -m "Commit %s"' % (
+                'file%s' % index, 'broken' if index == 3 else '', index,
+            ), cwd=self.project.repo)
+            shas.append(Command('git rev-parse HEAD',
+                                cwd=self.project.repo).out.strip())
+        self.project.build()
+        bad = self.project.builds.latest('pk')
+        self.assertEqual(bad.build_status, 'failed')
+        self.assertEqual([commit['rev'] for commit in bad.commits_since(good)],
+                         shas)
+
+        url = reverse('bisect_build', args=[self.project.slug, bad.pk])
+        response = self.client.post(url, {'good': good.pk, 'width': 2})
+        bisection = Bisection.objects.get()
+        self.assertRedirects(response, bisection.get_absolute_url())
+        self.assertEqual(bisection.status, Bisection.FINISHED)
+        self.assertEqual(bisection.first_bad, shas[3])
+        # 2 rounds of 2 builds instead of 3 rounds of 1
+        self.assertEqual(bisection.builds.count(), 4)
+        response = self.client.get(bisection.get_absolute_url())
+        self.assertContains(response, 'first bad commit')
+
+        # Bisection builds of older revisions aren't the latest results
+        self.assertEqual(self.project.build_status, 'failed')
+        response = self.client.get(self.project.get_absolute_url())
+        self.assertEqual(response.context['last_build'], bad)
+
+        # Finished builds are reused
+        bisection = bad.bisect(good, width=3)
+        self.assertEqual(bisection.first_bad, shas[3])
+        self.assertEqual(bisection.builds.count(), 0)
+
+        # Builds without a complete changelog can't be bisected
+        response = self.client.post(reverse(
+            'bisect_build', args=[self.project.slug, good.pk]), {'width': 2})
+        self.assertEqual(response.status_code, 200)
+
+    def test_remote_agents(self):
+        """Remote agents lease jobs and send their output over HTTP"""
+        self._create_project()
+        self.project.remote_agents = True
+        self.project.build_instructions = 'echo "running with $PYTHON"'
+        self.project.save()
+        key = self.project.configurations.create(key='PYTHON')
+        key.values.create(value='2.6')
+        key.values.create(value='2.7')
+        settings.AGENT_TOKEN = 'secret'
+        try:
+            self.project.build()
+            self.assertEqual(
+                Job.objects.filter(status=Job.PENDING).count(), 2)
+            response = self.client.post(
+                reverse('agent_lease'), json.dumps({'agent': 'intruder'}),
+                content_type='application/json', HTTP_X_CI_TOKEN='wrong')
+            self.assertEqual(response.status_code, 403)
+
+            first = ClientAgent(self.client, 'first')
+            second = ClientAgent(self.client, 'second')
+            spec = first.lease()
+            self.assertEqual(spec['build']['revision'],
+                             self.project.builds.get().revision)
+            second.run(once=True)
+            leased = Job.objects.get(pk=spec['id'])
+            self.assertEqual((leased.status, leased.agent),
+                             (Job.RUNNING, 'first'))
+            done = Job.objects.exclude(pk=leased.pk).get()
+            self.assertEqual((done.status, done.agent),
+                             (Job.SUCCESS, 'second'))
+            self.assertTrue('running with' in done.get_output())
+            self.assertTrue(done.compressed)
+
+            first.run_job(spec)
+            job = Job.objects.get(pk=leased.pk)
+            self.assertEqual(job.status, Job.SUCCESS)
+            self.assertTrue('running with %s' % job.values_data['PYTHON']
+                            in job.get_output())
+            self.assertTrue(job.timings_data)
+
+            # Jobs of silent agents go back to the queue
+            self.project.builds.get().queue()
+            spec = first.lease()
+            Job.objects.filter(pk=spec['id']).update(
+                lease_expiry=datetime.datetime.now() -
+                datetime.timedelta(seconds=1))
+            Job.expire_leases()
+            job = Job.objects.get(pk=spec['id'])
+            self.assertEqual((job.status, job.agent), (Job.PENDING, ''))
+            lost = first.run_job(spec)
+            self.assertTrue(lost.lost)
+            self.assertFalse('running with' in lost.output)
+            self.assertEqual(Job.objects.get(pk=spec['id']).status,
+                             Job.PENDING)
+            second.run(once=True)
+            self.assertEqual(
+                Job.objects.filter(status=Job.SUCCESS).count(), 2)
+
+            # Warm workspaces are leased on the agent's machine
+            self.project.warm_workspace = True
+            self.project.save()
+            self.project.builds.get().queue()
+            spec = first.lease()
+            held = AgentJob.from_spec(spec, first)
+            held.lease_workspace()
+            self.assertTrue(held.workspace_lease.locked)
+            self.assertFalse(Lock('workspace:%s' % held.workspace).locked)
+            job = first.run_job(spec)
+            self.assertEqual(job.workspace, held.workspace[:-1] + '1')
+            self.assertFalse(job.workspace_lease.locked)
+            self.assertEqual(Job.objects.get(pk=spec['id']).status,
+                             Job.SUCCESS)
+            held.workspace_lease.release()
+            second.run(once=True)
+            self.assertEqual(
+                Job.objects.filter(status=Job.SUCCESS).count(), 2)
+        finally:
+            settings.AGENT_TOKEN = None
+
+    def test_worker_labels(self):
+        """Jobs needing labelled workers go to dedicated queues"""
+        metrics._store = None
+        self._create_project()
+        url = reverse('project_axis', args=[self.project.slug])
+        data = {
+            'form-TOTAL_FORMS': 1,
+            'form-INITIAL_FORMS': 0,
+            'form-0-name': 'python',
+            'form-0-values': '2.6, pypy',
+            'form-0-labels': 'pypy: pypy, jit; 2.4: old',
+        }
+        response = self.client.post(url, data)
+        self.assertContains(response, 'Unknown values: 2.4')
+        data['form-0-labels'] = 'pypy: pypy jit'
+        response = self.client.post(url, data)
+        self.assertEqual(Value.objects.get(value='pypy').labels, 'jit pypy')
+        self.assertEqual(Value.objects.get(value='2.6').labels, '')
+        response = self.client.get(url)
+        self.assertContains(response, 'pypy: jit pypy')
+
+        self.project.build()
+        jobs = dict([(job.values_data['python'], job)
+                     for job in Job.objects.all()])
+        self.assertEqual(jobs['2.6'].queue_name, None)
+        self.assertEqual(jobs['pypy'].queue_name, 'ci.jit.pypy')
+        self.assertEqual(jobs['pypy'].status, Job.SUCCESS)
+        self.assertEqual(labels.worker_queues(['pypy', 'jit']),
+                         ['celery', 'ci.jit', 'ci.pypy', 'ci.jit.pypy'])
+        self.assertEqual(labels.label_combinations(['pypy', 'jit', 'jit']),
+                         ['', 'jit', 'pypy', 'jit pypy'])
+        response = self.client.get(reverse('metrics'))
+        self.assertContains(response,
+                            'ci_jobs_pending_by_label{label="pypy"} 0')
+
+        # Agents only get the jobs they have the labels for
+        self.project.remote_agents = True
+        self.project.save()
+        self.project.builds.get().queue()
+        self.assertEqual(Job.lease('plain').pk, jobs['2.6'].pk)
+        self.assertEqual(Job.lease('plain'), None)
+        self.assertEqual(Job.lease('fast', ['jit', 'pypy', 'x']).pk,
+                         jobs['pypy'].pk)
+
+    def test_pipeline(self):
+        """Stages run after the stages they need, with their artifacts"""
+        self._create_project()
+        url = reverse('project_stages', args=[self.project.slug])
+        data = {
+            'stages-TOTAL_FORMS': 2,
+            'stages-INITIAL_FORMS': 0,
+            'stages-0-name': 'lint',
+            'stages-0-needs': 'test',
+            'stages-0-build_instructions':
+                'mkdir -p out && echo ok > out/lint',
+            'stages-0-artifacts': 'out/lint',
+            'stages-1-name': 'test',
+            'stages-1-needs': 'lint',
+            'stages-1-build_instructions': 'true',
+        }
+        response = self.client.post(url, data)
+        self.assertContains(response, 'Stages needing each other')
+        data.update({
+            'stages-TOTAL_FORMS': 4,
+            'stages-0-needs': '',
+            'stages-1-matrix': 'on',
+            'stages-1-build_instructions': 'echo "lint $(cat out/lint) $PY"',
+            'stages-2-name': 'package',
+            'stages-2-needs': 'test lint',
+            'stages-2-build_instructions': 'test -f out/lint',
+            'stages-3-name': 'docs',
+            'stages-3-build_instructions': 'echo docs',
+        })
+        response = self.client.post(url, data)
+        self.assertRedirects(response, self.project.get_absolute_url())
+        self.assertEqual(self.project.stages.count(), 4)
+        self.assertEqual([stage['name'] for stage in
+                          self.project.pipeline()],
+                         ['docs', 'lint', 'test', 'package'])
+        self.assertRaises(ValueError, pipelines.sort_stages, {'a': ['b']})
+
+        key = self.project.configurations.create(key='PY')
+        key.values.create(value='2.6')
+        key.values.create(value='2.7')
+        self.project.build()
+        build = self.project.builds.get()
+        self.assertEqual(build.build_status, 'success')
+        jobs = Job.objects.filter(build=build)
+        self.assertEqual(sorted([job.stage for job in jobs]),
+                         ['docs', 'lint', 'package', 'test', 'test'])
+        for job in jobs.filter(stage='test'):
+            self.assertTrue('lint ok %s' % job.values_data['PY']
+                            in job.get_output())
+        self.assertTrue(os.path.exists(os.path.join(
+            build.artifacts_path('lint'), 'out', 'lint')))
+        # The matrix waits for lint
+        lint = jobs.get(stage='lint')
+        for job in jobs.filter(stage='test'):
+            self.assertTrue(job.start_date >= lint.end_date)
+
+        # A failed stage cancels the stages needing it
+        stages = build.stages_data
+        stages[1]['build_instructions'] = 'false'
+        build.stages = json.dumps(stages)
+        build.save()
+        build.queue()
+        statuses = dict([(job.stage, job.status) for job in
+                         Job.objects.filter(build=build)])
+        self.assertEqual(statuses, {'docs': Job.SUCCESS,
+                                    'lint': Job.FAILURE,
+                                    'test': Job.CANCELLED,
+                                    'package': Job.CANCELLED})
+        self.assertEqual(build.build_status, 'failed')
+
+        build.delete()
+        self.assertFalse(os.path.exists(build.artifacts_path('lint')))
+
+    def test_log_search(self):
+        """Job outputs are indexed and searchable"""
+        self._create_project()
+        self.project.build_instructions = 'echo "needle in <$PYTHON>"'
+        self.project.save()
+        key = self.project.configurations.create(key='PYTHON')
+        key.values.create(value='2.6')
+        key.values.create(value='2.7')
+        self.project.build()
+        self.assertEqual(Job.objects.count(), 2)
+
+        url = reverse('search')
+        response = self.client.get(url, {'q': 'needle'})
+        self.assertEqual(len(response.context['results']), 2)
+        self.assertContains(response, '<mark>needle</mark> in &lt;2.7&gt;')
+
+        response = self.client.get(url, {'q': 'needle',
+                                          'value': 'PYTHON=2.6'})
+        [(job, snippet)] = response.context['results']
+        self.assertEqual(job.values_data, {'PYTHON': '2.6'})
+        for value in ['PYTHON=2_6', 'PYTHON=2%']:
+            response = self.client.get(url, {'q': 'needle', 'value': value})
+            self.assertEqual(response.context['results'], [])
+        for params in [{'project': self.project.slug, 'branch': 'master'},
+                       {'since': datetime.date.today()}]:
+            params['q'] = 'needle'
+            response = self.client.get(url, params)
+            self.assertEqual(len(response.context['results']), 2)
+        for params in [{'branch': 'other'},
+                       {'until': datetime.date(2000, 1, 1)},
+                       {'q': 'haystack'}]:
+            params.setdefault('q', 'needle')
+            response = self.client.get(url, params)
+            self.assertEqual(response.context['results'], [])
+
+        response = self.client.get(url, {'q': '"needle'})
+        self.assertEqual(response.context['error'], 'Invalid search query.')
+
+        # Deleted jobs are skipped, then removed from the index
+        job.delete()
+        response = self.client.get(url, {'q': 'needle'})
+        self.assertEqual(len(response.context['results']), 1)
+        call_command('index_logs')
+        index = search.get_index()
+        self.assertEqual(index.job_ids(), [Job.objects.get().pk])
+        index.close()
+
+    def test_build_lock(self):
+        """One build cycle at a time"""
+        self._create_project()
+        lock = self.project.build_lock
+        self.assertTrue(lock.acquire())
+        self.assertFalse(lock.acquire())
+
+        # Another worker is building: the request is left to it
+        self.project.build_requests.create()
+        tasks.process_build_requests(self.project.pk)
+        self.assertEqual(Build.objects.count(), 0)
+        self.assertEqual(BuildRequest.objects.count(), 1)
+
+        lock.release()
+        tasks.process_build_requests(self.project.pk)
+        self.assertEqual(Build.objects.count(), 1)
+        self.assertEqual(BuildRequest.objects.count(), 0)
+
+    def test_deleted_branch_request(self):
+        """A request for a deleted branch doesn't lose the other ones"""
+        self._create_project()
+        self.project.build_branches = Project.ALL_BRANCHES
+        self.project.save()
+        self.project.build()
+        Command('git checkout -b foo && echo "yay" >> README && '
+                'git commit -am "Added stuff to branch foo"',
+                cwd=self.project.repo)
+        self.project.build_requests.create(branch='gone')
+        self.project.build_requests.create(branch='foo')
+        tasks.process_build_requests(self.project.pk)
+        self.assertEqual(self.project.builds.latest('pk').branch, 'foo')
+        self.assertEqual(BuildRequest.objects.count(), 0)
+
     def test_revision(self):
         """Fetching the latest revision from the VCS"""
         self._create_project()
@@ -8,12 +8,33 @@ urlpatterns = patterns('',
 
     url(r'^add/$', views.add_project, name='add_project'),
 
+    url(r'^workspace/$', views.workspace_usage, name='workspace_usage'),
+
+    url(r'^metrics$', views.metrics_view, name='metrics'),
+
+    url(r'^failures/$', views.failures, name='failures'),
+
+    url(r'^failures/(?P<slug>[0-9a-f]{40})/$', views.failure, name='failure'),
+
+    url(r'^search/$', views.search_view, name='search'),
+
+    url(r'^agents/lease/$', views.agent_lease, name='agent_lease'),
+
+    url(r'^agents/jobs/(?P<job_id>\d+)/output/$',
+        views.agent_output, name='agent_output'),
+
+    url(r'^agents/jobs/(?P<job_id>\d+)/finish/$',
+        views.agent_finish, name='agent_finish'),
+
     url(r'^project/(?P<slug>[\w_-]+)/admin/$',
         views.project_admin, name='project_admin'),
 
     url(r'^project/(?P<slug>[\w_-]+)/axis/$',
         views.project_axis, name='project_axis'),
 
+    url(r'^project/(?P<slug>[\w_-]+)/stages/$',
+        views.project_stages, name='project_stages'),
+
     url(r'^project/(?P<slug>[\w_-]+)/build/$',
         views.project_trigger_build, name='project_trigger_build'),
 
@@ -23,9 +44,27 @@ urlpatterns = patterns('',
     url(r'^project/(?P<slug>[\w_-]+)/builds/(?P<pk>\d+)/jobs/(?P<job_id>\d+)/$',
         views.job, name='project_job'),
 
+    url(r'^project/(?P<slug>[\w_-]+)/builds/(?P<pk>\d+)/jobs/(?P<job_id>\d+)/output/$',
+        views.job_output, name='project_job_output'),
+
     url(r'^project/(?P<slug>[\w_-]+)/builds/(?P<pk>\d+)/$',
         views.project_build, name='project_build'),
 
+    url(r'^project/(?P<slug>[\w_-]+)/builds/(?P<pk>\d+)/bisect/$',
+        views.bisect_build, name='bisect_build'),
+
+    url(r'^project/(?P<slug>[\w_-]+)/bisections/(?P<pk>\d+)/$',
+        views.bisection, name='bisection'),
+
+    url(r'^project/(?P<slug>[\w_-]+)/benchmarks/$',
+        views.project_benchmarks, name='project_benchmarks'),
+
+    url(r'^project/(?P<slug>[\w_-]+)/builds/(?P<pk>\d+)/trace/$',
+        views.build_trace, name='build_trace'),
+
+    url(r'^project/(?P<slug>[\w_-]+)/timings/$',
+        views.project_timings, name='project_timings'),
+
     url(r'^project/(?P<slug>[\w_-]+)/builds/$',
         views.project_builds, name='project_builds'),
 
@@ -1,15 +1,31 @@
+import anyjson as json
+import datetime
+import sqlite3
+import time
+
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.sites.models import RequestSite
+from django.db.models import Count, Max
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, Http404
 from django.shortcuts import redirect, get_object_or_404
 from django.template.defaultfilters import slugify
+from django.utils.decorators import method_decorator
 from django.utils.translation import ugettext as _
 from django.views import generic
 from django.views.decorators.csrf import csrf_exempt
 
-from .forms import ProjectForm, ProjectBuildForm, ConfigurationFormSet
-from .models import Project, Job, Build
+from .. import metrics, search, tracing
+from ..labels import parse_labels
+from ..parsers import log_sections, parse_push
+from .forms import (ProjectForm, ProjectBuildForm, ConfigurationFormSet,
+                    StageFormSet, BisectForm, SearchForm)
+from .models import (Project, Job, Build, BenchmarkResult, Bisection,
+                     FailureSignature, Span)
+from .stats import (benchmark_series, resource_stats, step_stats,
+                    timing_stats, waterfall)
+from .workspace import get_usage_stats
 
 
 class Projects(generic.ListView):
@@ -23,7 +39,7 @@ class ProjectDetails(generic.DetailView):
     def get_context_data(self, **kwargs):
         ctx = super(ProjectDetails, self).get_context_data(**kwargs)
         try:
-            ctx['last_build'] = self.object.builds.all()[0]
+            ctx['last_build'] = self.object.branch_builds[0]
         except IndexError:
             pass
         ctx.update({
@@ -33,6 +49,78 @@ class ProjectDetails(generic.DetailView):
 project = ProjectDetails.as_view()
 
 
+class ProjectTimings(generic.DetailView):
+    model = Project
+    template_name = 'projects/project_timings.html'
+
+    def get_context_data(self, **kwargs):
+        ctx = super(ProjectTimings, self).get_context_data(**kwargs)
+        try:
+            days = max(1, min(int(self.request.GET.get('days', 30)), 3650))
+        except (ValueError, OverflowError):
+            days = 30
+        since = datetime.datetime.now() - datetime.timedelta(days=days)
+        jobs = Job.objects.filter(
+            build__project=self.object, end_date__gte=since,
+        )
+        ctx.update({
+            'days': days,
+            'phases': [name for phase, name in Job.PHASES],
+            'timings': timing_stats(jobs.values_list('end_date', 'values',
+                                                     'timings'),
+                                    [phase for phase, name in Job.PHASES]),
+            'steps': step_stats(jobs.values_list('profile', flat=True)),
+            'step_columns': [_('Duration')],
+            'resources': [name for field, name in Job.RESOURCES],
+            'usage': resource_stats(jobs.values_list(
+                'end_date', 'values', 'cpu_user', 'cpu_system', 'max_rss',
+                'io_read', 'io_write',
+            )),
+        })
+        return ctx
+project_timings = ProjectTimings.as_view()
+
+
+class ProjectBenchmarks(generic.DetailView):
+    """
+    Benchmark results of the last builds of a branch, and the revisions
+    between which their level changed.
+    """
+    model = Project
+    template_name = 'projects/project_benchmarks.html'
+    build_count = 100
+
+    def get_context_data(self, **kwargs):
+        ctx = super(ProjectBenchmarks, self).get_context_data(**kwargs)
+        builds = self.object.branch_builds
+        branch = self.request.GET.get('branch') or (
+            list(builds.values_list('branch', flat=True)[:1]) or [''])[0]
+        builds = builds.filter(branch=branch)
+        build_ids = list(builds.order_by('-pk').values_list(
+            'pk', flat=True)[:self.build_count])
+        series = benchmark_series(BenchmarkResult.objects.filter(
+            job__build__in=build_ids,
+        ).order_by('job__build__id', 'pk').values_list(
+            'job__build', 'name', 'values', 'value'))
+        for row in series:
+            for change in row['changes']:
+                # The commits built since the last build with results
+                change['builds'] = builds.filter(
+                    pk__gt=change['before'], pk__lte=change['after'],
+                ).order_by('-pk')
+                change['commits'] = [commit for build in change['builds']
+                                     for commit in build.history_data]
+        ctx.update({
+            'branch': branch,
+            'branches': self.object.builds.order_by('branch').values_list(
+                'branch', flat=True).distinct(),
+            'build_count': len(build_ids),
+            'series': series,
+        })
+        return ctx
+project_benchmarks = ProjectBenchmarks.as_view()
+
+
 class ProjectMixin(object):
     """
     Mixin that injects the current project to the context.
@@ -61,6 +149,78 @@ class ProjectBuild(ProjectMixin, generic.DetailView):
 project_build = ProjectBuild.as_view()
 
 
+class BisectBuild(generic.FormView):
+    """
+    Starts looking for the commit that broke a build.
+    """
+    form_class = BisectForm
+    template_name = 'projects/bisect_form.html'
+
+    def dispatch(self, request, *args, **kwargs):
+        self.build = get_object_or_404(Build, project__slug=kwargs['slug'],
+                                       pk=kwargs['pk'])
+        return super(BisectBuild, self).dispatch(request, *args, **kwargs)
+
+    def get_form_kwargs(self):
+        kwargs = super(BisectBuild, self).get_form_kwargs()
+        kwargs['bad'] = self.build
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        ctx = super(BisectBuild, self).get_context_data(**kwargs)
+        ctx['build'] = self.build
+        return ctx
+
+    def form_valid(self, form):
+        bisection = self.build.bisect(form.cleaned_data['good'],
+                                      form.cleaned_data['width'])
+        return redirect(bisection)
+bisect_build = BisectBuild.as_view()
+
+
+class BisectionDetails(generic.DetailView):
+    def get_object(self):
+        return get_object_or_404(
+            Bisection.objects.select_related('project', 'good', 'bad'),
+            project__slug=self.kwargs['slug'], pk=self.kwargs['pk'],
+        )
+
+    def get_context_data(self, **kwargs):
+        ctx = super(BisectionDetails, self).get_context_data(**kwargs)
+        states = self.object.revision_states()
+        good, bad = self.object.bounds(states)
+        builds = {}
+        for build in self.object.builds.all():
+            builds[build.revision] = build
+        ctx.update({
+            'project': self.object.project,
+            'commits': [{
+                'commit': commit,
+                'state': states.get(revision, ''),
+                'build': builds.get(revision),
+                'candidate': good < index <= bad,
+            } for index, (commit, revision) in enumerate(zip(
+                self.object.commits_data, self.object.revisions,
+            ))],
+        })
+        return ctx
+bisection = BisectionDetails.as_view()
+
+
+class BuildTrace(ProjectMixin, generic.DetailView):
+    model = Build
+    template_name = 'projects/build_trace.html'
+
+    def get_context_data(self, **kwargs):
+        ctx = super(BuildTrace, self).get_context_data(**kwargs)
+        spans = []
+        if self.object.trace_id:
+            spans = list(Span.objects.filter(trace_id=self.object.trace_id))
+        ctx['spans'] = waterfall(spans)
+        return ctx
+build_trace = BuildTrace.as_view()
+
+
 class DeleteBuild(generic.DeleteView):
     model = Build
 
@@ -79,6 +239,10 @@ delete_build = DeleteBuild.as_view()
 
 
 class BuildDetails(generic.DetailView):
+    # The output is displayed by pages of this many lines, the last one
+    # unless ?start=<line> is given
+    log_lines = 1000
+
     def get_object(self):
         return get_object_or_404(
             Job,
@@ -86,9 +250,133 @@ class BuildDetails(generic.DetailView):
             build__pk=self.kwargs['pk'],
             pk=self.kwargs['job_id'],
         )
+
+    def get_context_data(self, **kwargs):
+        ctx = super(BuildDetails, self).get_context_data(**kwargs)
+        start = self.request.GET.get('start', '')
+        if start.isdigit() and int(start) > 0:
+            start = int(start) - 1
+            lines, total = self.object.get_lines(start, self.log_lines)
+        else:
+            lines, total = self.object.get_lines(0, 0)
+            start = max(total - self.log_lines, 0)
+            lines, total = self.object.get_lines(start, self.log_lines)
+        ctx['log'] = {
+            'sections': log_sections(lines, start),
+            'start': start + 1,
+            'end': start + len(lines),
+            'total': total,
+            'previous': start and max(start - self.log_lines, 0) + 1,
+            'next': (start + self.log_lines < total and
+                     start + self.log_lines + 1),
+        }
+        error = self.object.first_error_line
+        if error is not None:
+            ctx['log'].update({
+                'first_error': error + 1,
+                'first_error_page': max(error - 10, 0) + 1,
+            })
+        return ctx
 job = BuildDetails.as_view()
 
 
+class JobOutput(BuildDetails):
+    """
+    The raw output of a job, streamed as it's decompressed. With ?tail=<n>,
+    only the last <n> bytes.
+    """
+    def get(self, request, *args, **kwargs):
+        job = self.get_object()
+        tail = request.GET.get('tail')
+        if tail is not None:
+            if not tail.isdigit():
+                raise Http404
+            tail = int(tail)
+            output = [job.get_output_tail(tail)]
+        else:
+            output = job.iter_output()
+        response = HttpResponse(output, mimetype='text/plain; charset=utf-8')
+        if 'download' in request.GET:
+            response['Content-Disposition'] = (
+                'attachment; filename=%s-%s.log' % (job.build.project.slug,
+                                                    job.pk))
+        return response
+job_output = JobOutput.as_view()
+
+
+class WorkspaceUsage(generic.TemplateView):
+    template_name = 'projects/workspace.html'
+
+    def get_context_data(self, **kwargs):
+        ctx = super(WorkspaceUsage, self).get_context_data(**kwargs)
+        ctx['usage'] = get_usage_stats()
+        return ctx
+workspace_usage = WorkspaceUsage.as_view()
+
+
+class Failures(generic.ListView):
+    """
+    Failure signatures, most recently seen first.
+    """
+    template_name = 'projects/failure_list.html'
+
+    def get_queryset(self):
+        return FailureSignature.objects.annotate(
+            job_count=Count('jobs', distinct=True),
+            project_count=Count('jobs__build__project', distinct=True),
+            last_seen=Max('jobs__end_date'),
+        ).select_related('first_job__build__project').order_by(
+            '-last_seen')[:100]
+failures = Failures.as_view()
+
+
+class FailureDetails(generic.DetailView):
+    model = FailureSignature
+    slug_field = 'hash'
+
+    def get_context_data(self, **kwargs):
+        ctx = super(FailureDetails, self).get_context_data(**kwargs)
+        jobs = self.object.jobs.select_related('build__project').order_by(
+            '-id')
+        ctx.update({
+            'jobs': jobs[:100],
+            'job_count': jobs.count(),
+            'project_count': jobs.values('build__project').distinct().count(),
+        })
+        return ctx
+failure = FailureDetails.as_view()
+
+
+class Search(generic.TemplateView):
+    """
+    Full-text search over the output of the jobs.
+    """
+    template_name = 'projects/search.html'
+
+    def get_context_data(self, **kwargs):
+        ctx = super(Search, self).get_context_data(**kwargs)
+        form = SearchForm(self.request.GET or None)
+        ctx['form'] = form
+        if form.is_valid():
+            index = search.get_index()
+            try:
+                ctx['results'] = form.search(index)
+            except sqlite3.OperationalError:
+                # FTS syntax errors, e.g. unbalanced quotes
+                ctx['error'] = _('Invalid search query.')
+            finally:
+                index.close()
+        return ctx
+search_view = Search.as_view()
+
+
+class Metrics(generic.View):
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.render(Job.gauges()),
+                            content_type='text/plain; version=0.0.4')
+metrics_view = Metrics.as_view()
+
+
 class AddProject(generic.CreateView):
     model = Project
     form_class = ProjectForm
@@ -116,7 +404,10 @@ class ProjectAdmin(generic.UpdateView):
     def get_context_data(self, **kwargs):
         ctx = super(ProjectAdmin, self).get_context_data(**kwargs)
         ctx.update({
-            'formset': ConfigurationFormSet(initial=self.object.axis_initial())
+            'formset': ConfigurationFormSet(
+                initial=self.object.axis_initial()),
+            'stages': StageFormSet(queryset=self.object.stages.all(),
+                                   prefix='stages'),
         })
         return ctx
 
@@ -152,6 +443,8 @@ class ProjectAxis(generic.FormView):
         # the same template
         ctx['formset'] = ctx['form']
         ctx['form'] = ProjectBuildForm(instance=self.project)
+        ctx['stages'] = StageFormSet(queryset=self.project.stages.all(),
+                                     prefix='stages')
         ctx['object'] = self.project
         return ctx
 
@@ -176,6 +469,10 @@ class ProjectAxis(generic.FormView):
                 val, created = config.values.get_or_create(
                     value=value,
                 )
+                labels = ' '.join(axis['labels'].get(value, []))
+                if val.labels != labels:
+                    val.labels = labels
+                    val.save()
         messages.success(self.request,
                          _('Build axis have been successfully updated.'))
         return super(ProjectAxis, self).form_valid(form)
@@ -187,27 +484,174 @@ class ProjectAxis(generic.FormView):
 project_axis = ProjectAxis.as_view()
 
 
+class ProjectStages(generic.FormView):
+    form_class = StageFormSet
+    template_name = 'projects/project_admin_form.html'
+
+    def dispatch(self, request, *args, **kwargs):
+        self.project = get_object_or_404(Project, slug=kwargs['slug'])
+        return super(ProjectStages, self).dispatch(request, *args, **kwargs)
+
+    def get_form_kwargs(self):
+        kwargs = super(ProjectStages, self).get_form_kwargs()
+        kwargs.update({
+            'queryset': self.project.stages.all(),
+            'prefix': 'stages',
+        })
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        ctx = super(ProjectStages, self).get_context_data(**kwargs)
+        # Same template as ProjectAdmin
+        ctx['stages'] = ctx['form']
+        ctx['form'] = ProjectBuildForm(instance=self.project)
+        ctx['formset'] = ConfigurationFormSet(
+            initial=self.project.axis_initial())
+        ctx['object'] = self.project
+        return ctx
+
+    def form_valid(self, form):
+        for stage in form.save(commit=False):
+            stage.project = self.project
+            stage.save()
+        messages.success(self.request,
+                         _('Pipeline stages have been successfully updated.'))
+        return super(ProjectStages, self).form_valid(form)
+
+    def get_success_url(self):
+        if '_addanother' in self.request.POST:
+            return reverse('project_stages', args=[self.project.slug])
+        return reverse('project', args=[self.project.slug])
+project_stages = ProjectStages.as_view()
+
+
+def pushed_refs(request):
+    """
+    The (branch, revision) tuples sent by a push hook, or None.
+    """
+    try:
+        if 'payload' in request.POST:
+            data = json.loads(request.POST['payload'])
+        elif request.META.get('CONTENT_TYPE', '').startswith(
+            'application/json'):
+            data = json.loads(request.raw_post_data)
+        else:
+            data = request.POST
+        return parse_push(data)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
 @csrf_exempt
 def project_trigger_build(request, slug):
     """BUILD BUTTON"""
+    with tracing.span('project_trigger_build', root=True, project=slug):
+        return trigger_build(request, slug)
+
+
+def trigger_build(request, slug):
+    status = 200
     if request.method == 'POST':
         project = get_object_or_404(Project, slug=slug)
-        if not Job.objects.filter(
-            build__project=project,
-            status__in=[Job.RUNNING, Job.PENDING],
-        ).exists():
-            triggered = project.build()
-            if triggered:
-                messages.success(
-                    request,
-                    _('A build of %s has been triggered' % project),
-                )
-            else:
-                messages.info(
-                    request,
-                    _('The latest revision has already been built'),
-                )
+        if project.request_build(pushed_refs(request)):
+            messages.success(
+                request,
+                _('A build of %s has been scheduled') % project,
+            )
+        else:
+            messages.info(
+                request,
+                _('%s is up to date or a build is already '
+                  'scheduled') % project,
+            )
+        status = 202
     if 'HTTP_REFERER' in request.META:
         return redirect(reverse('project', args=[slug]))
     else:
-        return HttpResponse()
+        return HttpResponse(status=status)
+
+
+class AgentView(generic.View):
+    """
+    API of the remote build agents: POST requests with a JSON body,
+    authenticated by the AGENT_TOKEN setting in the X-CI-Token header.
+    """
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        if (not settings.AGENT_TOKEN or request.META.get('HTTP_X_CI_TOKEN')
+            != settings.AGENT_TOKEN):
+            return HttpResponse(status=403)
+        try:
+            self.data = json.loads(request.raw_post_data or '{}')
+            self.agent = self.data['agent'][:255]
+        except (KeyError, TypeError, ValueError):
+            return HttpResponse(status=400)
+        return super(AgentView, self).dispatch(request, *args, **kwargs)
+
+    def json_response(self, data):
+        return HttpResponse(json.dumps(data), mimetype='application/json')
+
+
+class LeaseJob(AgentView):
+    """
+    Gives a job to the agent, waiting for one at most <wait> seconds.
+    """
+    def post(self, request, *args, **kwargs):
+        try:
+            wait = min(float(self.data.get('wait', 0)),
+                       settings.AGENT_POLL_TIMEOUT)
+        except (TypeError, ValueError):
+            wait = 0
+        deadline = time.time() + wait
+        while True:
+            Job.expire_leases()
+            job = Job.lease(self.agent,
+                            parse_labels(self.data.get('labels', '')))
+            if job is not None:
+                return self.json_response(job.agent_spec())
+            if time.time() >= deadline:
+                return HttpResponse(status=204)
+            time.sleep(1)
+agent_lease = LeaseJob.as_view()
+
+
+class JobOutputChunk(AgentView):
+    """
+    Appends the output sent by the agent and extends its lease. Answers 409
+    when the lease was lost: the job has been given to another agent.
+    """
+    def post(self, request, *args, **kwargs):
+        job = get_object_or_404(Job, pk=kwargs['job_id'])
+        if not job.renew_lease(self.agent, self.data.get('output', '')):
+            return HttpResponse(status=409)
+        return self.json_response({})
+agent_output = JobOutputChunk.as_view()
+
+
+class FinishJob(AgentView):
+    """
+    Stores the results of a job run by an agent.
+    """
+    def post(self, request, *args, **kwargs):
+        job = get_object_or_404(Job, pk=kwargs['job_id'])
+        # Clearing the lease expiry keeps it from expiring meanwhile
+        if (self.data.get('status') not in [Job.SUCCESS, Job.FAILURE] or
+            not Job.objects.filter(
+                pk=job.pk, status=Job.RUNNING, agent=self.agent,
+            ).update(lease_expiry=None)):
+            return HttpResponse(status=409)
+        job = Job.objects.get(pk=job.pk)
+        job.status = self.data['status']
+        job.output = self.data.get('output', '')
+        job.profile = self.data.get('profile', '')
+        job.xunit_xml_report = self.data.get('xunit_xml_report', '')
+        for field in ['cpu_user', 'cpu_system', 'max_rss', 'io_read',
+                      'io_write']:
+            setattr(job, field, self.data.get(field))
+        job.benchmark_results = [
+            (name, float(value))
+            for name, value in self.data.get('benchmarks', [])]
+        job.finish(dict([(phase, float(duration)) for phase, duration in
+                         self.data.get('timings', {}).items()]))
+        return self.json_response({})
+agent_finish = FinishJob.as_view()
@@ -0,0 +1,195 @@
+import datetime
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ..locks import Lock
+from ..trash import move_to_trash
+from .maintenance import is_borrowed_from
+from .models import Project, Job
+
+logger = logging.getLogger('ci')
+
+# Importance of the workspace's content, the least important is evicted
+# first.
+ORPHAN = 0  # Data of deleted projects or builds, crashed jobs
+CACHE = 1  # Dependency caches
+WARM = 2  # Warm workspaces
+KEPT = 3  # Build data kept for debugging
+
+USAGE_KEY = 'ci:workspace-usage'
+
+
+def disk_usage(path):
+    if os.path.islink(path) or not os.path.isdir(path):
+        return os.lstat(path).st_size
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass  # Deleted in the meantime
+    return total
+
+
+class Item(object):
+    """
+    Something taking space in the workspace.
+    """
+    def __init__(self, kind, path, projects=(), importance=None,
+                 last_access=None):
+        self.kind = kind
+        self.path = path
+        self.projects = list(projects)
+        self.importance = importance  # None if it can't be evicted
+        if last_access is None:
+            last_access = os.lstat(path).st_mtime
+        self.last_access = last_access
+        self.size = disk_usage(path)
+
+    @property
+    def evictable(self):
+        return self.importance is not None
+
+    def __repr__(self):
+        return '<Item: %s (%s bytes)>' % (self.path, self.size)
+
+
+def listdir(path):
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.listdir(path))
+
+
+def scan():
+    """
+    Lists the content of the workspace.
+    """
+    projects = dict([(p.slug, p) for p in Project.objects.all()])
+    mirrors = {}
+    for project in projects.values():
+        mirrors.setdefault(project.cache_dir, []).append(project.slug)
+
+    items = []
+    repos = os.path.join(settings.WORKSPACE, 'repos')
+    for name in listdir(repos):
+        path = os.path.join(repos, name)
+        slugs = mirrors.get(path, [])
+        # Forks of a deleted project still use its clone's objects
+        keep = slugs or is_borrowed_from(path)
+        items.append(Item('repos', path, slugs,
+                          importance=None if keep else ORPHAN))
+
+    builds = os.path.join(settings.WORKSPACE, 'builds')
+    names = listdir(builds)
+    jobs = Job.objects.filter(
+        pk__in=[int(n) for n in names if n.isdigit()],
+    ).select_related('build__project')
+    jobs = dict([(str(job.pk), job) for job in jobs])
+    for name in names:
+        path = os.path.join(builds, name)
+        job = jobs.get(name)
+        if job is None:
+            items.append(Item('builds', path, importance=ORPHAN))
+        elif job.status in (Job.RUNNING, Job.PENDING):
+            items.append(Item('builds', path, [job.build.project.slug]))
+        else:
+            last_access = None
+            if job.end_date is not None:
+                last_access = time.mktime(job.end_date.timetuple())
+            importance = (KEPT if job.build.project.keep_build_data
+                          else ORPHAN)
+            items.append(Item('builds', path, [job.build.project.slug],
+                              importance=importance,
+                              last_access=last_access))
+
+    for kind, importance in [('warm', WARM), ('caches', CACHE)]:
+        root = os.path.join(settings.WORKSPACE, kind)
+        for slug in listdir(root):
+            for name in listdir(os.path.join(root, slug)):
+                path = os.path.join(root, slug, name)
+                if slug not in projects:
+                    items.append(Item(kind, path, importance=ORPHAN))
+                elif kind == 'warm' and Lock('workspace:%s' % path).locked:
+                    items.append(Item(kind, path, [slug]))
+                else:
+                    items.append(Item(kind, path, [slug],
+                                      importance=importance))
+    return items
+
+
+def usage_stats(items):
+    """
+    Disk usage per project and per kind of content. Shared clones count
+    for every project using them.
+    """
+    projects = {}
+    orphans = 0
+    for item in items:
+        if not item.projects:
+            orphans += item.size
+        for slug in item.projects:
+            stats = projects.setdefault(slug, {
+                'slug': slug, 'repos': 0, 'builds': 0, 'warm': 0,
+                'caches': 0, 'total': 0,
+            })
+            stats[item.kind] += item.size
+            stats['total'] += item.size
+    return {
+        'date': datetime.datetime.now(),
+        'total': sum([item.size for item in items]),
+        'limit': settings.WORKSPACE_SIZE_LIMIT,
+        'orphans': orphans,
+        'projects': sorted(projects.values(), key=lambda s: -s['total']),
+    }
+
+
+def collect_garbage():
+    """
+    Evicts content from the workspace until it fits in
+    WORKSPACE_SIZE_LIMIT bytes: the least important first, the least
+    recently used first for the same importance.
+
+    Returns the evicted items.
+    """
+    items = scan()
+    total = sum([item.size for item in items])
+    evicted = []
+    candidates = sorted([item for item in items if item.evictable],
+                        key=lambda item: (item.importance, item.last_access))
+    for item in candidates:
+        if total <= settings.WORKSPACE_SIZE_LIMIT:
+            break
+        if item.kind == 'warm':
+            # Don't pull the rug from under a job
+            lease = Lock('workspace:%s' % item.path)
+            if not lease.acquire():
+                continue
+            try:
+                move_to_trash(item.path)
+            finally:
+                lease.release()
+        else:
+            move_to_trash(item.path)
+        logger.info("Evicted %s" % item.path)
+        total -= item.size
+        evicted.append(item)
+
+    if evicted:
+        from .tasks import empty_trash
+        empty_trash.delay()
+        items = [item for item in items if item not in evicted]
+    cache.set(USAGE_KEY, usage_stats(items), 24 * 60 * 60)
+    return evicted
+
+
+def get_usage_stats():
+    stats = cache.get(USAGE_KEY)
+    if stats is None:
+        stats = usage_stats(scan())
+        cache.set(USAGE_KEY, stats, 24 * 60 * 60)
+    return stats
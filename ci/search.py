@@ -0,0 +1,117 @@
+import cgi
+import os
+import sqlite3
+
+from django.conf import settings
+
+# Markers around the matches in snippets, replaced after HTML escaping
+MATCH_START = u'\x02'
+MATCH_END = u'\x03'
+
+
+class LogIndex(object):
+    """
+    Full-text index of the build outputs in a SQLite database, next to the
+    main database. Uses FTS5 if SQLite has it, FTS4 otherwise.
+
+    The rowids of the full-text table are the job ids, the metadata used to
+    filter the results is in a regular table.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')  # Readers don't block
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY, project TEXT, branch TEXT, '
+                'axis TEXT, end_date TEXT)')
+            for column in ['project', 'branch', 'end_date']:
+                self.db.execute(
+                    'CREATE INDEX IF NOT EXISTS jobs_%s ON jobs (%s)' % (
+                        column, column))
+            if not self.db.execute("SELECT 1 FROM sqlite_master WHERE "
+                                   "name = 'logs'").fetchall():
+                try:
+                    self.db.execute('CREATE VIRTUAL TABLE logs USING '
+                                    'fts5(output)')
+                except sqlite3.OperationalError:
+                    self.db.execute('CREATE VIRTUAL TABLE logs USING '
+                                    'fts4(output)')
+        self.fts5 = 'fts5' in self.db.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'logs'",
+        ).fetchone()[0].lower()
+
+    def close(self):
+        self.db.close()
+
+    def add(self, job_id, output, project, branch, values, end_date):
+        """
+        Indexes the output of a job, replacing what was indexed before.
+        <values> are the job's axis values.
+        """
+        axis = ' %s ' % ' '.join(['%s=%s' % item
+                                  for item in sorted(values.items())])
+        with self.db:
+            self._remove(job_id)
+            self.db.execute('INSERT INTO logs (rowid, output) VALUES (?, ?)',
+                            (job_id, output))
+            self.db.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?)',
+                            (job_id, project, branch, axis,
+                             end_date.isoformat()))
+
+    def remove(self, job_ids):
+        with self.db:
+            for job_id in job_ids:
+                self._remove(job_id)
+
+    def _remove(self, job_id):
+        self.db.execute('DELETE FROM logs WHERE rowid = ?', (job_id,))
+        self.db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def job_ids(self):
+        return [row[0] for row in self.db.execute('SELECT id FROM jobs')]
+
+    def search(self, query, project=None, branch=None, value=None,
+               since=None, until=None, limit=50):
+        """
+        The latest jobs whose output matches <query> (in the FTS query
+        syntax, e.g. words or "a phrase"), as (job id, HTML snippet) tuples.
+        """
+        if self.fts5:
+            snippet = "snippet(logs, 0, ?, ?, '...', 24)"
+        else:
+            snippet = "snippet(logs, ?, ?, '...', 0, 24)"
+        sql = ['SELECT jobs.id, %s FROM logs JOIN jobs ON '
+               'jobs.id = logs.rowid WHERE logs MATCH ?' % snippet]
+        params = [MATCH_START, MATCH_END, query]
+        for column, operator, param in [('project', '=', project),
+                                        ('branch', '=', branch),
+                                        ('end_date', '>=', since),
+                                        ('end_date', '<', until)]:
+            if param is not None:
+                sql.append('AND jobs.%s %s ?' % (column, operator))
+                params.append(hasattr(param, 'isoformat') and
+                              param.isoformat() or param)
+        if value is not None:
+            sql.append("AND jobs.axis LIKE ? ESCAPE '\\'")
+            params.append('%% %s %%' % like_escape(value))
+        # Job ids grow with time, and FTS tables are sorted by rowid
+        sql.append('ORDER BY logs.rowid DESC LIMIT ?')
+        params.append(limit)
+        return [(job_id, highlight(text)) for job_id, text in
+                self.db.execute(' '.join(sql), params)]
+
+
+def like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_')
+
+
+def highlight(snippet):
+    return cgi.escape(snippet).replace(MATCH_START, '<mark>').replace(
+        MATCH_END, '</mark>')
+
+
+def get_index():
+    return LogIndex(os.path.join(settings.WORKSPACE, 'search.sqlite'))
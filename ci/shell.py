@@ -1,7 +1,9 @@
 import os
 import logging
+import signal
 import subprocess
 
+from . import tracing
 from .exceptions import CommandError
 
 logger = logging.getLogger('ci')
@@ -10,6 +12,10 @@ logger = logging.getLogger('ci')
 class Command(object):
     def __init__(self, command, stdin=None, environ={}, stream_to=None,
                  cwd=None):
+        with tracing.span('Command', command=command[:200]):
+            self.run(command, stdin, environ, stream_to, cwd)
+
+    def run(self, command, stdin, environ, stream_to, cwd):
         self.command = command
         env = os.environ
         env.update(environ)
@@ -21,20 +27,38 @@ class Command(object):
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             cwd=cwd,
+            # In its own process group, to kill the commands it runs too
+            preexec_fn=os.setsid,
         )
         self.out = ''
         logger.info("Running: '%s'" % self.command)
 
-        while self.process.poll() is None:
-            output = self.process.stdout.readline()
-            if stream_to is None:
-                self.out += output
-            else:
-                stream_to(output)
+        if stdin:
+            self.process.stdin.write(stdin)
+        self.process.stdin.close()
+
+        try:
+            for output in iter(self.process.stdout.readline, ''):
+                if stream_to is None:
+                    self.out += output
+                else:
+                    stream_to(output)
+        except BaseException:
+            # <stream_to> gave up on the command
+            logger.info("Killing: '%s'" % self.command)
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+            raise
+        finally:
+            self.process.stdout.close()
 
-        output, err = self.process.communicate(stdin)
-        if output:
-            self.out += output
+        # wait4() instead of wait() for the resources used by the process
+        # and its children
+        pid, status, self.rusage = os.wait4(self.process.pid, 0)
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
         self.return_code = self.process.returncode
 
         # Raise an error if the command isn't successful
@@ -2,12 +2,16 @@ from default_settings import *
 
 # Don't break the local workspace
 WORKSPACE = os.path.join(HERE, 'test_workspace')
+LOGS_ROOT = os.path.join(WORKSPACE, 'logs')
 
 # Make tasks synchronous
 CELERY_ALWAYS_EAGER = True
 # Fail loudly, not silently
 CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
 
+# No Redis needed for the metrics
+METRICS_REDIS = None
+
 # Silent CI logs
 LOGGING['handlers']['null'] = {
     'level': 'DEBUG',
@@ -0,0 +1,165 @@
+import anyjson as json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger('ci')
+
+_local = threading.local()
+
+
+class Span(object):
+    def __init__(self, trace_id, parent_id, name, attributes):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+
+    def otlp(self):
+        """
+        The span in OTLP/JSON format.
+        """
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(int(self.start * 1e9)),
+            'endTimeUnixNano': str(int(self.end * 1e9)),
+            'attributes': [
+                {'key': key, 'value': {'stringValue': unicode(value)}}
+                for key, value in sorted(self.attributes.items())
+            ],
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+        _local.finished = []
+    return _local.stack
+
+
+def current():
+    """
+    The context to pass to tasks so that their spans join the current trace:
+    (trace id, span id, time sent), or None outside of a trace.
+    """
+    stack = _stack()
+    if not stack:
+        return None
+    return (stack[-1].trace_id, stack[-1].span_id, time.time())
+
+
+def trace_id():
+    context = current()
+    return context[0] if context is not None else ''
+
+
+@contextmanager
+def _record(current):
+    stack = _stack()
+    stack.append(current)
+    try:
+        yield current
+    finally:
+        current.end = time.time()
+        stack.pop()
+        _local.finished.append(current)
+        if not stack:
+            flush()
+
+
+@contextmanager
+def span(name, root=False, **attributes):
+    """
+    Times the enclosed block. Outside of a trace, does nothing unless
+    <root> is True, in which case a new trace is started.
+    """
+    stack = _stack()
+    if stack:
+        parent = stack[-1]
+        with _record(Span(parent.trace_id, parent.span_id, name,
+                          attributes)) as current:
+            yield current
+    elif root and settings.TRACING:
+        with _record(Span(uuid.uuid4().hex, '', name,
+                          attributes)) as current:
+            yield current
+    else:
+        yield None
+
+
+@contextmanager
+def resume(context, name, **attributes):
+    """
+    Starts a span in the trace of <context>, as returned by current() in
+    another process, or a new trace if <context> is None. The time spent
+    between current() and resume() is recorded as a 'queue' span.
+    """
+    if context is None or not settings.TRACING:
+        with span(name, root=True, **attributes) as current:
+            yield current
+        return
+    trace_id, parent_id, sent = context
+    with _record(Span(trace_id, parent_id, name, attributes)) as current:
+        queue = Span(trace_id, parent_id, 'queue', {})
+        queue.start = sent
+        queue.end = current.start
+        _local.finished.append(queue)
+        yield current
+
+
+def flush():
+    """
+    Stores the finished spans and exports them if TRACING_OTLP_FILE is set.
+    Tracing never breaks a build.
+    """
+    spans, _local.finished = _local.finished, []
+    try:
+        from .projects.models import Span as StoredSpan  # circular imports
+        for finished in spans:
+            StoredSpan.objects.create(
+                trace_id=finished.trace_id,
+                span_id=finished.span_id,
+                parent_id=finished.parent_id or '',
+                name=finished.name[:255],
+                start=finished.start,
+                duration=finished.end - finished.start,
+                attributes=json.dumps(finished.attributes),
+            )
+        if settings.TRACING_OTLP_FILE:
+            export(spans, settings.TRACING_OTLP_FILE)
+    except Exception:
+        logger.exception("Unable to store spans")
+
+
+def export(spans, path):
+    """
+    Appends <spans> to an OTLP/JSON file, one line per batch.
+    """
+    batch = {'resourceSpans': [{
+        'resource': {'attributes': [
+            {'key': 'service.name', 'value': {'stringValue': 'ci'}},
+            {'key': 'process.pid',
+             'value': {'stringValue': str(os.getpid())}},
+        ]},
+        'scopeSpans': [{
+            'scope': {'name': 'ci'},
+            'spans': [s.otlp() for s in spans],
+        }],
+    }]}
+    with open(path, 'a') as f:
+        f.write(json.dumps(batch) + '\n')
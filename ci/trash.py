@@ -0,0 +1,79 @@
+import errno
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from django.conf import settings
+
+logger = logging.getLogger('ci')
+
+
+def trash_dir():
+    path = os.path.join(settings.WORKSPACE, 'trash')
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def move_to_trash(path):
+    """
+    Moves <path> out of the way. Renaming is atomic and instantaneous, the
+    actual deletion happens later in :func:`empty_trash`.
+    """
+    target = os.path.join(trash_dir(), '%s-%s' % (os.path.basename(path),
+                                                  uuid.uuid4().hex))
+    try:
+        os.rename(path, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Not on the same filesystem
+        shutil.rmtree(path)
+
+
+def empty_trash():
+    """
+    Deletes everything in the trash, including what's been left behind by
+    interrupted runs. Deletions are throttled to TRASH_DELETE_RATE files per
+    second to leave some I/O for running jobs.
+    """
+    root = trash_dir()
+    batch = max(1, settings.TRASH_DELETE_RATE // 10)
+    deleted = 0
+    started = time.time()
+    for name in os.listdir(root):
+        logger.info("Deleting %s" % name)
+        path = os.path.join(root, name)
+        if os.path.islink(path) or not os.path.isdir(path):
+            remove(os.remove, path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for filename in filenames:
+                remove(os.remove, os.path.join(dirpath, filename))
+                deleted += 1
+                if deleted % batch == 0:
+                    elapsed = time.time() - started
+                    expected = float(deleted) / settings.TRASH_DELETE_RATE
+                    if expected > elapsed:
+                        time.sleep(expected - elapsed)
+            for dirname in dirnames:
+                subdir = os.path.join(dirpath, dirname)
+                if os.path.islink(subdir):
+                    remove(os.remove, subdir)
+                else:
+                    remove(os.rmdir, subdir)
+        remove(os.rmdir, path)
+    return deleted
+
+
+def remove(function, path):
+    """
+    Another reaper may be deleting the same files: missing files are fine.
+    """
+    try:
+        function(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
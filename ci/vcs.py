@@ -1,4 +1,7 @@
+import hashlib
 import os
+import pipes
+import re
 
 from datetime import datetime
 from StringIO import StringIO
@@ -7,9 +10,47 @@ from dulwich.repo import Repo
 from dulwich.walk import Walker
 from mercurial import ui, hg
 
+from .exceptions import CommandError
 from .shell import Command
 
 
+def normalize_url(url):
+    """
+    Normalizes a repository URL so that the different ways of writing it --
+    scheme, user, scp-like syntax, trailing slash or ".git" suffix -- all
+    give the same result.
+    """
+    url = url.strip()
+    scp_like = re.match(r'^(?:[^@/]+@)?([^:/]+):(?!//)(.*)$', url)
+    if '://' in url:
+        scheme, rest = url.split('://', 1)
+        if scheme == 'file':
+            host, path = '', rest
+        else:
+            host, _, path = rest.partition('/')
+            host = host.rsplit('@', 1)[-1].split(':')[0].lower()
+    elif scp_like is not None:
+        host, path = scp_like.groups()
+        host = host.lower()
+    else:
+        host, path = '', os.path.abspath(url)
+    path = path.rstrip('/')
+    if path.endswith('.git'):
+        path = path[:-4].rstrip('/')
+    return '%s/%s' % (host, path.lstrip('/'))
+
+
+def mirror_name(repo_type, url):
+    """
+    The directory name of a repository's mirror: its name, followed by a
+    hash of its URL.
+    """
+    normalized = normalize_url(url)
+    name = re.sub(r'[^\w.-]', '_', normalized.rsplit('/', 1)[-1]) or 'repo'
+    digest = hashlib.sha1('%s:%s' % (repo_type, normalized)).hexdigest()
+    return '%s-%s' % (name, digest[:12])
+
+
 class Commit(object):
     """
     A common object to represent a commit.
@@ -29,9 +70,12 @@ class Commit(object):
 
 
 class Vcs(object):
-    def __init__(self, repo_url, path):
+    def __init__(self, repo_url, path, reference=None):
         self.repo_url = repo_url
         self.path = path
+        # A local repository sharing history with this one, used to avoid
+        # storing and fetching the same objects twice.
+        self.reference = reference
 
 
 class Git(Vcs):
@@ -45,14 +89,26 @@ class Git(Vcs):
             self._repo = Repo(self.path)
         return self._repo
 
-    def update_source(self):
+    def update_source(self, branches=None):
         """
-        Clones if the project hasn't been cloned yet. Fetches otherwise.
+        Clones if the project hasn't been cloned yet. Fetches otherwise --
+        only <branches> if given.
         """
         cwd = None
-        if os.path.exists(self.path):
+        if os.path.exists(self.path) and branches:
+            cwd = self.path
+            cmd = 'git fetch origin %s' % ' '.join([
+                pipes.quote('+refs/heads/%s:refs/remotes/origin/%s' % (
+                    branch, branch,
+                )) for branch in branches
+            ])
+        elif os.path.exists(self.path):
             cwd = self.path
             cmd = 'git fetch && git reset --hard origin/master'
+        elif self.reference is not None:
+            cmd = 'git clone --reference %s %s %s' % (
+                self.reference, self.repo_url, self.path,
+            )
         else:
             cmd = 'git clone %s %s' % (self.repo_url, self.path)
         Command(cmd, cwd=cwd)
@@ -71,11 +127,59 @@ class Git(Vcs):
             )
         ])
 
+    def remote_branches(self):
+        """
+        Lists the upstream branches and their HEAD without fetching anything.
+        """
+        out = Command('git ls-remote --heads %s' % pipes.quote(
+            self.repo_url,
+        )).out
+        heads = {}
+        for line in out.splitlines():
+            if '\t' not in line:
+                continue
+            sha, ref = line.split('\t', 1)
+            if ref.startswith('refs/heads/'):
+                heads[ref[11:]] = sha
+        return heads
+
+    def changed_branches(self):
+        """
+        Lists the branches that have changed upstream since the last fetch,
+        or None if the repository hasn't been cloned yet.
+        """
+        if not os.path.exists(self.path):
+            return None
+        local = self.repo.get_refs()
+        return sorted([
+            branch for branch, sha in self.remote_branches().items()
+            if local.get('refs/remotes/origin/' + branch) != sha
+        ])
+
+    def maintain(self, prune=True):
+        """
+        Repacks the objects and writes a commit-graph, keeping ref reads and
+        history walks fast on long-lived clones. Unreachable objects are kept
+        unless <prune> is True: other clones may borrow them via alternates.
+        """
+        if prune:
+            repack = 'git repack -a -d -l && git prune'
+        else:
+            repack = 'git repack -A -d -l'
+        Command('%s && git pack-refs --all && '
+                'git commit-graph write --reachable' % repack, cwd=self.path)
+
     def checkout(self, branch, revision):
         Command('git checkout %s && git reset --hard %s' % (
             branch, revision,
         ), cwd=self.path)
 
+    def clean(self):
+        """
+        Removes untracked files, except the ignored ones.
+        """
+        Command('git clean -fd', cwd=self.path)
+
     def latest_branch_revision(self, branch):
         """
         Returns the SHA of a branch's HEAD
@@ -119,11 +223,13 @@ class Hg(Vcs):
             self._repo = hg.repository(ci(), self.path)
         return self._repo
 
-    def update_source(self):
+    def update_source(self, branches=None):
         cwd = None
         if os.path.exists(self.path):
             cwd = self.path
-            cmd = 'hg pull && hg update -C'
+            cmd = 'hg pull %s&& hg update -C' % ''.join([
+                '-b %s ' % pipes.quote(branch) for branch in branches or []
+            ])
         else:
             cmd = 'hg clone %s %s' % (self.repo_url, self.path)
         Command(cmd, cwd=cwd)
@@ -137,11 +243,42 @@ class Hg(Vcs):
     def latest_branch_revision(self, branch):
         return self.repo.changelog.rev(self.repo.branchtags()[branch])
 
+    def changed_branches(self):
+        """
+        Lists the branches that have heads unknown to the local clone, or
+        None if the repository hasn't been cloned yet.
+        """
+        if not os.path.exists(self.path):
+            return None
+        remote = hg.repository(ci(), self.repo_url)
+        known = self.repo.changelog.nodemap
+        return sorted([
+            branch for branch, heads in remote.branchmap().items()
+            if [head for head in heads if head not in known]
+        ])
+
+    def maintain(self, prune=True):
+        """
+        Rolls back interrupted transactions and checks the repository's
+        integrity. Mercurial revlogs don't need repacking.
+        """
+        try:
+            Command('hg recover', cwd=self.path)
+        except CommandError:
+            pass  # No interrupted transaction
+        Command('hg verify', cwd=self.path)
+
     def checkout(self, branch, revision):
         Command('hg update -C %s && hg update -r %s' % (
             branch, revision,
         ), cwd=self.path)
 
+    def clean(self):
+        """
+        Removes untracked files, except the ignored ones.
+        """
+        Command('hg --config extensions.purge= purge', cwd=self.path)
+
     def changelog(self, branch, since=None):
         current_ctx = self.repo.changectx(self.latest_branch_revision(branch))
         watch = [current_ctx]